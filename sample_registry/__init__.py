@@ -12,6 +12,12 @@ __version__ = "1.4.0"
 ARCHIVE_ROOT = Path(
     os.environ.get("SAMPLE_REGISTRY_ARCHIVE_ROOT", "/mnt/isilon/microbiome/")
 )
+# Files derived from archived run data, such as QC read previews, are cached here
+CACHE_DIR = Path(
+    os.environ.get(
+        "SAMPLE_REGISTRY_CACHE_DIR", Path(__file__).parent.parent.resolve() / "cache"
+    )
+)
 # Doesn't include "NA" because that's what we fill in for missing values
 NULL_VALUES: list[Optional[str]] = [
     None,
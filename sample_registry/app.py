@@ -1,10 +1,14 @@
 import csv
-import pickle
+import functools
+import hashlib
+import json
 import os
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 from flask import (
     Flask,
+    Response,
+    g,
     make_response,
     render_template,
     url_for,
@@ -12,21 +16,48 @@ from flask import (
     redirect,
     send_file,
     send_from_directory,
+    stream_with_context,
     jsonify,
 )
 from flask_sqlalchemy import SQLAlchemy
 from contextlib import contextmanager
 from io import StringIO
 from pathlib import Path
-from sample_registry import ARCHIVE_ROOT, SQLALCHEMY_DATABASE_URI
-from sample_registry.mapping import SampleTable
-from sample_registry.models import Base, Annotation, Run, Sample
-from sample_registry.db import run_to_dataframe, query_tag_stats, STANDARD_TAGS
+from sample_registry import ARCHIVE_ROOT, CACHE_DIR, SQLALCHEMY_DATABASE_URI
+from sample_registry import instrument, jobs, metrics, operations, slowlog
+from sample_registry.bulk import scalars_in
+from sample_registry.export import iter_mapping_tsv
+from sample_registry.models import (
+    Base,
+    Annotation,
+    ArchiveStatus,
+    IdempotencyKey,
+    RegistrationJob,
+    Run,
+    Sample,
+)
+from sample_registry.db import (
+    ensure_schema,
+    run_to_dict,
+    sample_to_dict,
+    run_to_dataframe,
+    query_tag_stats,
+    STANDARD_TAGS,
+)
 from sample_registry.registrar import SampleRegistry
 from sample_registry.standards import STANDARD_HOST_SPECIES, STANDARD_SAMPLE_TYPES
+from sample_registry.subsample import subsample_info, subsample_path
+from sample_registry.util import accession_number
+from sample_registry.writequeue import (
+    DEFAULT_MAX_DEPTH,
+    DEFAULT_TIMEOUT,
+    WriteQueue,
+    WriteUnavailable,
+)
 from typing import Optional
 from werkzeug.middleware.proxy_fix import ProxyFix
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker
 
 app = Flask(__name__)
@@ -41,12 +72,77 @@ SQLALCHEMY_WRITE_URI = SQLALCHEMY_DATABASE_URI
 SQLALCHEMY_DATABASE_URI = f"{SQLALCHEMY_DATABASE_URI.split('?')[0]}?mode=ro"
 app.config["SQLALCHEMY_DATABASE_URI"] = SQLALCHEMY_DATABASE_URI
 print(SQLALCHEMY_DATABASE_URI)
+# Connection pool settings, so they can be matched to the server's thread count
+POOL_OPTIONS = {
+    option: cast(os.environ[env])
+    for option, env, cast in [
+        ("pool_size", "SAMPLE_REGISTRY_POOL_SIZE", int),
+        ("max_overflow", "SAMPLE_REGISTRY_POOL_MAX_OVERFLOW", int),
+        ("pool_timeout", "SAMPLE_REGISTRY_POOL_TIMEOUT", float),
+        ("pool_recycle", "SAMPLE_REGISTRY_POOL_RECYCLE", int),
+    ]
+    if os.environ.get(env)
+}
 # Ensure SQLite explicitly opens in read-only mode
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"connect_args": {"uri": True}}
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "connect_args": {"uri": True},
+    **POOL_OPTIONS,
+}
 db = SQLAlchemy(model_class=Base)
 db.init_app(app)
-write_engine = create_engine(SQLALCHEMY_WRITE_URI, echo=False)
+write_engine = create_engine(SQLALCHEMY_WRITE_URI, echo=False, **POOL_OPTIONS)
 WriteSession = sessionmaker(bind=write_engine)
+ensure_schema(write_engine)
+with app.app_context():
+    metrics.init_app(app, [db.engine, write_engine])
+    if instrument.enabled():
+        instrument.init_app(app, [db.engine, write_engine])
+    if slowlog.threshold_ms() is not None:
+        slowlog.init_engines(
+            [db.engine, write_engine], slowlog.threshold_ms(), slowlog.log_path()
+        )
+
+# SQLite has a single writer, so API writes go through one thread that
+# commits them in groups. The thread starts on the first write, so a server
+# that preloads the app starts one per worker after forking; run a single
+# worker process for the writes to be serialized across the whole server.
+WRITE_QUEUE_DEPTH = int(
+    os.environ.get(
+        "SAMPLE_REGISTRY_WRITE_QUEUE_DEPTH",
+        DEFAULT_MAX_DEPTH if write_engine.dialect.name == "sqlite" else 0,
+    )
+)
+WRITE_TIMEOUT = float(os.environ.get("SAMPLE_REGISTRY_WRITE_TIMEOUT", DEFAULT_TIMEOUT))
+write_queue = (
+    WriteQueue(WriteSession, WRITE_QUEUE_DEPTH, timeout=WRITE_TIMEOUT)
+    if WRITE_QUEUE_DEPTH
+    else None
+)
+
+# Large sample tables can be registered in the background as jobs. A job
+# that has been running for longer than its lease is taken over, in case
+# the process running it died.
+JOB_LEASE = timedelta(
+    seconds=float(os.environ.get("SAMPLE_REGISTRY_JOB_LEASE_SECONDS", 3600))
+)
+job_worker = jobs.JobWorker(
+    WriteSession,
+    lease=JOB_LEASE,
+    submit=functools.partial(write_queue.submit, block=True) if write_queue else None,
+)
+
+# How long the response to a request with an Idempotency-Key is kept for retries
+IDEMPOTENCY_TTL = timedelta(
+    hours=float(os.environ.get("SAMPLE_REGISTRY_IDEMPOTENCY_TTL_HOURS", 24))
+)
+# How long a request may hold an Idempotency-Key before a retry can take it over
+IDEMPOTENCY_LEASE = timedelta(
+    seconds=float(os.environ.get("SAMPLE_REGISTRY_IDEMPOTENCY_LEASE_SECONDS", 300))
+)
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+API_SAMPLES_PAGE_SIZE = 1000
+API_SAMPLES_MAX_PAGE_SIZE = 10000
 
 
 @contextmanager
@@ -71,18 +167,15 @@ def api_error(message: str, status: int = 400):
     return jsonify({"status": "error", "error": message}), status
 
 
-def api_sample_table_from_request():
-    if "sample_table" in request.files:
-        content = request.files["sample_table"].stream.read().decode("utf-8")
-    else:
-        data = api_request_data()
-        content = data.get("sample_table")
-    if not content:
-        raise ValueError("sample_table is required")
-    sample_table = SampleTable.load(StringIO(content))
-    sample_table.look_up_nextera_barcodes()
-    sample_table.validate()
-    return sample_table
+def api_sample_filters_from_args() -> dict:
+    runs = [r for arg in request.args.getlist("run") for r in arg.split(",") if r]
+    return {
+        "run_accessions": [accession_number(r, "run") for r in runs] or None,
+        "tag": request.args.get("tag"),
+        "val": request.args.get("val"),
+        "start_date": request.args.get("start_date"),
+        "end_date": request.args.get("end_date"),
+    }
 
 
 @app.route("/favicon.ico")
@@ -113,12 +206,6 @@ def show_tags(tag: Optional[str] = None, val: Optional[str] = None):
                 .all()
             )
         else:
-            annotations = (
-                db.session.query(Annotation)
-                .filter(Annotation.key == tag, Annotation.val == val)
-                .all()
-            )
-            sample_accessions = [a.sample_accession for a in annotations]
             samples = (
                 db.session.query(
                     Sample.sample_accession,
@@ -128,7 +215,10 @@ def show_tags(tag: Optional[str] = None, val: Optional[str] = None):
                     Run.run_date,
                 )
                 .join(Run, Sample.run_accession == Run.run_accession)
-                .filter(Sample.sample_accession.in_(sample_accessions))
+                .join(
+                    Annotation, Annotation.sample_accession == Sample.sample_accession
+                )
+                .filter(Annotation.key == tag, Annotation.val == val)
                 .order_by(
                     Run.run_date.desc(),
                     Run.machine_type,
@@ -139,12 +229,13 @@ def show_tags(tag: Optional[str] = None, val: Optional[str] = None):
                 .all()
             )
 
-        sample_annotations = (
-            db.session.query(Annotation)
-            .filter(
-                Annotation.sample_accession.in_([s.sample_accession for s in samples])
+        sample_annotations = list(
+            scalars_in(
+                db.session,
+                select(Annotation),
+                Annotation.sample_accession,
+                [s.sample_accession for s in samples],
             )
-            .all()
         )
         keyed_metadata = {
             sa: [a for a in sample_annotations if a.sample_accession == sa]
@@ -178,20 +269,9 @@ def show_runs(run_acc: Optional[str] = None):
         run_acc = "".join(filter(str.isdigit, run_acc.strip()))  # Sanitize run_acc
 
     if request.path.endswith(".json"):
-        run = db.session.query(Run).filter(Run.run_accession == run_acc).all()
-        with open(f"run_{run_acc}", "wb") as f:  # TEMP
-            pickle.dump(run, f)
-        return send_file(f"run_{run_acc}", as_attachment=True)
-    elif request.path.endswith(".txt"):
-        run = db.session.query(Run).filter(Run.run_accession == run_acc).all()
-        with open(f"run_{run_acc}", "wb") as f:  # TEMP
-            pickle.dump(run, f)
-        return send_file(f"run_{run_acc}", as_attachment=True)
-    elif request.path.endswith(".tsv"):
-        run = db.session.query(Run).filter(Run.run_accession == run_acc).all()
-        with open(f"run_{run_acc}", "wb") as f:  # TEMP
-            pickle.dump(run, f)
-        return send_file(f"run_{run_acc}", as_attachment=True)
+        return run_json_response(run_acc)
+    elif request.path.endswith((".txt", ".tsv")):
+        return run_mapping_response(run_acc, request.path[-4:])
     elif run_acc:
         run = db.session.query(Run).filter(Run.run_accession == run_acc).all()
         samples = (
@@ -202,18 +282,33 @@ def show_runs(run_acc: Optional[str] = None):
         )
         annotations = (
             db.session.query(Annotation)
-            .filter(
-                Annotation.sample_accession.in_([s.sample_accession for s in samples])
-            )
+            .join(Sample, Annotation.sample_accession == Sample.sample_accession)
+            .filter(Sample.run_accession == run_acc)
             .all()
         )
         keyed_annotations = {
             sa: [a for a in annotations if a.sample_accession == sa]
             for sa in [s.sample_accession for s in samples]
         }
+        read_counts = SampleRegistry(db.session).get_read_counts(int(run_acc))
+
+        archive_status = (
+            db.session.query(ArchiveStatus)
+            .filter(ArchiveStatus.run_accession == run_acc)
+            .first()
+        )
+        preview = subsample_info(int(run_acc), CACHE_DIR)
+        metrics.count_cache("preview", preview is not None)
 
         return render_template(
-            "show_run.html", run=run, samples=samples, sample_metadata=keyed_annotations
+            "show_run.html",
+            run=run,
+            samples=samples,
+            sample_metadata=keyed_annotations,
+            read_counts=read_counts,
+            preview=preview,
+            archive_root=ARCHIVE_ROOT,
+            archive_status=archive_status,
         )
     else:
         runs = db.session.query(Run).all()[::-1]
@@ -226,7 +321,14 @@ def show_runs(run_acc: Optional[str] = None):
             .all()
         }
         sample_counts = {run: sample_counts.get(run.run_accession, 0) for run in runs}
-        return render_template("browse_runs.html", sample_counts=sample_counts)
+        archive_status = {
+            s.run_accession: s for s in db.session.query(ArchiveStatus).all()
+        }
+        return render_template(
+            "browse_runs.html",
+            sample_counts=sample_counts,
+            archive_status=archive_status,
+        )
 
 
 @app.route("/stats")
@@ -350,19 +452,60 @@ def show_stats():
     )
 
 
-@app.route("/download/<run_acc>", methods=["GET", "POST"])
-def download(run_acc: str):
-    ext = run_acc[-4:]
-    run_acc = run_acc[:-4]
+def run_json_response(run_acc: str):
+    run = db.session.query(Run).filter(Run.run_accession == run_acc).first()
+    if not run:
+        return api_error(f"Run does not exist: {run_acc}", 404)
+    samples = (
+        db.session.query(Sample)
+        .filter(Sample.run_accession == run.run_accession)
+        .order_by(Sample.sample_accession)
+        .all()
+    )
+    annotations = defaultdict(list)
+    for a in (
+        db.session.query(Annotation)
+        .join(Sample, Annotation.sample_accession == Sample.sample_accession)
+        .filter(Sample.run_accession == run.run_accession)
+        .order_by(Annotation.sample_accession, Annotation.key)
+    ):
+        annotations[a.sample_accession].append(a)
+
+    with instrument.timed("serialize"):
+        response = jsonify(
+            {
+                "run": run_to_dict(run),
+                "samples": [
+                    sample_to_dict(s, annotations[s.sample_accession]) for s in samples
+                ],
+            }
+        )
+    response.headers["Content-Disposition"] = (
+        f"attachment; filename=CMR{run.run_accession:06d}.json"
+    )
+    return response
+
+
+def run_mapping_response(run_acc: str, ext: str):
+    run = db.session.query(Run).filter(Run.run_accession == run_acc).first()
+    if not run or ext not in (".txt", ".tsv"):
+        return render_template("failed_export.html", run_acc=run_acc)
     t = run_to_dataframe(db, run_acc)
+    with instrument.timed("serialize"):
+        csv_file = write_mapping(run, t, ext)
+
+    # Create the response and set the appropriate headers
+    response = make_response(csv_file.getvalue())
+    response.headers["Content-Disposition"] = f"attachment; filename={run_acc}{ext}"
+    response.headers["Content-type"] = "text/csv"
+    return response
+
+
+def write_mapping(run: Run, t: dict, ext: str) -> StringIO:
     csv_file = StringIO()
     writer = csv.writer(csv_file, delimiter="\t")
 
     if ext == ".txt":
-        run = db.session.query(Run).filter(Run.run_accession == run_acc).first()
-        if not run:
-            return render_template("failed_export.html", run_acc=run_acc)
-
         QIIME_HEADERS = {
             "Barcode": "BarcodeSequence",
             "Primer": "LinkerPrimerSequence",
@@ -379,202 +522,424 @@ def download(run_acc: str):
         writer.writerow([f"#Run accession: CMR{run.run_accession:06d}"])
         for row in zip(*t.values()):
             writer.writerow(row)
-    elif ext == ".tsv":
+    else:
         writer.writerow(t.keys())
         for row in zip(*t.values()):
             writer.writerow(row)
-    else:
-        return render_template("failed_export.html", run_acc=run_acc)
-
-    # Create the response and set the appropriate headers
-    response = make_response(csv_file.getvalue())
-    response.headers["Content-Disposition"] = f"attachment; filename={run_acc}{ext}"
-    response.headers["Content-type"] = "text/csv"
+    return csv_file
+
+
+@app.route("/download/<run_acc>", methods=["GET", "POST"])
+def download(run_acc: str):
+    return run_mapping_response(run_acc[:-4], run_acc[-4:])
+
+
+@app.route("/export/mapping.tsv")
+def export_merged_mapping():
+    try:
+        filters = api_sample_filters_from_args()
+    except ValueError as exc:
+        return api_error(str(exc))
+    if not filters["run_accessions"] and not filters["tag"]:
+        return api_error("Give at least one run or a tag to export")
+    response = Response(
+        stream_with_context(iter_mapping_tsv(db.session, **filters)),
+        mimetype="text/csv",
+    )
+    response.headers["Content-Disposition"] = "attachment; filename=mapping.tsv"
     return response
 
 
-@app.post("/api/register_run")
-def api_register_run():
-    data = api_request_data()
-    missing = [k for k in ("file", "date", "comment") if not data.get(k)]
-    if missing:
-        return api_error(f"Missing required fields: {', '.join(missing)}")
+@app.route("/preview/<run_acc>")
+def download_preview(run_acc: str):
+    run_acc = "".join(filter(str.isdigit, run_acc.strip()))  # Sanitize run_acc
+    fp = subsample_path(int(run_acc), CACHE_DIR) if run_acc else None
+    hit = bool(fp and fp.exists())
+    metrics.count_cache("preview", hit)
+    if not hit:
+        return render_template("failed_export.html", run_acc=run_acc)
+    return send_file(fp, as_attachment=True, download_name=fp.name)
+
+
+@app.route("/api/resolve", methods=["GET", "POST"])
+def api_resolve():
+    if request.method == "POST":
+        accessions = api_request_data().get("accessions")
+        if isinstance(accessions, str):
+            accessions = accessions.split(",")
+    else:
+        accessions = [
+            a for arg in request.args.getlist("accessions") for a in arg.split(",")
+        ]
+    if not accessions or not isinstance(accessions, list):
+        return api_error("Missing required field: accessions")
+    if not all(isinstance(a, str) for a in accessions):
+        return api_error("accessions must be strings like CMS000123 or CMR000007")
+    resolved = SampleRegistry(db.session).resolve_many(accessions)
+    return jsonify(dict(resolved, status="ok"))
+
+
+@app.get("/api/samples")
+def api_samples():
     try:
-        lane = int(data.get("lane", 1))
+        filters = api_sample_filters_from_args()
+        after = accession_number(request.args.get("after", "0"), "sample")
+        limit = int(request.args.get("limit", API_SAMPLES_PAGE_SIZE))
     except ValueError as exc:
-        return api_error(f"Invalid lane value: {exc}")
+        return api_error(str(exc))
+    limit = max(1, min(limit, API_SAMPLES_MAX_PAGE_SIZE))
+
+    page = SampleRegistry(db.session).get_sample_page(after, limit, **filters)
+    with instrument.timed("serialize"):
+        body = "".join(json.dumps(s) + "\n" for s in page)
+    response = make_response(body, 200)
+    response.mimetype = "application/x-ndjson"
+    if len(page) == limit:
+        # A full page may have more after it; the client resumes from here
+        next_after = page[-1]["sample_accession"]
+        args = request.args.to_dict(flat=False)
+        args["after"] = [next_after]
+        response.headers["X-Next-After"] = next_after
+        response.headers["Link"] = '<{0}>; rel="next"'.format(
+            url_for("api_samples", **args)
+        )
+    return response
+
+
+def apply_write(operation, data) -> dict:
     with api_registry() as registry:
         try:
-            run_accession = registry.register_run(
-                data["date"],
-                data.get("type", "Illumina-MiSeq"),
-                "Nextera XT",
-                lane,
-                data["file"],
-                data["comment"],
-            )
+            result = operation(registry, data)
             registry.session.commit()
         except Exception:
             registry.session.rollback()
             raise
-    return jsonify({"status": "ok", "run_accession": run_accession})
+    return result
 
 
-def api_register_sample_annotations(register_samples: bool):
-    data = api_request_data()
-    if not data.get("run_accession"):
-        return api_error("Missing required field: run_accession")
-    try:
-        run_accession = int(data["run_accession"])
-    except ValueError as exc:
-        return api_error(f"Invalid run_accession value: {exc}")
+def write_unavailable_error(exc: WriteUnavailable):
+    response, status = api_error(str(exc), 503)
+    response.headers["Retry-After"] = "1"
+    return response, status
+
+
+def submit_write(operation, data) -> dict:
+    if write_queue is not None:
+        return write_queue.submit(operation, data)
+    return apply_write(operation, data)
+
+
+def api_write(
+    operation,
+    data,
+    name: Optional[str] = None,
+    status: int = 200,
+    prepare=None,
+):
+    """Apply a write operation and answer with its result.
+
+    ``prepare(data)``, if given, runs first in the request thread, so slow
+    validation such as loading a sample table doesn't hold up the writer.
+    """
+    name = name or operation.__name__
+    idempotency = g.get("idempotency")
+    if idempotency is not None:
+        operation = _saving_idempotent_response(operation, idempotency["key"], status)
     try:
-        sample_table = api_sample_table_from_request()
-    except Exception as exc:
+        if prepare is not None:
+            data = prepare(data)
+        result = submit_write(operation, data)
+    except WriteUnavailable as exc:
+        metrics.count_write(name, "rejected")
+        return write_unavailable_error(exc)
+    except (ValueError, IOError) as exc:
+        # OperationError, and the registry's checks for runs and samples
+        # that don't exist, as in operations.run_batch
+        metrics.count_write(name, "error")
         return api_error(str(exc))
-    with api_registry() as registry:
+    except Exception:
+        metrics.count_write(name, "error")
+        raise
+    metrics.count_write(name, "ok")
+    if idempotency is not None:
+        idempotency["saved"] = True
+    response = jsonify(dict(result, status="ok"))
+    response.status_code = status
+    return response
+
+
+def api_request_data_with_file(name: str) -> dict:
+    data = api_request_data()
+    if name in request.files:
+        data = dict(data)
+        data[name] = request.files[name].stream.read().decode("utf-8")
+    return data
+
+
+def request_fingerprint() -> str:
+    """Hash the parts of the request that decide what a write does.
+
+    Form fields and file contents are hashed rather than the raw body,
+    which for multipart uploads has a boundary that changes on each retry.
+    """
+    files = {}
+    for name, f in request.files.items():
+        files[name] = hashlib.sha256(f.stream.read()).hexdigest()
+        f.stream.seek(0)
+    content = {
+        "method": request.method,
+        "path": request.path,
+        "args": request.args.to_dict(flat=False),
+        "json": request.get_json(silent=True),
+        "form": request.form.to_dict(flat=False),
+        "files": files,
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def _reserve_idempotency_key(registry: SampleRegistry, data) -> dict:
+    key, fingerprint = data
+    existing = registry.reserve_idempotency_key(key, fingerprint, IDEMPOTENCY_LEASE)
+    if existing is None:
+        return {}
+    return {
+        "fingerprint": existing.fingerprint,
+        "status_code": existing.status_code,
+        "response": existing.response,
+    }
+
+
+def _save_idempotent_response(registry: SampleRegistry, data) -> dict:
+    key, status_code, response = data
+    registry.save_idempotent_response(key, status_code, response, IDEMPOTENCY_TTL)
+    return {}
+
+
+def _release_idempotency_key(registry: SampleRegistry, key) -> dict:
+    registry.release_idempotency_key(key)
+    return {}
+
+
+def _saving_idempotent_response(operation, key: str, status: int):
+    """Wrap a write operation to store its response in the same transaction."""
+
+    def save(registry: SampleRegistry, data) -> dict:
+        result = operation(registry, data)
+        registry.save_idempotent_response(
+            key, status, app.json.dumps(dict(result, status="ok")), IDEMPOTENCY_TTL
+        )
+        return result
+
+    return save
+
+
+def _finish_idempotent_request(key: str, response: Optional[Response]):
+    """Store a response that didn't come from a write, or release the key.
+
+    A failure here is logged rather than raised: the request has been
+    handled, and the claim's lease lets a retry take the key over.
+    """
+    try:
+        if response is None or response.status_code >= 500:
+            submit_write(_release_idempotency_key, key)
+        else:
+            submit_write(
+                _save_idempotent_response,
+                (key, response.status_code, response.get_data(as_text=True)),
+            )
+    except Exception:
+        app.logger.exception("Could not finish request with Idempotency-Key %s", key)
+
+
+def idempotent(view):
+    """Replay the stored response when a write is retried with the same key.
+
+    A request with an ``Idempotency-Key`` header claims the key for
+    ``IDEMPOTENCY_LEASE`` before the write runs. ``api_write`` stores the
+    response in the write's own transaction, kept for ``IDEMPOTENCY_TTL``,
+    so a write is never committed without it. A retry with the key gets the
+    stored response back, found by primary key, without the write running
+    again. Server errors release the key so the request can be retried.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return api_error(
+                f"Idempotency-Key must be at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters"
+            )
+        fingerprint = request_fingerprint()
+
+        stored = db.session.get(IdempotencyKey, key)
+        if (
+            stored is not None
+            and stored.status_code is not None
+            and stored.expires_at >= datetime.now()
+        ):
+            stored = {
+                "fingerprint": stored.fingerprint,
+                "status_code": stored.status_code,
+                "response": stored.response,
+            }
+        else:
+            try:
+                stored = submit_write(_reserve_idempotency_key, (key, fingerprint))
+            except IntegrityError:
+                # Claimed by a concurrent request between our read and write
+                stored = {"fingerprint": fingerprint, "status_code": None}
+            except WriteUnavailable as exc:
+                return write_unavailable_error(exc)
+
+        if stored:
+            if stored["fingerprint"] != fingerprint:
+                return api_error(
+                    "Idempotency-Key was already used for a different request", 422
+                )
+            if stored["status_code"] is None:
+                return api_error(
+                    "A request with this Idempotency-Key is still in progress", 409
+                )
+            response = Response(
+                stored["response"],
+                status=stored["status_code"],
+                mimetype="application/json",
+            )
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+
+        g.idempotency = {"key": key, "saved": False}
         try:
-            if register_samples:
-                registry.check_samples(run_accession, exists=False)
-            registry.check_run_accession(run_accession)
-            if register_samples:
-                registry.register_samples(run_accession, sample_table)
-            registry.register_annotations(run_accession, sample_table)
-            registry.session.commit()
+            response = make_response(view(*args, **kwargs))
         except Exception:
-            registry.session.rollback()
+            _finish_idempotent_request(key, None)
             raise
-    return jsonify(
-        {
-            "status": "ok",
-            "run_accession": run_accession,
-            "sample_count": len(sample_table.recs),
-        }
-    )
+        if not g.idempotency["saved"]:
+            _finish_idempotent_request(key, response)
+        return response
+
+    return wrapper
+
+
+@app.post("/api/register_run")
+@idempotent
+def api_register_run():
+    return api_write(operations.register_run, api_request_data())
 
 
 @app.post("/api/register_samples")
+@idempotent
 def api_register_samples():
-    return api_register_sample_annotations(register_samples=True)
+    return api_write(
+        operations.register_samples,
+        api_request_data_with_file("sample_table"),
+        prepare=operations.prepare_sample_table,
+    )
 
 
 @app.post("/api/register_annotations")
+@idempotent
 def api_register_annotations():
-    return api_register_sample_annotations(register_samples=False)
+    return api_write(
+        operations.register_annotations,
+        api_request_data_with_file("sample_table"),
+        prepare=operations.prepare_sample_table,
+    )
 
 
 @app.post("/api/unregister_samples")
+@idempotent
 def api_unregister_samples():
-    data = api_request_data()
-    if not data.get("run_accession"):
-        return api_error("Missing required field: run_accession")
-    try:
-        run_accession = int(data["run_accession"])
-    except ValueError as exc:
-        return api_error(f"Invalid run_accession value: {exc}")
-    with api_registry() as registry:
-        try:
-            registry.check_run_accession(run_accession)
-            samples_removed = registry.remove_samples(run_accession)
-            registry.session.commit()
-        except Exception:
-            registry.session.rollback()
-            raise
-    return jsonify(
-        {
-            "status": "ok",
-            "run_accession": run_accession,
-            "removed_samples": samples_removed,
-        }
-    )
+    return api_write(operations.unregister_samples, api_request_data())
 
 
 @app.post("/api/modify_run")
+@idempotent
 def api_modify_run():
-    data = api_request_data()
-    if not data.get("run_accession"):
-        return api_error("Missing required field: run_accession")
-    try:
-        run_accession = int(data["run_accession"])
-    except ValueError as exc:
-        return api_error(f"Invalid run_accession value: {exc}")
-    lane = data.get("lane")
-    if lane is not None:
-        try:
-            lane = int(lane)
-        except ValueError as exc:
-            return api_error(f"Invalid lane value: {exc}")
-    with api_registry() as registry:
-        try:
-            registry.check_run_accession(run_accession)
-            registry.modify_run(
-                run_accession=run_accession,
-                run_date=data.get("date"),
-                machine_type=data.get("type"),
-                machine_kit=data.get("kit"),
-                lane=lane,
-                data_uri=data.get("data_uri"),
-                comment=data.get("comment"),
-                admin_comment=data.get("admin_comment"),
-            )
-            registry.session.commit()
-        except Exception:
-            registry.session.rollback()
-            raise
-    return jsonify({"status": "ok", "run_accession": run_accession})
+    return api_write(operations.modify_run, api_request_data())
 
 
 @app.post("/api/modify_sample")
+@idempotent
 def api_modify_sample():
-    data = api_request_data()
-    if not data.get("sample_accession"):
-        return api_error("Missing required field: sample_accession")
-    try:
-        sample_accession = int(data["sample_accession"])
-    except ValueError as exc:
-        return api_error(f"Invalid sample_accession value: {exc}")
-    with api_registry() as registry:
-        try:
-            registry.check_sample_accession(sample_accession)
-            registry.modify_sample(
-                sample_accession=sample_accession,
-                sample_name=data.get("sample_name"),
-                sample_type=data.get("sample_type"),
-                subject_id=data.get("subject_id"),
-                host_species=data.get("host_species"),
-                barcode_sequence=data.get("barcode_sequence"),
-                primer_sequence=data.get("primer_sequence"),
-            )
-            registry.session.commit()
-        except Exception:
-            registry.session.rollback()
-            raise
-    return jsonify({"status": "ok", "sample_accession": sample_accession})
+    return api_write(operations.modify_sample, api_request_data())
 
 
 @app.post("/api/modify_annotation")
+@idempotent
 def api_modify_annotation():
-    data = api_request_data()
-    missing = [k for k in ("sample_accession", "key", "val") if not data.get(k)]
-    if missing:
-        return api_error(f"Missing required fields: {', '.join(missing)}")
-    try:
-        sample_accession = int(data["sample_accession"])
-    except ValueError as exc:
-        return api_error(f"Invalid sample_accession value: {exc}")
-    with api_registry() as registry:
-        try:
-            registry.check_sample_accession(sample_accession)
-            registry.modify_annotation(
-                sample_accession=sample_accession,
-                key=data["key"],
-                val=data["val"],
-            )
-            registry.session.commit()
-        except Exception:
-            registry.session.rollback()
-            raise
-    return jsonify({"status": "ok", "sample_accession": sample_accession})
+    return api_write(operations.modify_annotation, api_request_data())
+
+
+@app.post("/api/patch_samples")
+@idempotent
+def api_patch_samples():
+    return api_write(
+        operations.patch_samples, api_request_data_with_file("patch_table")
+    )
+
+
+@app.post("/api/batch")
+@idempotent
+def api_batch():
+    data = request.get_json(silent=True)
+    batch = data.get("operations") if isinstance(data, dict) else None
+    if not batch or not isinstance(batch, list):
+        return api_error("Missing required field: operations")
+
+    return api_write(
+        lambda registry, ops: {"results": operations.run_batch(registry, ops)},
+        batch,
+        name="batch",
+        prepare=operations.prepare_batch,
+    )
+
+
+@app.post("/api/jobs")
+@idempotent
+def api_create_job():
+    data = api_request_data_with_file("sample_table")
+    fields = {k: v for k, v in data.items() if k != "op"}
+    response = api_write(
+        jobs.create_job, (data.get("op"), fields), name="create_job", status=202
+    )
+    if isinstance(response, tuple):
+        return response
+    job_worker.notify()
+    response.headers["Location"] = url_for(
+        "api_job", job_id=response.get_json()["job_id"]
+    )
+    return response
+
+
+@app.get("/api/jobs/<int:job_id>")
+def api_job(job_id: int):
+    job = db.session.get(RegistrationJob, job_id)
+    if job is None:
+        return api_error(f"Job {job_id} not found", 404)
+    if job.status == "queued":
+        # In case the process that queued it has gone
+        job_worker.notify()
+    return jsonify({"status": "ok", "job": jobs.job_to_dict(job)})
+
+
+@app.route("/metrics")
+def show_metrics():
+    body = metrics.render_metrics(db.session, [db.engine, write_engine])
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/admin/slow_queries")
+def show_slow_queries():
+    return render_template(
+        "slow_queries.html",
+        threshold_ms=slowlog.threshold_ms(),
+        queries=slowlog.read_slow_queries(slowlog.log_path()),
+    )
 
 
 @app.route("/description")
@@ -0,0 +1,293 @@
+"""Check that run data files are present and intact on the archive"""
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from pathlib import Path
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from sample_registry import ARCHIVE_ROOT
+from sample_registry.db import ensure_schema
+from sample_registry.models import Run
+from sample_registry.registrar import SampleRegistry
+
+# The archive is a network mount, so stat calls mostly wait on I/O
+DEFAULT_WORKERS = 16
+DEFAULT_MAX_AGE_HOURS = 24
+# Large sequential reads keep the network mount streaming
+HASH_BLOCK_BYTES = 8 * 1024 * 1024
+DEFAULT_ALGORITHM = "sha256"
+# Checksums are committed in batches of this many files
+CHECKSUM_COMMIT_EVERY = 50
+
+
+def stat_data_uri(archive_root: str | Path, data_uri: str) -> dict:
+    """Stat a run's data file, returning ``ArchiveStatus`` column values."""
+    try:
+        st = os.stat(Path(archive_root) / data_uri)
+    except FileNotFoundError:
+        return {"status": "missing", "size": None, "mtime": None}
+    except OSError:
+        return {"status": "error", "size": None, "mtime": None}
+    if st.st_size == 0:
+        return {"status": "empty", "size": 0, "mtime": st.st_mtime}
+    return {"status": "ok", "size": st.st_size, "mtime": st.st_mtime}
+
+
+def stat_runs(
+    runs: list[Run], archive_root: str | Path, workers: int = DEFAULT_WORKERS
+) -> list[dict]:
+    """Stat the data files for ``runs`` through a bounded thread pool."""
+    data_uris = [r.data_uri for r in runs]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        stats = executor.map(lambda uri: stat_data_uri(archive_root, uri), data_uris)
+        checked_at = datetime.now()
+        return [
+            dict(
+                s,
+                run_accession=r.run_accession,
+                data_uri=r.data_uri,
+                checked_at=checked_at,
+            )
+            for r, s in zip(runs, stats)
+        ]
+
+
+def verify_runs(
+    registry: SampleRegistry,
+    archive_root: str | Path = ARCHIVE_ROOT,
+    max_age: timedelta = timedelta(hours=DEFAULT_MAX_AGE_HOURS),
+    workers: int = DEFAULT_WORKERS,
+) -> list[dict]:
+    """Re-check runs whose archive status is stale and record the results."""
+    ensure_schema(registry.session.get_bind())
+    runs = registry.get_stale_archive_runs(datetime.now() - max_age)
+    statuses = stat_runs(runs, archive_root, workers)
+    registry.register_archive_status(statuses)
+    registry.session.commit()
+    return statuses
+
+
+def verify_archive(argv=None, session: Session = None, out=sys.stdout):
+    p = argparse.ArgumentParser(
+        description=(
+            "Check that run data files exist on the archive and record their "
+            "size and modification time"
+        )
+    )
+    p.add_argument(
+        "--archive-root",
+        default=str(ARCHIVE_ROOT),
+        help="Directory that run data URIs are relative to",
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of concurrent stat calls",
+    )
+    p.add_argument(
+        "--max-age",
+        type=float,
+        default=DEFAULT_MAX_AGE_HOURS,
+        help="Re-check runs last checked more than this many hours ago",
+    )
+    p.add_argument(
+        "--all", action="store_true", help="Re-check every run, ignoring --max-age"
+    )
+    p.add_argument(
+        "--watch",
+        type=float,
+        metavar="SECONDS",
+        help="Keep running, checking for stale runs every SECONDS",
+    )
+    args = p.parse_args(argv)
+
+    registry = SampleRegistry(session)
+    max_age = timedelta(0) if args.all else timedelta(hours=args.max_age)
+    while True:
+        statuses = verify_runs(registry, args.archive_root, max_age, args.workers)
+        problems = [s for s in statuses if s["status"] != "ok"]
+        for s in problems:
+            out.write(
+                "CMR{:06d}\t{}\t{}\n".format(
+                    s["run_accession"], s["status"], s["data_uri"]
+                )
+            )
+        out.write(
+            "Checked {0} runs, {1} with problems\n".format(len(statuses), len(problems))
+        )
+        out.flush()
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
+
+
+def hash_file(
+    fp: str | Path,
+    algorithm: str = DEFAULT_ALGORITHM,
+    block_bytes: int = HASH_BLOCK_BYTES,
+) -> str:
+    h = hashlib.new(algorithm)
+    buf = bytearray(block_bytes)
+    view = memoryview(buf)
+    with open(fp, "rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def checksum_runs(
+    registry: SampleRegistry,
+    archive_root: str | Path = ARCHIVE_ROOT,
+    workers: int | None = None,
+    verify: bool = False,
+    algorithm: str = DEFAULT_ALGORITHM,
+) -> list[dict]:
+    """Hash run data files that changed since the last pass.
+
+    Files are skipped when their data_uri, size and mtime match the stored
+    checksum. With ``verify``, unchanged files are hashed as well and
+    compared against the stored digest; a difference there means the
+    content changed without the file being rewritten. Mismatches are
+    reported but leave the stored digest in place.
+
+    Returns
+    -------
+    list[dict]
+        One entry per hashed file with the run accession, data_uri, digest
+        and a ``result`` of ``new``, ``changed``, ``verified``, ``mismatch``
+        or ``error``. Files that can't be read get an ``error`` message and
+        no digest, and the pass carries on without them.
+    """
+    ensure_schema(registry.session.get_bind())
+    runs = list(registry.session.scalars(select(Run).order_by(Run.run_accession)))
+    statuses = stat_runs(runs, archive_root)
+    registry.register_archive_status(statuses)
+    stored = registry.get_checksums()
+
+    todo = []
+    for s in statuses:
+        if s["status"] not in ("ok", "empty"):
+            continue
+        prev = stored.get(s["run_accession"])
+        if prev is None:
+            result = "new"
+        elif (prev.data_uri, prev.size, prev.mtime, prev.algorithm) != (
+            s["data_uri"],
+            s["size"],
+            s["mtime"],
+            algorithm,
+        ):
+            result = "changed"
+        elif verify:
+            result = "verified"
+        else:
+            continue
+        todo.append((s, result))
+
+    results = []
+    updates = []
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    hash_file, Path(archive_root) / s["data_uri"], algorithm
+                ): (
+                    s,
+                    result,
+                )
+                for s, result in todo
+            }
+            for future in as_completed(futures):
+                s, result = futures[future]
+                entry = {"run_accession": s["run_accession"], "data_uri": s["data_uri"]}
+                try:
+                    digest = future.result()
+                except OSError as exc:
+                    # Left without a checksum, so the next pass tries again
+                    results.append(
+                        dict(entry, digest=None, result="error", error=str(exc))
+                    )
+                    continue
+                if result == "verified" and digest != stored[s["run_accession"]].digest:
+                    result = "mismatch"
+                results.append(dict(entry, digest=digest, result=result))
+                if result != "mismatch":
+                    updates.append(
+                        dict(
+                            entry,
+                            algorithm=algorithm,
+                            digest=digest,
+                            size=s["size"],
+                            mtime=s["mtime"],
+                            computed_at=datetime.now(),
+                        )
+                    )
+                if len(updates) >= CHECKSUM_COMMIT_EVERY:
+                    # Saved as they come in, so an interrupted pass keeps its work
+                    registry.register_checksums(updates)
+                    registry.session.commit()
+                    updates = []
+    registry.register_checksums(updates)
+    registry.session.commit()
+    return sorted(results, key=lambda r: r["run_accession"])
+
+
+def checksum_archive(argv=None, session: Session = None, out=sys.stdout):
+    p = argparse.ArgumentParser(
+        description=(
+            "Record content checksums for run data files, hashing only files "
+            "that changed since the last pass"
+        )
+    )
+    p.add_argument(
+        "--archive-root",
+        default=str(ARCHIVE_ROOT),
+        help="Directory that run data URIs are relative to",
+    )
+    p.add_argument(
+        "--workers", type=int, help="Number of worker processes (default: CPU count)"
+    )
+    p.add_argument(
+        "--algorithm",
+        default=DEFAULT_ALGORITHM,
+        # SHAKE digests need an explicit length, so they're left out
+        choices=sorted(
+            a for a in hashlib.algorithms_guaranteed if not a.startswith("shake")
+        ),
+        help="Hash algorithm",
+    )
+    p.add_argument(
+        "--verify",
+        action="store_true",
+        help="Also re-hash unchanged files and compare against stored checksums",
+    )
+    args = p.parse_args(argv)
+
+    registry = SampleRegistry(session)
+    results = checksum_runs(
+        registry, args.archive_root, args.workers, args.verify, args.algorithm
+    )
+    for r in results:
+        out.write(
+            "CMR{:06d}\t{}\t{}\t{}\n".format(
+                r["run_accession"],
+                r["result"],
+                r["digest"] or r["error"],
+                r["data_uri"],
+            )
+        )
+    errors = sum(r["result"] == "error" for r in results)
+    mismatches = sum(r["result"] == "mismatch" for r in results)
+    out.write(
+        "Hashed {0} files, {1} checksum mismatches\n".format(
+            len(results) - errors, mismatches
+        )
+    )
+    if errors:
+        out.write(f"Could not read {errors} files\n")
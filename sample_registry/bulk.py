@@ -0,0 +1,79 @@
+"""Run bulk statements in chunks that fit the database's parameter limit
+
+Multi-row ``INSERT ... VALUES`` statements and ``IN (...)`` filters take one
+bound parameter per value, and databases cap how many a statement may
+have. These helpers split the values so each statement stays under the
+cap for the dialect in use.
+"""
+
+from typing import Iterable, Iterator
+from sqlalchemy import Delete, Select, insert
+from sqlalchemy.orm import Session
+from sample_registry.util import chunked
+
+# SQLite allows 999 parameters per statement before 3.32 and 32766 after.
+# Postgres and MySQL count parameters in 16 bits, but very long statements
+# are slow to plan, so stay well below that.
+DIALECT_MAX_PARAMS = {"postgresql": 10000, "mysql": 10000}
+DEFAULT_MAX_PARAMS = 999
+# Parameters kept free for the rest of the statement, e.g. other filters
+RESERVED_PARAMS = 20
+
+
+def max_params(session: Session) -> int:
+    """Return the most bound parameters to use in one statement."""
+    dialect = session.get_bind().dialect
+    if dialect.name == "sqlite":
+        version = getattr(dialect.dbapi, "sqlite_version_info", (0,))
+        return 32766 if version >= (3, 32, 0) else 999
+    return DIALECT_MAX_PARAMS.get(dialect.name, DEFAULT_MAX_PARAMS)
+
+
+def chunks(session: Session, values: Iterable, params_per_value: int = 1):
+    """Split ``values`` into lists that fit in one statement."""
+    size = (max_params(session) - RESERVED_PARAMS) // params_per_value
+    return chunked(values, max(1, size))
+
+
+def select_in(session: Session, stmt: Select, column, values: Iterable) -> Iterator:
+    """Yield the rows of ``stmt`` filtered to ``column IN values``.
+
+    Ordering applies within each chunk only.
+    """
+    for chunk in chunks(session, dict.fromkeys(values)):
+        yield from session.execute(stmt.where(column.in_(chunk)))
+
+
+def scalars_in(session: Session, stmt: Select, column, values: Iterable) -> Iterator:
+    """Like ``select_in``, yielding the first column of each row."""
+    for chunk in chunks(session, dict.fromkeys(values)):
+        yield from session.scalars(stmt.where(column.in_(chunk)))
+
+
+def delete_in(session: Session, stmt: Delete, column, values: Iterable):
+    """Execute ``stmt`` restricted to ``column IN values``."""
+    for chunk in chunks(session, dict.fromkeys(values)):
+        session.execute(stmt.where(column.in_(chunk)))
+
+
+def insert_rows(session: Session, model, rows: list[dict], returning=()) -> list:
+    """Insert ``rows`` in executemany batches that fit the parameter limit.
+
+    Each batch has at most ``(max_params - RESERVED_PARAMS) // columns``
+    rows, ``columns`` being the number of keys in the first row.
+
+    The statement is compiled once and SQLAlchemy renders each batch as
+    multi-row VALUES where the driver supports it. Returns the
+    ``returning`` columns of the inserted rows, in order.
+    """
+    if not rows:
+        return []
+    stmt = insert(model)
+    if returning:
+        stmt = stmt.returning(*returning, sort_by_parameter_order=True)
+    returned = []
+    for chunk in chunks(session, rows, len(rows[0])):
+        result = session.execute(stmt, chunk)
+        if returning:
+            returned += result.all()
+    return returned
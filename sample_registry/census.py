@@ -0,0 +1,230 @@
+"""Count index reads in a run's raw FASTQ against its registered barcodes"""
+
+import argparse
+import collections
+import gzip
+import itertools
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import BinaryIO, Iterable, Optional
+from sqlalchemy.orm import Session
+from sample_registry import ARCHIVE_ROOT
+from sample_registry.db import ensure_schema
+from sample_registry.registrar import SampleRegistry
+from sample_registry.util import illumina_index
+
+# Uncompressed files larger than this are split into ranges of this size
+CHUNK_BYTES = 256 * 1024 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+@dataclass
+class Census:
+    exact: dict[str, int] = field(default_factory=dict)
+    mismatch: dict[str, int] = field(default_factory=dict)
+    unmatched: int = 0
+
+    @property
+    def total(self) -> int:
+        return sum(self.exact.values()) + sum(self.mismatch.values()) + self.unmatched
+
+
+def is_gzipped(fp: str | Path) -> bool:
+    with open(fp, "rb") as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def open_fastq(fp: str | Path) -> BinaryIO:
+    if is_gzipped(fp):
+        return gzip.open(fp, "rb")
+    return open(fp, "rb")
+
+
+def _index_key(header: bytes) -> bytes:
+    return header.rstrip().rsplit(b":", 1)[-1]
+
+
+def count_index_stream(f: BinaryIO) -> collections.Counter:
+    """Count the raw index field of every read in a binary FASTQ stream."""
+    return collections.Counter(_index_key(h) for h in itertools.islice(f, 0, None, 4))
+
+
+def _sync_to_record(f: BinaryIO) -> int:
+    # A header line starts with "@" and is followed two lines later by the
+    # "+" separator. A quality line can also start with "@", but two lines
+    # after it comes a sequence line, which never starts with "+".
+    while True:
+        pos = f.tell()
+        line = f.readline()
+        if not line:
+            return pos
+        if line.startswith(b"@"):
+            after = f.tell()
+            f.readline()
+            if f.readline().startswith(b"+"):
+                f.seek(pos)
+                return pos
+            f.seek(after)
+
+
+def count_index_range(fp: str | Path, start: int, end: int) -> collections.Counter:
+    """Count index fields of reads whose header starts in ``[start, end)``.
+
+    Only valid for uncompressed FASTQ files, where byte offsets can be
+    seeked directly.
+    """
+    counts = collections.Counter()
+    with open(fp, "rb") as f:
+        # Step back one byte so a header starting exactly at ``start`` isn't
+        # discarded along with the partial line
+        if start:
+            f.seek(start - 1)
+            f.readline()
+        pos = _sync_to_record(f)
+        while pos < end:
+            header = f.readline()
+            if not header:
+                break
+            rest = len(f.readline()) + len(f.readline()) + len(f.readline())
+            pos += len(header) + rest
+            counts[_index_key(header)] += 1
+    return counts
+
+
+def count_indexes(
+    fp: str | Path, workers: Optional[int] = None, chunk_bytes: int = CHUNK_BYTES
+) -> collections.Counter:
+    """Count raw index fields for every read in ``fp``.
+
+    Uncompressed files larger than ``chunk_bytes`` are split into byte
+    ranges that are counted in a process pool. A gzip stream cannot be
+    entered at an arbitrary offset, so gzipped files are read in a single
+    pass that only touches the header lines.
+    """
+    if is_gzipped(fp):
+        with gzip.open(fp, "rb") as f:
+            return count_index_stream(f)
+
+    size = os.path.getsize(fp)
+    if size <= chunk_bytes or workers == 1:
+        return count_index_range(fp, 0, size)
+
+    starts = range(0, size, chunk_bytes)
+    ends = [min(s + chunk_bytes, size) for s in starts]
+    counts = collections.Counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for c in executor.map(count_index_range, itertools.repeat(fp), starts, ends):
+            counts.update(c)
+    return counts
+
+
+def barcode_neighbors(barcodes: Iterable[str]) -> dict[str, str]:
+    """Map each sequence one mismatch away from a barcode to that barcode.
+
+    Sequences within one mismatch of more than one barcode, or identical to
+    a barcode, are left out because they cannot be assigned unambiguously.
+    """
+    barcodes = set(barcodes)
+    neighbors = {}
+    ambiguous = set()
+    for barcode in barcodes:
+        for i, base in enumerate(barcode):
+            if base == "-":
+                continue
+            for sub in "ACGTN":
+                if sub == base:
+                    continue
+                variant = barcode[:i] + sub + barcode[i + 1 :]
+                if variant in neighbors and neighbors[variant] != barcode:
+                    ambiguous.add(variant)
+                neighbors[variant] = barcode
+    return {
+        k: v for k, v in neighbors.items() if k not in ambiguous and k not in barcodes
+    }
+
+
+def assign_indexes(
+    index_counts: collections.Counter, barcodes: Iterable[str]
+) -> Census:
+    """Assign counted index sequences to registered barcodes."""
+    barcodes = {b.upper() for b in barcodes if b}
+    neighbors = barcode_neighbors(barcodes)
+    census = Census(exact={b: 0 for b in barcodes}, mismatch={b: 0 for b in barcodes})
+    for raw, n in index_counts.items():
+        index = illumina_index(raw.decode("ascii", errors="replace")).upper()
+        if index in barcodes:
+            census.exact[index] += n
+        elif index in neighbors:
+            census.mismatch[neighbors[index]] += n
+        else:
+            census.unmatched += n
+    return census
+
+
+def census_fastq(
+    fp: str | Path,
+    barcodes: Iterable[str],
+    workers: Optional[int] = None,
+    chunk_bytes: int = CHUNK_BYTES,
+) -> Census:
+    return assign_indexes(count_indexes(fp, workers, chunk_bytes), barcodes)
+
+
+def census_run(argv=None, session: Session = None, out=sys.stdout):
+    p = argparse.ArgumentParser(
+        description=(
+            "Count reads for each registered sample in a run's raw FASTQ file "
+            "and store the counts in the registry"
+        )
+    )
+    p.add_argument("run_accession", type=int, help="Run accession number")
+    p.add_argument(
+        "--workers", type=int, help="Number of worker processes (default: CPU count)"
+    )
+    p.add_argument(
+        "--archive-root",
+        default=str(ARCHIVE_ROOT),
+        help="Directory that run data URIs are relative to",
+    )
+    args = p.parse_args(argv)
+
+    registry = SampleRegistry(session)
+    run = registry.check_run_accession(args.run_accession)
+    samples = registry.check_samples(args.run_accession)
+
+    census = census_fastq(
+        Path(args.archive_root) / run.data_uri,
+        [s.barcode_sequence for s in samples],
+        workers=args.workers,
+    )
+
+    # Samples sharing a barcode in the same run can't be told apart, so
+    # each of them is credited with the barcode's reads
+    counts = {}
+    for s in samples:
+        barcode = (s.barcode_sequence or "").upper()
+        counts[s.sample_accession] = (
+            census.exact.get(barcode, 0),
+            census.mismatch.get(barcode, 0),
+        )
+
+    ensure_schema(registry.session.get_bind())
+    registry.register_read_counts(counts)
+    registry.session.commit()
+
+    for s in samples:
+        exact, mismatch = counts[s.sample_accession]
+        out.write(
+            "CMS{:06d}\t{}\t{}\t{}\t{}\n".format(
+                s.sample_accession, s.sample_name, s.barcode_sequence, exact, mismatch
+            )
+        )
+    out.write(
+        "Counted {0} reads, {1} not assigned to a sample\n".format(
+            census.total, census.unmatched
+        )
+    )
@@ -1,14 +1,18 @@
 import sys
 from typing import Optional
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import exists, select
+from sqlalchemy.orm import aliased, sessionmaker
 from sample_registry import NULL_VALUES
+from sqlalchemy.engine import Connection, Engine
 from sample_registry.models import (
     Base,
     Run,
+    RunPath,
     Sample,
     Annotation,
 )
+from sample_registry.util import split_data_uri
 
 STANDARD_TAGS: dict[str, str] = {
     "SampleType": "sample_type",
@@ -17,6 +21,85 @@ STANDARD_TAGS: dict[str, str] = {
 }
 
 
+def ensure_schema(bind: Engine | Connection):
+    """Create any tables and indexes that are missing from an existing database.
+
+    Tables and indexes added to the models after a database was first
+    created are not picked up by anything else, so commands that rely on
+    them call this first. Existing tables are left untouched.
+    """
+    Base.metadata.create_all(bind)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind, checkfirst=True)
+
+
+def sample_filters(
+    run_accessions: Optional[list[int]] = None,
+    tag: Optional[str] = None,
+    val: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+) -> list:
+    """Build ``WHERE`` clauses on ``Sample`` for the common sample filters.
+
+    ``tag`` may be a standard tag like ``SampleType`` or any annotation key;
+    without ``val`` it matches samples that have the tag at all. Dates are
+    compared against ``Run.run_date`` (YYYY-MM-DD) and are inclusive.
+    """
+    clauses = []
+    if run_accessions is not None:
+        clauses.append(Sample.run_accession.in_(run_accessions))
+    if tag in STANDARD_TAGS:
+        column = getattr(Sample, STANDARD_TAGS[tag])
+        clauses.append(column.is_not(None) if val is None else column == val)
+    elif tag:
+        # Aliased so the filter also works in queries that select annotations
+        tagged = aliased(Annotation)
+        annotation = (tagged.sample_accession == Sample.sample_accession) & (
+            tagged.key == tag
+        )
+        if val is not None:
+            annotation &= tagged.val == val
+        clauses.append(exists().where(annotation))
+    if start_date or end_date:
+        runs = select(Run.run_accession)
+        if start_date:
+            runs = runs.where(Run.run_date >= start_date)
+        if end_date:
+            runs = runs.where(Run.run_date <= end_date)
+        clauses.append(Sample.run_accession.in_(runs))
+    return clauses
+
+
+def run_to_dict(run: Run) -> dict:
+    return {
+        "run_accession": "CMR{:06d}".format(run.run_accession),
+        "run_date": run.run_date,
+        "machine_type": run.machine_type,
+        "machine_kit": run.machine_kit,
+        "lane": run.lane,
+        "data_uri": run.data_uri,
+        "comment": run.comment,
+    }
+
+
+def sample_to_dict(
+    sample: Sample, annotations: Optional[list[Annotation]] = None
+) -> dict:
+    return {
+        "sample_accession": "CMS{:06d}".format(sample.sample_accession),
+        "sample_name": sample.sample_name,
+        "run_accession": "CMR{:06d}".format(sample.run_accession),
+        "barcode_sequence": sample.barcode_sequence,
+        "primer_sequence": sample.primer_sequence,
+        "sample_type": sample.sample_type,
+        "subject_id": sample.subject_id,
+        "host_species": sample.host_species,
+        "annotations": {a.key: a.val for a in annotations or []},
+    }
+
+
 def create_test_db(session: Optional[sessionmaker] = None):
     if not session:
         from sample_registry import engine
@@ -59,6 +142,12 @@ def create_test_db(session: Optional[sessionmaker] = None):
         comment="Test run 3 (NO SAMPLES)",
     )
     session.bulk_save_objects([run1, run2, run3])
+    session.bulk_save_objects(
+        [
+            RunPath(run_accession=r.run_accession, **split_data_uri(r.data_uri))
+            for r in [run1, run2, run3]
+        ]
+    )
 
     sample1 = Sample(
         sample_accession=1,
@@ -185,7 +274,8 @@ def run_to_dataframe(db: SQLAlchemy, run_acc: str) -> dict[str, str]:
     )
     annotations = (
         db.session.query(Annotation)
-        .filter(Annotation.sample_accession.in_([s.sample_accession for s in samples]))
+        .join(Sample, Annotation.sample_accession == Sample.sample_accession)
+        .filter(Sample.run_accession == run.run_accession)
         .all()
     )
 
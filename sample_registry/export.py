@@ -0,0 +1,287 @@
+"""Export sample tables from the registry"""
+
+import argparse
+import csv
+import gzip
+import io
+import itertools
+import json
+import sys
+from typing import Iterator
+from sqlalchemy import Row, func, select
+from sqlalchemy.orm import Session
+from sample_registry import NULL_VALUES
+from sample_registry.db import sample_filters, sample_to_dict
+from sample_registry.models import Annotation, Sample
+from sample_registry.registrar import SampleRegistry
+from sample_registry.util import accession_number
+
+# Column names match the per-run downloads from the web app
+STANDARD_COLUMNS = [
+    ("SampleID", Sample.sample_name),
+    ("Barcode", Sample.barcode_sequence),
+    ("Primer", Sample.primer_sequence),
+    ("SampleType", Sample.sample_type),
+    ("SubjectID", Sample.subject_id),
+    ("HostSpecies", Sample.host_species),
+]
+# Standard fields written by export_samples, as named by sample_to_dict
+SAMPLE_FIELDS = [
+    "sample_accession",
+    "sample_name",
+    "run_accession",
+    "barcode_sequence",
+    "primer_sequence",
+    "sample_type",
+    "subject_id",
+    "host_species",
+]
+EXPORT_FORMATS = ["tsv", "jsonl"]
+# Rows fetched from the database per round trip while streaming
+EXPORT_BATCH_SIZE = 1000
+PROGRESS_INTERVAL = 10000
+
+
+def annotation_keys(session: Session, **filters) -> list[str]:
+    """Return the annotation keys used by the samples matching ``filters``.
+
+    Keys are found in one aggregate query and ordered by the first sample
+    that has them, which keeps the columns of a single run in the order
+    they were registered.
+    """
+    return list(
+        session.scalars(
+            select(Annotation.key)
+            .join(Sample, Sample.sample_accession == Annotation.sample_accession)
+            .where(*sample_filters(**filters))
+            .group_by(Annotation.key)
+            .order_by(func.min(Annotation.sample_accession), Annotation.key)
+        )
+    )
+
+
+def iter_samples(session: Session, **filters) -> Iterator[tuple[Row, list[Row]]]:
+    """Yield each sample matching ``filters`` with its annotations, run by run.
+
+    Samples and annotations come back from a single joined query that is
+    read in batches through a server-side cursor where the database has
+    one, so memory use doesn't depend on the number of samples.
+    """
+    stmt = (
+        select(
+            Sample.sample_accession,
+            Sample.sample_name,
+            Sample.run_accession,
+            Sample.barcode_sequence,
+            Sample.primer_sequence,
+            Sample.sample_type,
+            Sample.subject_id,
+            Sample.host_species,
+            Annotation.key,
+            Annotation.val,
+        )
+        .outerjoin(Annotation, Annotation.sample_accession == Sample.sample_accession)
+        .where(*sample_filters(**filters))
+        .order_by(Sample.run_accession, Sample.sample_accession)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    for _, rows in itertools.groupby(
+        session.execute(stmt), key=lambda r: r.sample_accession
+    ):
+        rows = list(rows)
+        yield rows[0], [r for r in rows if r.key is not None]
+
+
+def mapping_columns(session: Session, **filters) -> list[str]:
+    """Return the merged column names for the samples matching ``filters``."""
+    names = [name for name, _ in STANDARD_COLUMNS]
+    names += [k for k in annotation_keys(session, **filters) if k not in names]
+    return names + ["sample_accession", "run_accession"]
+
+
+def iter_mapping_rows(
+    session: Session, columns: list[str], **filters
+) -> Iterator[list[str]]:
+    """Yield one mapping table row per sample matching ``filters``."""
+    n_annotations = len(columns) - len(STANDARD_COLUMNS) - 2
+    index = {c: i for i, c in enumerate(columns)}
+    for sample, annotations in iter_samples(session, **filters):
+        row = [getattr(sample, c.key) for _, c in STANDARD_COLUMNS]
+        row += ["NA"] * n_annotations
+        for a in annotations:
+            if a.key in index:
+                row[index[a.key]] = a.val
+        row.append("CMS{:06d}".format(sample.sample_accession))
+        row.append("CMR{:06d}".format(sample.run_accession))
+        yield ["NA" if v in NULL_VALUES else v for v in row]
+
+
+def iter_mapping_tsv(session: Session, **filters) -> Iterator[str]:
+    """Yield a merged mapping table as chunks of TSV text."""
+    columns = mapping_columns(session, **filters)
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter="\t", lineterminator="\n")
+    writer.writerow(columns)
+    for i, row in enumerate(iter_mapping_rows(session, columns, **filters), 1):
+        writer.writerow(row)
+        if i % EXPORT_BATCH_SIZE == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def export_mapping(argv=None, session: Session = None, out=sys.stdout):
+    p = argparse.ArgumentParser(
+        description=(
+            "Write one mapping table covering several runs, with the union "
+            "of their annotation columns"
+        )
+    )
+    p.add_argument(
+        "run_accessions",
+        nargs="*",
+        help="Run accessions, as numbers or like CMR000012",
+    )
+    p.add_argument("--tag", help="Only include samples with this tag")
+    p.add_argument("--val", help="Only include samples where --tag has this value")
+    args = p.parse_args(argv)
+    if not args.run_accessions and not args.tag:
+        p.error("Give at least one run accession or --tag")
+    if args.val is not None and not args.tag:
+        p.error("--val requires --tag")
+    try:
+        runs = [accession_number(r, "run") for r in args.run_accessions]
+    except ValueError as exc:
+        p.error(str(exc))
+
+    registry = SampleRegistry(session)
+    for chunk in iter_mapping_tsv(
+        registry.session, run_accessions=runs or None, tag=args.tag, val=args.val
+    ):
+        out.write(chunk)
+
+
+def count_samples(session: Session, **filters) -> int:
+    return session.scalar(
+        select(func.count(Sample.sample_accession)).where(*sample_filters(**filters))
+    )
+
+
+def write_samples(
+    session: Session, out, fmt: str = "tsv", progress=None, **filters
+) -> int:
+    """Write the samples matching ``filters`` with their annotations.
+
+    TSV output has one column per standard field and per annotation key
+    used by the exported samples, with "NA" for missing values. JSON Lines
+    output has one ``sample_to_dict`` record per line.
+
+    Parameters
+    ----------
+    out:
+        Text stream to write to.
+    fmt:
+        ``"tsv"`` or ``"jsonl"``.
+    progress:
+        Called with the number of samples written every
+        ``PROGRESS_INTERVAL`` samples.
+
+    Returns
+    -------
+    int
+        Number of samples written.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: %s" % fmt)
+    if fmt == "tsv":
+        keys = annotation_keys(session, **filters)
+        writer = csv.writer(out, delimiter="\t", lineterminator="\n")
+        writer.writerow(SAMPLE_FIELDS + keys)
+
+    n = 0
+    for sample, annotations in iter_samples(session, **filters):
+        record = sample_to_dict(sample, annotations)
+        if fmt == "jsonl":
+            out.write(json.dumps(record) + "\n")
+        else:
+            row = [record[f] for f in SAMPLE_FIELDS]
+            row += [record["annotations"].get(k) for k in keys]
+            writer.writerow(["NA" if v in NULL_VALUES else v for v in row])
+        n += 1
+        if progress and n % PROGRESS_INTERVAL == 0:
+            progress(n)
+    return n
+
+
+def export_samples(argv=None, session: Session = None, out=sys.stdout):
+    p = argparse.ArgumentParser(
+        description=(
+            "Export samples with their annotations, for the whole registry "
+            "or the samples matching the given filters"
+        )
+    )
+    p.add_argument(
+        "--run",
+        action="append",
+        dest="run_accessions",
+        help="Only export samples from this run (can be repeated)",
+    )
+    p.add_argument("--tag", help="Only export samples with this tag")
+    p.add_argument("--val", help="Only export samples where --tag has this value")
+    p.add_argument("--start-date", help="Only export runs on or after this date")
+    p.add_argument("--end-date", help="Only export runs on or before this date")
+    p.add_argument(
+        "--format",
+        choices=EXPORT_FORMATS,
+        help="Output format (default: jsonl for .jsonl files, otherwise tsv)",
+    )
+    p.add_argument("--output", "-o", help="Output file (default: standard output)")
+    p.add_argument(
+        "--gzip",
+        action="store_true",
+        help="Compress the output (default for output files ending in .gz)",
+    )
+    p.add_argument("--quiet", "-q", action="store_true", help="Don't report progress")
+    args = p.parse_args(argv)
+    if args.val is not None and not args.tag:
+        p.error("--val requires --tag")
+    try:
+        runs = [accession_number(r, "run") for r in args.run_accessions or []]
+    except ValueError as exc:
+        p.error(str(exc))
+
+    output = args.output or ""
+    compress = args.gzip or output.endswith(".gz")
+    fmt = args.format
+    if fmt is None:
+        fmt = "jsonl" if output.removesuffix(".gz").endswith(".jsonl") else "tsv"
+    filters = {
+        "run_accessions": runs or None,
+        "tag": args.tag,
+        "val": args.val,
+        "start_date": args.start_date,
+        "end_date": args.end_date,
+    }
+
+    registry = SampleRegistry(session)
+    total = count_samples(registry.session, **filters)
+
+    def progress(n):
+        if not args.quiet:
+            sys.stderr.write("Exported {0} of {1} samples\n".format(n, total))
+
+    if output and compress:
+        f = gzip.open(output, "wt", encoding="utf-8", newline="")
+    elif output:
+        f = open(output, "w", encoding="utf-8", newline="")
+    elif compress:
+        f = gzip.open(getattr(out, "buffer", out), "wt", encoding="utf-8", newline="")
+    else:
+        f = out
+    try:
+        n = write_samples(registry.session, f, fmt, progress, **filters)
+    finally:
+        if f is not out:
+            f.close()
+    progress(n)
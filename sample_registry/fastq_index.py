@@ -0,0 +1,323 @@
+"""Sidecar offset indexes for random access to reads in archived FASTQ files
+
+An index records where each read starts, grouped by the index sequence in
+the read header, so that the reads for one barcode can be pulled out of a
+run's FASTQ without scanning the whole file.
+
+Uncompressed files are indexed by byte offset and read through ``mmap``.
+Gzipped files are indexed at the level of gzip members: each read is
+located by the member it starts in and its offset in the decompressed
+stream from the start of that member. Files written as many members (for
+example with ``bgzip``) can then be entered close to every read. A file
+written as a single member has only one entry point, so reading from it
+still stops after the last requested read but must decompress everything
+before it.
+"""
+
+import argparse
+import collections
+import gzip
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, Optional
+from sqlalchemy.orm import Session
+from sample_registry import ARCHIVE_ROOT
+from sample_registry.census import barcode_neighbors, is_gzipped
+from sample_registry.registrar import SampleRegistry
+from sample_registry.util import illumina_index, parse_fastq
+
+INDEX_SUFFIX = ".sridx"
+INDEX_MAGIC = b"SRFQIDX1\n"
+READ_SIZE = 1024 * 1024
+
+
+def index_path(fp: str | Path, index_dir: Optional[str | Path] = None) -> Path:
+    fp = Path(fp)
+    if index_dir is None:
+        return fp.with_name(fp.name + INDEX_SUFFIX)
+    return Path(index_dir) / (fp.name + INDEX_SUFFIX)
+
+
+class _GzipMemberReader(io.RawIOBase):
+    """Decompress a gzip file, recording where each member starts.
+
+    ``members`` holds ``(compressed_offset, uncompressed_offset)`` pairs for
+    every member seen so far.
+    """
+
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.members: list[tuple[int, int]] = []
+        self._d = None
+        self._read = 0
+        self._uoffset = 0
+        self._out = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def _fill(self) -> bytes:
+        chunk = self.f.read(READ_SIZE)
+        self._read += len(chunk)
+        return chunk
+
+    def readinto(self, b) -> int:
+        while not self._out:
+            if self._d is None or self._d.eof:
+                leftover = self._d.unused_data if self._d is not None else b""
+                if not leftover:
+                    leftover = self._fill()
+                # Trailing zero padding after the last member is allowed
+                if not leftover.strip(b"\x00"):
+                    return 0
+                self.members.append((self._read - len(leftover), self._uoffset))
+                self._d = zlib.decompressobj(wbits=31)
+                self._out = memoryview(self._d.decompress(leftover))
+            else:
+                chunk = self._fill()
+                if not chunk:
+                    raise EOFError(
+                        "Compressed file ended before the end-of-stream marker was reached"
+                    )
+                self._out = memoryview(self._d.decompress(chunk))
+        n = min(len(b), len(self._out))
+        b[:n] = self._out[:n]
+        self._out = self._out[n:]
+        self._uoffset += n
+        return n
+
+
+def build_index(fp: str | Path, index_dir: Optional[str | Path] = None) -> "FastqIndex":
+    """Scan ``fp`` once and write its sidecar index."""
+    fp = Path(fp)
+    gzipped = is_gzipped(fp)
+    groups: dict[str, array] = collections.defaultdict(lambda: array("Q"))
+
+    with open(fp, "rb") as raw:
+        if gzipped:
+            members = _GzipMemberReader(raw)
+            f = io.BufferedReader(members, buffer_size=READ_SIZE)
+            blocks = members.members
+        else:
+            f = raw
+            blocks = [(0, 0)]
+
+        pos = 0
+        block = 0
+        lines = iter(f)
+        for record, header in enumerate(lines, 1):
+            try:
+                rest = len(next(lines)) + len(next(lines)) + len(next(lines))
+            except StopIteration:
+                raise ValueError(
+                    f"{fp}: FASTQ record {record} is truncated, "
+                    "expected 4 lines per record"
+                ) from None
+            while block + 1 < len(blocks) and blocks[block + 1][1] <= pos:
+                block += 1
+            offsets = groups[illumina_index(header.decode("ascii", errors="replace"))]
+            offsets.append(block)
+            offsets.append(pos - blocks[block][1])
+            pos += len(header) + rest
+        blocks = list(blocks)
+
+    stat = fp.stat()
+    barcodes = {}
+    array_offset = 0
+    for barcode, offsets in groups.items():
+        barcodes[barcode] = [array_offset, len(offsets) // 2]
+        array_offset += len(offsets) * offsets.itemsize
+    header = {
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "gzip": gzipped,
+        "blocks": [b[0] for b in blocks],
+        "barcodes": barcodes,
+    }
+
+    ifp = index_path(fp, index_dir)
+    tmp = ifp.with_name(ifp.name + ".tmp")
+    with open(tmp, "wb") as out:
+        encoded = json.dumps(header).encode("utf-8")
+        out.write(INDEX_MAGIC)
+        out.write(struct.pack("<Q", len(encoded)))
+        out.write(encoded)
+        for offsets in groups.values():
+            if sys.byteorder != "little":
+                offsets.byteswap()
+            offsets.tofile(out)
+    os.replace(tmp, ifp)
+    return FastqIndex.load(fp, index_dir)
+
+
+class FastqIndex:
+    def __init__(self, fp: Path, index_fp: Path, header: dict, data_offset: int):
+        self.fp = fp
+        self.index_fp = index_fp
+        self.gzip = header["gzip"]
+        self.blocks = header["blocks"]
+        self._barcodes = header["barcodes"]
+        self._data_offset = data_offset
+
+    @classmethod
+    def load(
+        cls, fp: str | Path, index_dir: Optional[str | Path] = None
+    ) -> "FastqIndex":
+        fp = Path(fp)
+        ifp = index_path(fp, index_dir)
+        with open(ifp, "rb") as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError("Not a FASTQ index file: %s" % ifp)
+            (n,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(n))
+        stat = fp.stat()
+        if (stat.st_size, stat.st_mtime_ns) != (
+            header["source_size"],
+            header["source_mtime_ns"],
+        ):
+            raise ValueError("FASTQ file changed since it was indexed: %s" % fp)
+        return cls(fp, ifp, header, len(INDEX_MAGIC) + 8 + n)
+
+    def barcodes(self) -> dict[str, int]:
+        """Return the number of reads for each index sequence in the file."""
+        return {k: v[1] for k, v in self._barcodes.items()}
+
+    def offsets(self, barcode: str) -> list[tuple[int, int]]:
+        """Return ``(block, offset)`` pairs for the reads with ``barcode``."""
+        if barcode not in self._barcodes:
+            return []
+        start, count = self._barcodes[barcode]
+        offsets = array("Q")
+        with open(self.index_fp, "rb") as f:
+            f.seek(self._data_offset + start)
+            offsets.fromfile(f, count * 2)
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        return list(zip(offsets[::2], offsets[1::2]))
+
+    def read(self, barcodes: Iterable[str]) -> Iterator[tuple[str, str, str]]:
+        """Yield ``(desc, seq, qual)`` for every read with one of ``barcodes``.
+
+        Reads come out in file order.
+        """
+        positions = sorted(p for b in set(barcodes) for p in self.offsets(b))
+        if not positions:
+            return
+        if self.gzip:
+            yield from self._read_gzip(positions)
+        else:
+            yield from self._read_mmap(positions)
+
+    def _read_mmap(self, positions):
+        with open(self.fp, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for _, start in positions:
+                    end = start
+                    for _ in range(4):
+                        end = mm.find(b"\n", end) + 1 or len(mm)
+                    lines = mm[start:end].decode("ascii").splitlines()
+                    yield next(parse_fastq(lines))
+
+    def _read_gzip(self, positions):
+        with open(self.fp, "rb") as f:
+            current = None
+            g = None
+            for block, offset in positions:
+                if block != current:
+                    f.seek(self.blocks[block])
+                    g = gzip.GzipFile(fileobj=f, mode="rb")
+                    current = block
+                g.seek(offset)
+                lines = [g.readline().decode("ascii") for _ in range(4)]
+                yield next(parse_fastq(lines))
+
+
+def read_sample_fastq(
+    registry: SampleRegistry,
+    sample_accession: int,
+    archive_root: str | Path = ARCHIVE_ROOT,
+    index_dir: Optional[str | Path] = None,
+    mismatches: bool = False,
+) -> Iterator[tuple[str, str, str]]:
+    """Yield the reads for one registered sample from its run's FASTQ.
+
+    With ``mismatches``, reads whose index is one mismatch away from the
+    sample's barcode (and not closer to another barcode in the run) are
+    included as well.
+    """
+    sample = registry.check_sample_accession(sample_accession)
+    run = registry.check_run_accession(sample.run_accession)
+    index = FastqIndex.load(Path(archive_root) / run.data_uri, index_dir)
+
+    barcode = sample.barcode_sequence.upper()
+    barcodes = {barcode}
+    if mismatches:
+        neighbors = barcode_neighbors(
+            s.barcode_sequence.upper()
+            for s in registry.get_samples(sample.run_accession)
+        )
+        barcodes.update(k for k, v in neighbors.items() if v == barcode)
+    return index.read(barcodes)
+
+
+def index_run_fastq(argv=None, session: Session = None, out=sys.stdout):
+    p = argparse.ArgumentParser(
+        description="Build a sidecar read offset index for a run's FASTQ file"
+    )
+    p.add_argument("run_accession", type=int, help="Run accession number")
+    p.add_argument(
+        "--archive-root",
+        default=str(ARCHIVE_ROOT),
+        help="Directory that run data URIs are relative to",
+    )
+    p.add_argument(
+        "--index-dir", help="Directory for the index (default: next to the FASTQ)"
+    )
+    args = p.parse_args(argv)
+
+    registry = SampleRegistry(session)
+    run = registry.check_run_accession(args.run_accession)
+    index = build_index(Path(args.archive_root) / run.data_uri, args.index_dir)
+    out.write(
+        "Indexed {0} reads with {1} index sequences in {2}\n".format(
+            sum(index.barcodes().values()), len(index.barcodes()), index.index_fp
+        )
+    )
+
+
+def extract_sample_fastq(argv=None, session: Session = None, out=sys.stdout):
+    p = argparse.ArgumentParser(
+        description="Write the reads for one sample using its run's FASTQ index"
+    )
+    p.add_argument("sample_accession", type=int, help="Sample accession number")
+    p.add_argument(
+        "--archive-root",
+        default=str(ARCHIVE_ROOT),
+        help="Directory that run data URIs are relative to",
+    )
+    p.add_argument(
+        "--index-dir", help="Directory for the index (default: next to the FASTQ)"
+    )
+    p.add_argument(
+        "--mismatches",
+        action="store_true",
+        help="Include reads with one mismatch in the index sequence",
+    )
+    args = p.parse_args(argv)
+
+    registry = SampleRegistry(session)
+    for desc, seq, qual in read_sample_fastq(
+        registry,
+        args.sample_accession,
+        args.archive_root,
+        args.index_dir,
+        args.mismatches,
+    ):
+        out.write("@{0}\n{1}\n+\n{2}\n".format(desc, seq, qual))
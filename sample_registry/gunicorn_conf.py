@@ -0,0 +1,57 @@
+"""Gunicorn settings for serving the registry in production
+
+Each setting can be overridden with the environment variable named next
+to it. Run with::
+
+    gunicorn -c python:sample_registry.gunicorn_conf sample_registry.wsgi:app
+"""
+
+import multiprocessing
+import os
+import tempfile
+from sqlalchemy.engine import make_url
+from sample_registry import SQLALCHEMY_DATABASE_URI
+from sample_registry import metrics
+from sample_registry.metrics import METRICS_DIR_ENV
+
+SQLITE = make_url(SQLALCHEMY_DATABASE_URI).get_backend_name() == "sqlite"
+
+bind = os.environ.get("SAMPLE_REGISTRY_BIND", "0.0.0.0:80")
+# Pages spend most of their time in Python, so one process per core. SQLite
+# takes one writer at a time and each process has its own write queue (see
+# sample_registry.writequeue), so with SQLite a single process serves every
+# request on its threads, keeping all writes on one writer thread.
+workers = int(
+    os.environ.get(
+        "SAMPLE_REGISTRY_WORKERS", 1 if SQLITE else multiprocessing.cpu_count()
+    )
+)
+# Threads let a worker keep serving while another request waits on the database
+threads = int(os.environ.get("SAMPLE_REGISTRY_THREADS", 4))
+# Large downloads and registrations can legitimately take a while
+timeout = int(os.environ.get("SAMPLE_REGISTRY_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+# Import the app once in the parent; sample_registry.wsgi resets the
+# connection pools in each worker after the fork
+preload_app = True
+accesslog = "-"
+
+# Workers share metrics through snapshot files, see sample_registry.metrics
+if not os.environ.get(METRICS_DIR_ENV):
+    os.environ[METRICS_DIR_ENV] = tempfile.mkdtemp(prefix="sample_registry_metrics_")
+
+
+def on_starting(server):
+    metrics.clear_snapshots()
+    if SQLITE and server.cfg.workers > 1:
+        server.log.warning(
+            "Running %d worker processes with SQLite: each has its own write "
+            "queue, so writes from different workers still contend for the "
+            "database lock",
+            server.cfg.workers,
+        )
+
+
+def child_exit(server, worker):
+    metrics.retire_snapshot(worker.pid)
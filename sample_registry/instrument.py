@@ -0,0 +1,190 @@
+"""Per-request timing for the web app
+
+When ``SAMPLE_REGISTRY_INSTRUMENT`` is set, each request records how many
+SQL statements it ran and how long it spent in the database, rendering
+templates and serializing downloads. The totals are sent back in a
+``Server-Timing`` header, which browser dev tools show next to the request,
+and logged as one JSON line per request to the ``sample_registry.instrument``
+logger.
+
+Work done while a streamed response is being sent happens after the header
+is written, so it is not counted.
+"""
+
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from flask import Flask, g, has_app_context, request, template_rendered
+from flask import before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENT_ENV = "SAMPLE_REGISTRY_INSTRUMENT"
+# Phases reported for every request, in Server-Timing order
+PHASES = ["db", "render", "serialize"]
+
+
+def enabled() -> bool:
+    return os.environ.get(INSTRUMENT_ENV, "").lower() not in ("", "0", "false", "no")
+
+
+class RequestTimings:
+    """Statement count and seconds spent in each phase of one request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+
+    def add(self, phase: str, seconds: float):
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+
+    def total(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        parts = [
+            '{0};dur={1:.1f};desc="{2} queries"'.format(
+                "db", self.seconds["db"] * 1000, self.queries
+            )
+        ]
+        parts += [
+            "{0};dur={1:.1f}".format(phase, seconds * 1000)
+            for phase, seconds in self.seconds.items()
+            if phase != "db"
+        ]
+        parts.append("total;dur={0:.1f}".format(self.total() * 1000))
+        return ", ".join(parts)
+
+    def to_dict(self) -> dict:
+        d = {"queries": self.queries}
+        d.update(
+            {f"{phase}_ms": round(s * 1000, 2) for phase, s in self.seconds.items()}
+        )
+        d["total_ms"] = round(self.total() * 1000, 2)
+        return d
+
+
+def current_timings() -> RequestTimings | None:
+    """Return the timings of the request being handled, if it's instrumented."""
+    if not has_app_context():
+        return None
+    return g.get("request_timings")
+
+
+@contextmanager
+def timed(phase: str):
+    """Add the time spent in the block to ``phase`` of the current request."""
+    timings = current_timings()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(phase, time.perf_counter() - start)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # A connection runs one statement at a time, so one start time is enough
+    conn.info["instrument_start"] = time.perf_counter()
+
+
+def _statement_done(conn):
+    start = conn.info.pop("instrument_start", None)
+    timings = current_timings()
+    if timings is not None and start is not None:
+        timings.queries += 1
+        timings.add("db", time.perf_counter() - start)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _statement_done(conn)
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute
+    if exception_context.connection is not None:
+        _statement_done(exception_context.connection)
+
+
+def instrument_engine(engine: Engine):
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+
+
+def _before_render(sender, template, context, **extra):
+    g.render_start = time.perf_counter()
+
+
+def _rendered(sender, template, context, **extra):
+    timings = current_timings()
+    start = g.pop("render_start", None)
+    if timings is not None and start is not None:
+        timings.add("render", time.perf_counter() - start)
+
+
+def init_app(app: Flask, engines: list[Engine]):
+    """Record timings for every request to ``app`` and statement on ``engines``."""
+    if not logger.handlers:
+        # Log lines are useful without any other logging set up
+        logger.addHandler(logging.StreamHandler())
+        logger.setLevel(logging.INFO)
+    for engine in engines:
+        instrument_engine(engine)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+
+    @app.before_request
+    def start_request_timings():
+        g.request_timings = RequestTimings()
+
+    @app.after_request
+    def report_request_timings(response):
+        timings = g.pop("request_timings", None)
+        if timings is None:
+            return response
+        response.headers["Server-Timing"] = timings.server_timing()
+        record = {
+            "method": request.method,
+            "path": request.path,
+            "endpoint": request.endpoint,
+            "status": response.status_code,
+        }
+        record.update(timings.to_dict())
+        logger.info(json.dumps(record))
+        return response
+
+
+class StatementCounter:
+    """Collect the SQL statements run on ``engines`` inside a ``with`` block.
+
+    Executemany calls count once, as they're one round trip to the driver.
+    """
+
+    def __init__(self, *engines: Engine):
+        self.engines = engines
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        for engine in self.engines:
+            event.listen(engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *exc):
+        for engine in self.engines:
+            event.remove(engine, "before_cursor_execute", self._record)
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
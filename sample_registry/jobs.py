@@ -0,0 +1,310 @@
+"""Register large sample tables in the background
+
+Parsing, validating and inserting a sample table with thousands of samples
+can take longer than a proxy will hold a request open. A registration job
+stores the request in the ``registration_jobs`` table and returns its ID
+straight away; a ``JobWorker`` thread then claims queued jobs one at a
+time and runs them. Clients poll the job for its status, stage, error and,
+once it's done, the accessions of the run's samples.
+
+Each job's registration is applied in one transaction together with the
+job's final status, so a job is either done with all its samples
+registered or failed with none of them. Progress is reported by stage,
+which is committed before the transaction starts. On SQLite, the worker's
+writes go through the app's ``WriteQueue`` so that it isn't a second
+writer competing with API requests for the database lock.
+
+The worker running a job renews its lease on a heartbeat thread. A job
+whose lease hasn't been renewed for its length, because the process running
+it died, is claimed again by the next worker to look for work. If the first
+run is still going, its transaction is rolled back when it finds its claim
+has been taken over.
+"""
+
+import functools
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+from sqlalchemy.orm import sessionmaker
+from sample_registry import operations
+from sample_registry.models import RegistrationJob
+from sample_registry.operations import OperationError
+from sample_registry.registrar import SampleRegistry
+
+logger = logging.getLogger(__name__)
+
+JOB_OPERATIONS = {
+    "register_samples": operations.register_samples,
+    "register_annotations": operations.register_annotations,
+}
+# Seconds between checks for jobs queued by other processes
+POLL_INTERVAL = 5.0
+# How long a job may go without its lease being renewed before another
+# worker can take it over
+JOB_LEASE = timedelta(hours=1)
+# Leases are renewed this many times per lease, so one late renewal
+# doesn't lose the job
+HEARTBEATS_PER_LEASE = 4
+
+
+def check_job_request(operation: str, data: dict) -> int:
+    """Check the fields of a job before it's queued and return its run accession.
+
+    Raises
+    ------
+    OperationError
+        If the operation is unknown or a required field is missing.
+    """
+    if operation not in JOB_OPERATIONS:
+        raise OperationError(
+            "op must be one of: {0}".format(", ".join(sorted(JOB_OPERATIONS)))
+        )
+    operations._require(data, "run_accession", "sample_table")
+    return operations._int(data, "run_accession")
+
+
+def create_job(registry: SampleRegistry, data: tuple[str, dict]) -> dict:
+    """Queue a job, as a write operation for ``submit_write``."""
+    operation, fields = data
+    run_accession = check_job_request(operation, fields)
+    job_id = registry.create_job(operation, json.dumps(fields), run_accession)
+    return {"job_id": job_id}
+
+
+def job_to_dict(job: RegistrationJob) -> dict:
+    d = {
+        "job_id": job.job_id,
+        "op": job.operation,
+        "status": job.status,
+        "stage": job.stage,
+        "run_accession": job.run_accession,
+        "sample_count": job.sample_count,
+        "created_at": job.created_at.isoformat(timespec="seconds"),
+        "started_at": job.started_at and job.started_at.isoformat(timespec="seconds"),
+        "finished_at": job.finished_at
+        and job.finished_at.isoformat(timespec="seconds"),
+        "error": job.error,
+    }
+    if job.result:
+        d["result"] = json.loads(job.result)
+    return d
+
+
+class JobTakenOver(Exception):
+    """Raised when a job's claim was taken over by another worker."""
+
+
+def apply_write(session_factory: sessionmaker, operation, data) -> dict:
+    """Apply ``operation(registry, data)`` in its own session and commit it."""
+    session = session_factory()
+    try:
+        result = operation(SampleRegistry(session), data)
+        session.commit()
+        return result
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def _claim_next_job(registry: SampleRegistry, lease: timedelta) -> dict:
+    job = registry.claim_next_job(lease)
+    if job is None:
+        return {}
+    return {
+        "job_id": job.job_id,
+        "operation": job.operation,
+        "request": job.request,
+        "claim": job.started_at,
+    }
+
+
+def _update_job(registry: SampleRegistry, data: tuple[int, datetime, dict]) -> dict:
+    job_id, claim, values = data
+    if not registry.update_job(job_id, claim, **values):
+        raise JobTakenOver(f"Registration job {job_id} was taken over")
+    return {}
+
+
+def _renew_job(registry: SampleRegistry, data: tuple[int, datetime]) -> dict:
+    job_id, claim = data
+    return _update_job(registry, (job_id, claim, {"heartbeat_at": datetime.now()}))
+
+
+def _heartbeat(submit, job_id: int, claim: datetime, interval: float, stop):
+    while not stop.wait(interval):
+        try:
+            submit(_renew_job, (job_id, claim))
+        except JobTakenOver:
+            return
+        except Exception:
+            logger.exception("Could not renew registration job %s", job_id)
+
+
+def _register_job(registry: SampleRegistry, data: tuple) -> dict:
+    """Register a job's samples and mark it done, in one transaction."""
+    job_id, claim, operation, fields, sample_table = data
+    result = JOB_OPERATIONS[operation](registry, fields, sample_table=sample_table)
+    result["samples"] = [
+        {"sample_accession": s.sample_accession, "sample_name": s.sample_name}
+        for s in sorted(
+            registry.get_samples(result["run_accession"]),
+            key=lambda s: s.sample_accession,
+        )
+    ]
+    return _update_job(
+        registry,
+        (
+            job_id,
+            claim,
+            {
+                "status": "done",
+                "stage": None,
+                "request": None,
+                "result": json.dumps(result),
+                "finished_at": datetime.now(),
+            },
+        ),
+    )
+
+
+def run_job(
+    submit,
+    job_id: int,
+    operation: str,
+    data: dict,
+    claim: datetime,
+    heartbeat: Optional[float] = None,
+):
+    """Parse and register a claimed job's sample table, recording the outcome.
+
+    Each write is applied with ``submit(operation, data)``. ``claim`` is
+    the job's ``started_at`` when it was claimed; nothing is committed once
+    the job has been taken over by another worker. With ``heartbeat``, the
+    job's lease is renewed every ``heartbeat`` seconds until it finishes.
+    """
+    stop = threading.Event()
+    if heartbeat:
+        threading.Thread(
+            target=_heartbeat,
+            args=(submit, job_id, claim, heartbeat, stop),
+            name=f"sample_registry-job-{job_id}",
+            daemon=True,
+        ).start()
+    try:
+        _run_job(submit, job_id, operation, data, claim)
+    finally:
+        stop.set()
+
+
+def _run_job(submit, job_id: int, operation: str, data: dict, claim: datetime):
+    try:
+        sample_table = operations.load_sample_table(data.get("sample_table"))
+        submit(
+            _update_job,
+            (
+                job_id,
+                claim,
+                {
+                    "stage": "registering",
+                    "sample_count": len(sample_table.recs),
+                    "heartbeat_at": datetime.now(),
+                },
+            ),
+        )
+        submit(_register_job, (job_id, claim, operation, data, sample_table))
+    except JobTakenOver:
+        logger.warning("Registration job %s was taken over", job_id)
+    except Exception as exc:
+        if isinstance(exc, (ValueError, IOError)):
+            error = str(exc)
+        else:
+            logger.exception("Registration job %s failed", job_id)
+            error = f"Internal error: {exc}"
+        try:
+            submit(
+                _update_job,
+                (
+                    job_id,
+                    claim,
+                    {
+                        "status": "failed",
+                        "stage": None,
+                        "request": None,
+                        "error": error,
+                        "finished_at": datetime.now(),
+                    },
+                ),
+            )
+        except JobTakenOver:
+            logger.warning("Registration job %s was taken over", job_id)
+
+
+class JobWorker:
+    """Run queued registration jobs on a background thread.
+
+    The thread starts on the first call to ``notify``, so a server that
+    preloads the app starts one per worker process after forking. The
+    lease of the job being run is renewed ``HEARTBEATS_PER_LEASE`` times
+    per ``lease``, and running jobs whose lease hasn't been renewed for
+    longer than ``lease`` are run again.
+
+    Writes are applied with ``submit(operation, data)``, such as a blocking
+    ``WriteQueue.submit``, so that on SQLite the worker doesn't compete
+    with the API's writer for the database lock. Without it, each write
+    is committed in a new session from ``session_factory``.
+    """
+
+    def __init__(
+        self,
+        session_factory: sessionmaker,
+        poll_interval: float = POLL_INTERVAL,
+        lease: timedelta = JOB_LEASE,
+        submit: Optional[Callable[..., dict]] = None,
+    ):
+        self.session_factory = session_factory
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.submit = submit or functools.partial(apply_write, session_factory)
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def notify(self):
+        """Start the worker if needed and have it look for queued jobs."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="sample_registry-jobs", daemon=True
+                )
+                self._thread.start()
+        self._wake.set()
+
+    def run_pending(self) -> int:
+        """Run queued jobs until there are none left, returning how many ran."""
+        n = 0
+        while True:
+            job = self.submit(_claim_next_job, self.lease)
+            if not job:
+                return n
+            run_job(
+                self.submit,
+                job["job_id"],
+                job["operation"],
+                json.loads(job["request"]),
+                job["claim"],
+                heartbeat=self.lease.total_seconds() / HEARTBEATS_PER_LEASE,
+            )
+            n += 1
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                self.run_pending()
+            except Exception:
+                logger.exception("Could not look for registration jobs")
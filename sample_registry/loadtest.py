@@ -0,0 +1,493 @@
+"""Fire concurrent requests at the web app and report how it holds up
+
+By default a registry of generated runs is written to a temporary SQLite
+file and served in a subprocess, so the server doesn't share an
+interpreter with the client threads. The same load can be run against the
+Flask development server and the production gunicorn setup in turn to
+compare them, or against a server that is already running with ``--url``.
+
+Unless a mix is given, each server gets a read-only mix and then a mix
+with writes, reported separately: with SQLite, reads scale with gunicorn's
+worker processes while writes still take the database lock one at a time.
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Optional
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sample_registry.mapping import SampleTable
+from sample_registry.models import Base
+from sample_registry.registrar import SampleRegistry
+
+REQUEST_KINDS = ["browse", "run", "tag", "download", "write"]
+SERVERS = ["dev", "gunicorn"]
+# The mixes each server gets by default, reported separately
+DEFAULT_MIXES = {
+    "read": "browse=2,run=4,tag=2,download=1",
+    "write": "browse=2,run=4,tag=2,download=1,write=1",
+}
+SAMPLE_TYPES = ["Stool", "Oral swab", "Blood", "Skin swab", "Bronchoalveolar lavage"]
+LOCK_ERROR_RE = re.compile(r"database is locked|database table is locked")
+# Lines that link an exception to the next one in a chained traceback
+CHAINED_RE = re.compile(
+    r"^(The above exception was the direct cause|During handling of the above)"
+)
+SERVER_START_TIMEOUT = 30
+REQUEST_TIMEOUT = 60
+# Samples listed from the server to pick request targets from
+TARGET_SAMPLES = 2000
+
+
+@dataclass
+class LoadResult:
+    kind: str
+    seconds: float
+    status: int
+    error: Optional[str] = None
+
+
+@dataclass
+class Targets:
+    run_accessions: list[str]
+    sample_accessions: list[str]
+    tags: list[tuple[str, str]]
+
+
+def parse_mix(text: str) -> dict[str, float]:
+    """Parse request kind weights like ``run=4,write=1``."""
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS:
+            raise ValueError(f"Unknown request kind: {kind}")
+        try:
+            mix[kind] = float(weight) if weight else 1.0
+        except ValueError:
+            raise ValueError(f"Invalid weight for {kind}: {weight}")
+    if not any(mix.values()):
+        raise ValueError("At least one request kind needs a positive weight")
+    return mix
+
+
+def generate_registry(
+    session: Session,
+    runs: int = 20,
+    samples_per_run: int = 96,
+    keys: int = 5,
+    seed: int = 0,
+):
+    """Fill ``session`` with runs of samples with random annotations."""
+    rng = random.Random(seed)
+    registry = SampleRegistry(session)
+    for i in range(1, runs + 1):
+        run_accession = registry.register_run(
+            "2024-{0:02d}-{1:02d}".format(i % 12 + 1, i % 28 + 1),
+            "Illumina-MiSeq",
+            "Nextera XT",
+            1,
+            f"raw_data/run{i}/Undetermined_S0_L001_R1_001.fastq.gz",
+            f"Load test run {i}",
+        )
+        recs = []
+        for j in range(samples_per_run):
+            rec = {
+                "SampleID": f"Run{i}.S{j}",
+                "BarcodeSequence": "".join(rng.choice("ACGT") for _ in range(12)),
+                "SampleType": rng.choice(SAMPLE_TYPES),
+                "SubjectID": f"Subject{rng.randrange(samples_per_run // 4 + 1)}",
+            }
+            rec.update({f"key{k}": f"val{rng.randrange(5)}" for k in range(keys)})
+            recs.append(rec)
+        sample_table = SampleTable(recs)
+        registry.register_samples(run_accession, sample_table)
+        registry.register_annotations(run_accession, sample_table)
+    session.commit()
+
+
+def discover_targets(base_url: str) -> Targets:
+    """List runs, samples and tag values to request from the server."""
+    url = f"{base_url}/api/samples?limit={TARGET_SAMPLES}"
+    with urllib.request.urlopen(url, timeout=REQUEST_TIMEOUT) as response:
+        samples = [json.loads(line) for line in response if line.strip()]
+    if not samples:
+        raise ValueError("The registry has no samples to request")
+    tags = sorted(
+        {(k, v) for s in samples for k, v in s["annotations"].items() if v}
+    ) or [("SampleType", samples[0]["sample_type"])]
+    return Targets(
+        run_accessions=sorted({s["run_accession"] for s in samples}),
+        sample_accessions=[s["sample_accession"] for s in samples],
+        tags=tags,
+    )
+
+
+def make_request(
+    kind: str, targets: Targets, rng: random.Random
+) -> tuple[str, Optional[bytes]]:
+    """Return the path and JSON body, if it's a POST, for one request."""
+    run = rng.choice(targets.run_accessions)
+    if kind == "browse":
+        return rng.choice(["/runs", "/tags", "/stats"]), None
+    if kind == "run":
+        return f"/runs/{run[3:]}", None
+    if kind == "tag":
+        key, val = rng.choice(targets.tags)
+        return rng.choice([f"/tags/{key}", f"/tags/{key}/{val}"]), None
+    if kind == "download":
+        return f"/runs/{run}{rng.choice(['.json', '.tsv', '.txt'])}", None
+    # An upsert, so every write changes a row whatever the registry holds
+    body = {
+        "patches": [
+            [
+                rng.choice(targets.sample_accessions),
+                "loadtest",
+                str(rng.randrange(1000000)),
+            ]
+        ]
+    }
+    return "/api/patch_samples", json.dumps(body).encode()
+
+
+def fetch(base_url: str, path: str, body: Optional[bytes]) -> tuple[int, str | None]:
+    req = urllib.request.Request(base_url + path, data=body)
+    if body is not None:
+        req.add_header("Content-Type", "application/json")
+    try:
+        with urllib.request.urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+            response.read()
+            return response.status, None
+    except urllib.error.HTTPError as exc:
+        return exc.code, exc.read().decode("utf-8", "replace")[:200]
+    except (urllib.error.URLError, OSError) as exc:
+        return 0, str(exc)
+
+
+def run_load(
+    base_url: str,
+    targets: Targets,
+    mix: dict[str, float],
+    threads: int = 8,
+    duration: float = 10,
+    seed: int = 0,
+) -> list[LoadResult]:
+    """Send requests from ``threads`` threads for ``duration`` seconds."""
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    deadline = time.perf_counter() + duration
+    results = []
+    lock = threading.Lock()
+
+    def worker(i):
+        rng = random.Random(seed * 1000 + i)
+        mine = []
+        while time.perf_counter() < deadline:
+            kind = rng.choices(kinds, weights)[0]
+            path, body = make_request(kind, targets, rng)
+            start = time.perf_counter()
+            status, error = fetch(base_url, path, body)
+            mine.append(LoadResult(kind, time.perf_counter() - start, status, error))
+        with lock:
+            results.extend(mine)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return results
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile of ``values``, ``p`` from 0 to 100."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[k]
+
+
+def summarize(results: list[LoadResult], elapsed: float, lock_errors: int) -> dict:
+    def stats(rs):
+        latencies = [r.seconds * 1000 for r in rs]
+        errors = sum(r.status == 0 or r.status >= 400 for r in rs)
+        return {
+            "requests": len(rs),
+            "errors": errors,
+            "error_rate": errors / len(rs) if rs else 0.0,
+            "p50_ms": percentile(latencies, 50),
+            "p90_ms": percentile(latencies, 90),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": max(latencies, default=0.0),
+        }
+
+    summary = stats(results)
+    summary["seconds"] = elapsed
+    summary["throughput"] = len(results) / elapsed if elapsed else 0.0
+    summary["lock_errors"] = lock_errors + sum(
+        bool(r.error and LOCK_ERROR_RE.search(r.error)) for r in results
+    )
+    summary["kinds"] = {
+        k: stats([r for r in results if r.kind == k])
+        for k in REQUEST_KINDS
+        if any(r.kind == k for r in results)
+    }
+    return summary
+
+
+def format_report(summary: dict) -> str:
+    lines = [
+        "{0} requests in {1:.1f}s, {2:.1f} requests/s".format(
+            summary["requests"], summary["seconds"], summary["throughput"]
+        ),
+        "Errors: {0} ({1:.2%}), SQLite lock errors: {2}".format(
+            summary["errors"], summary["error_rate"], summary["lock_errors"]
+        ),
+        "",
+        "kind\trequests\terrors\tp50_ms\tp90_ms\tp99_ms\tmax_ms",
+    ]
+    for kind, s in list(summary["kinds"].items()) + [("all", summary)]:
+        lines.append(
+            "{0}\t{1}\t{2}\t{3:.1f}\t{4:.1f}\t{5:.1f}\t{6:.1f}".format(
+                kind,
+                s["requests"],
+                s["errors"],
+                s["p50_ms"],
+                s["p90_ms"],
+                s["p99_ms"],
+                s["max_ms"],
+            )
+        )
+    return "\n".join(lines) + "\n"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_server(base_url: str, proc: subprocess.Popen):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("The server exited before it started listening")
+        try:
+            with urllib.request.urlopen(base_url + "/runs", timeout=1):
+                return
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.1)
+    raise RuntimeError(f"The server didn't respond within {SERVER_START_TIMEOUT}s")
+
+
+def server_command(server: str, port: int, workers: int = 1) -> list:
+    if server == "dev":
+        return [
+            sys.executable,
+            "-m",
+            "flask",
+            "--app",
+            "sample_registry.app",
+            "run",
+            "--port",
+            str(port),
+            "--with-threads",
+            "--no-reload",
+        ]
+    cmd = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "-c",
+        "python:sample_registry.gunicorn_conf",
+        "--bind",
+        f"127.0.0.1:{port}",
+        # gunicorn_conf runs one worker with SQLite unless told otherwise
+        "--workers",
+        str(workers),
+        "sample_registry.wsgi:app",
+    ]
+    return cmd
+
+
+@contextmanager
+def serve(
+    db_uri: str, log_path: Path, server: str = "dev", workers: int = 1
+) -> Iterator[str]:
+    """Run ``server`` on ``db_uri``, logging to ``log_path``."""
+    port = free_port()
+    env = dict(os.environ, SAMPLE_REGISTRY_DB_URI=db_uri, FLASK_DEBUG="0")
+    # The package swaps in an in-memory database when it sees this
+    env.pop("PYTEST_VERSION", None)
+    cmd = server_command(server, port, workers)
+    with open(log_path, "w") as log:
+        proc = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            wait_for_server(base_url, proc)
+            yield base_url
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+def count_lock_errors(log_path: Path) -> int:
+    """Count the failures from a locked database in a server log.
+
+    A chained traceback repeats the error for each exception in the chain,
+    e.g. sqlite3's and SQLAlchemy's, so only the last one is counted.
+    """
+    count = 0
+    pending = False
+    with open(log_path, errors="replace") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if pending and not CHAINED_RE.match(line):
+                count += 1
+            pending = bool(LOCK_ERROR_RE.search(line))
+    return count + pending
+
+
+def loadtest(argv=None, out=sys.stdout):
+    p = argparse.ArgumentParser(
+        description=(
+            "Send a mix of concurrent page, download and write API requests to "
+            "the web app and report throughput, latency and errors"
+        )
+    )
+    p.add_argument(
+        "--server",
+        action="append",
+        choices=SERVERS,
+        help=(
+            "Server to start: the Flask development server or gunicorn with the "
+            "production settings; repeat to compare them (default: dev)"
+        ),
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="gunicorn worker processes (default: one per core)",
+    )
+    p.add_argument("--url", help="Test this running server instead of starting one")
+    p.add_argument(
+        "--db",
+        help=(
+            "SQLite file to serve; generated if it doesn't exist "
+            "(default: a temporary file)"
+        ),
+    )
+    p.add_argument("--runs", type=int, default=20, help="Runs to generate")
+    p.add_argument(
+        "--samples-per-run", type=int, default=96, help="Samples per generated run"
+    )
+    p.add_argument("--threads", type=int, default=8, help="Concurrent clients")
+    p.add_argument(
+        "--duration", type=float, default=10, help="Seconds to send requests for"
+    )
+    p.add_argument(
+        "--mix",
+        help=(
+            "Weights of request kinds ({0}) (default: a read-only mix, {1}, "
+            "then one with writes, {2})"
+        ).format(
+            ", ".join(REQUEST_KINDS), DEFAULT_MIXES["read"], DEFAULT_MIXES["write"]
+        ),
+    )
+    p.add_argument("--seed", type=int, default=0, help="Random seed")
+    p.add_argument("--json", action="store_true", help="Write the report as JSON")
+    args = p.parse_args(argv)
+    try:
+        if args.mix:
+            mixes = {"custom": parse_mix(args.mix)}
+        else:
+            mixes = {name: parse_mix(mix) for name, mix in DEFAULT_MIXES.items()}
+    except ValueError as exc:
+        p.error(str(exc))
+
+    servers = ["url"] if args.url else args.server or ["dev"]
+    summaries = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        if not args.url:
+            db_path = Path(args.db or Path(tmp) / "loadtest.sqlite")
+            if not db_path.exists():
+                sys.stderr.write(f"Generating registry in {db_path}\n")
+                engine = create_engine(f"sqlite:///{db_path}")
+                Base.metadata.create_all(engine)
+                with Session(engine) as session:
+                    generate_registry(
+                        session, args.runs, args.samples_per_run, seed=args.seed
+                    )
+                engine.dispose()
+
+        for server_name in servers:
+            log_path = Path(tmp) / f"{server_name}.log"
+            if args.url:
+                server = nullcontext(args.url.rstrip("/"))
+            else:
+                server = serve(
+                    f"sqlite:///{db_path.resolve()}",
+                    log_path,
+                    server_name,
+                    args.workers,
+                )
+            summaries[server_name] = {}
+            with server as base_url:
+                targets = discover_targets(base_url)
+                for mix_name, mix in mixes.items():
+                    logged = 0 if args.url else count_lock_errors(log_path)
+                    start = time.perf_counter()
+                    results = run_load(
+                        base_url, targets, mix, args.threads, args.duration, args.seed
+                    )
+                    elapsed = time.perf_counter() - start
+                    lock_errors = (
+                        0 if args.url else count_lock_errors(log_path) - logged
+                    )
+                    summaries[server_name][mix_name] = summarize(
+                        results, elapsed, lock_errors
+                    )
+
+    if args.json:
+        out.write(json.dumps(summaries, indent=2) + "\n")
+    else:
+        for server_name, by_mix in summaries.items():
+            for mix_name, summary in by_mix.items():
+                out.write(f"== {server_name}, {mix_name} mix ==\n")
+                out.write(format_report(summary))
+        for server_name in servers[1:]:
+            for mix_name in mixes:
+                base = summaries[servers[0]][mix_name]["throughput"]
+                out.write(
+                    "{0} handled {1:.2f}x the requests/s of {2} with the {3} "
+                    "mix\n".format(
+                        server_name,
+                        (
+                            summaries[server_name][mix_name]["throughput"] / base
+                            if base
+                            else 0
+                        ),
+                        servers[0],
+                        mix_name,
+                    )
+                )
+    return summaries
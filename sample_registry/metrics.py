@@ -0,0 +1,386 @@
+"""Request, database and registry metrics in Prometheus text format
+
+Counters and histograms are kept in memory by each process. With several
+worker processes, set ``SAMPLE_REGISTRY_METRICS_DIR`` to a directory they
+share: each process then writes a snapshot of its values there at most
+once per ``SNAPSHOT_INTERVAL`` seconds, and ``/metrics`` adds up the
+snapshots of every process, so any worker can answer a scrape. When a
+worker exits, its snapshot is folded into one for all exited workers (see
+``retire_snapshot``), so the counts it made are kept without leaving a file
+behind for every worker ever started.
+"""
+
+import bisect
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from flask import Flask, g, request
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sample_registry.models import Annotation, Run, Sample
+
+METRICS_DIR_ENV = "SAMPLE_REGISTRY_METRICS_DIR"
+SNAPSHOT_INTERVAL = 1.0
+EXITED_SNAPSHOT = "exited.json"
+# Counting rows means scanning each table, so the sizes are only reread
+# once this many seconds have passed
+REGISTRY_SIZES_TTL = 60.0
+# Upper bounds in seconds, as used by the Prometheus client libraries
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+HELP = {
+    "sample_registry_http_requests_total": (
+        "counter",
+        "HTTP requests by route and status",
+    ),
+    "sample_registry_http_request_duration_seconds": (
+        "histogram",
+        "HTTP request latency by route",
+    ),
+    "sample_registry_db_checkouts_total": (
+        "counter",
+        "Connections checked out of the database pool",
+    ),
+    "sample_registry_db_checkout_duration_seconds": (
+        "histogram",
+        "Time connections were held before being returned to the pool",
+    ),
+    "sample_registry_db_pool_wait_seconds": (
+        "histogram",
+        "Time spent waiting to get a connection from the pool, including opening it",
+    ),
+    "sample_registry_db_connect_duration_seconds": (
+        "histogram",
+        "Time spent opening new database connections for the pool",
+    ),
+    "sample_registry_cache_requests_total": (
+        "counter",
+        "Cache lookups by cache and result",
+    ),
+    "sample_registry_api_writes_total": (
+        "counter",
+        "Write API operations by operation and status",
+    ),
+    "sample_registry_db_connections_in_use": (
+        "gauge",
+        "Connections currently checked out of the pool",
+    ),
+    "sample_registry_registry_size": ("gauge", "Rows in the registry by table"),
+}
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+class Metrics:
+    """Thread-safe counters and histograms for one process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, _labels(labels))
+        i = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                # One count per bucket plus +Inf, then the sum of observations
+                h = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            h[i] += 1
+            h[-1] += seconds
+
+    def add_gauge(self, name: str, value: float, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "counters": [[n, list(l), v] for (n, l), v in self.counters.items()],
+                "histograms": [
+                    [n, list(l), list(h)] for (n, l), h in self.histograms.items()
+                ],
+                "gauges": [[n, list(l), v] for (n, l), v in self.gauges.items()],
+            }
+
+    def merge(self, snapshot: dict):
+        with self.lock:
+            for n, l, v in snapshot["counters"]:
+                key = (n, tuple(map(tuple, l)))
+                self.counters[key] = self.counters.get(key, 0) + v
+            for n, l, h in snapshot["histograms"]:
+                key = (n, tuple(map(tuple, l)))
+                prev = self.histograms.get(key, [0] * len(h))
+                self.histograms[key] = [a + b for a, b in zip(prev, h)]
+            for n, l, v in snapshot["gauges"]:
+                key = (n, tuple(map(tuple, l)))
+                self.gauges[key] = self.gauges.get(key, 0) + v
+
+
+METRICS = Metrics()
+_last_snapshot = 0.0
+_registry_sizes = None
+
+
+def _format_labels(labels, extra=()) -> str:
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(
+            '{0}="{1}"'.format(
+                k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            )
+            for k, v in labels
+        )
+        + "}"
+    )
+
+
+def render(metrics: Metrics) -> str:
+    """Format ``metrics`` in the Prometheus text exposition format."""
+    series = {}
+    for (name, labels), v in metrics.counters.items():
+        series.setdefault(name, []).append(f"{name}{_format_labels(labels)} {v}")
+    for (name, labels), v in metrics.gauges.items():
+        series.setdefault(name, []).append(f"{name}{_format_labels(labels)} {v}")
+    for (name, labels), h in metrics.histograms.items():
+        lines = series.setdefault(name, [])
+        cumulative = 0
+        for le, n in zip(LATENCY_BUCKETS + ["+Inf"], h):
+            cumulative += n
+            lines.append(
+                "{0}_bucket{1} {2}".format(
+                    name, _format_labels(labels, [("le", le)]), cumulative
+                )
+            )
+        lines.append(f"{name}_sum{_format_labels(labels)} {h[-1]}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+    out = []
+    for name in sorted(series):
+        kind, help_text = HELP.get(name, ("untyped", name))
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+        out.extend(sorted(series[name]))
+    return "\n".join(out) + "\n"
+
+
+def metrics_dir() -> Path | None:
+    d = os.environ.get(METRICS_DIR_ENV)
+    return Path(d) if d else None
+
+
+def write_snapshot(force: bool = False):
+    """Save this process's values for other workers to read."""
+    global _last_snapshot
+    d = metrics_dir()
+    now = time.monotonic()
+    if d is None or (not force and now - _last_snapshot < SNAPSHOT_INTERVAL):
+        return
+    _last_snapshot = now
+    d.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=d, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(METRICS.snapshot(), f)
+    os.replace(tmp, d / f"{os.getpid()}.json")
+
+
+def _read_snapshot(fp: Path) -> dict | None:
+    try:
+        return json.loads(fp.read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def retire_snapshot(pid: int):
+    """Fold the snapshot of exited process ``pid`` into the exited workers' one.
+
+    Only one process, such as the gunicorn master, should call this.
+    """
+    d = metrics_dir()
+    if d is None:
+        return
+    fp = d / f"{pid}.json"
+    snapshot = _read_snapshot(fp)
+    if snapshot is None:
+        return
+    exited = Metrics()
+    previous = _read_snapshot(d / EXITED_SNAPSHOT)
+    if previous is not None:
+        exited.merge(previous)
+    exited.merge(snapshot)
+    # Gauges describe a live process, only its counts outlive it
+    exited.gauges.clear()
+    fd, tmp = tempfile.mkstemp(dir=d, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(exited.snapshot(), f)
+    os.replace(tmp, d / EXITED_SNAPSHOT)
+    fp.unlink(missing_ok=True)
+
+
+def clear_snapshots():
+    """Remove the snapshots left by an earlier run of the server."""
+    d = metrics_dir()
+    if d is None or not d.is_dir():
+        return
+    for fp in list(d.glob("*.json")) + list(d.glob("*.tmp")):
+        fp.unlink(missing_ok=True)
+
+
+def collect() -> Metrics:
+    """Return the values of every worker process, or just this one."""
+    d = metrics_dir()
+    if d is None:
+        return METRICS
+    write_snapshot(force=True)
+    merged = Metrics()
+    for fp in d.glob("*.json"):
+        snapshot = _read_snapshot(fp)
+        # A worker may be replacing its file as we read it
+        if snapshot is not None:
+            merged.merge(snapshot)
+    return merged
+
+
+def registry_sizes(session: Session) -> dict[str, int]:
+    """Count the rows in each table, at most once per ``REGISTRY_SIZES_TTL``."""
+    global _registry_sizes
+    now = time.monotonic()
+    if _registry_sizes is not None and now - _registry_sizes[0] < REGISTRY_SIZES_TTL:
+        return _registry_sizes[1]
+    sizes = {
+        "runs": session.scalar(select(func.count()).select_from(Run)),
+        "samples": session.scalar(select(func.count()).select_from(Sample)),
+        "annotations": session.scalar(select(func.count()).select_from(Annotation)),
+    }
+    _registry_sizes = (now, sizes)
+    return sizes
+
+
+def render_metrics(session: Session, engines: list[Engine]) -> str:
+    """Render the metrics of all workers plus values read at scrape time."""
+    metrics = Metrics()
+    metrics.merge(collect().snapshot())
+    for table, n in registry_sizes(session).items():
+        metrics.add_gauge("sample_registry_registry_size", n, table=table)
+    for i, engine in enumerate(engines):
+        checkedout = getattr(engine.pool, "checkedout", None)
+        if checkedout is not None:
+            metrics.add_gauge(
+                "sample_registry_db_connections_in_use", checkedout(), engine=str(i)
+            )
+    return render(metrics)
+
+
+def count_cache(cache: str, hit: bool):
+    METRICS.inc(
+        "sample_registry_cache_requests_total",
+        cache=cache,
+        result="hit" if hit else "miss",
+    )
+
+
+def count_write(operation: str, status: str):
+    METRICS.inc("sample_registry_api_writes_total", operation=operation, status=status)
+
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    connection_record.info["metrics_checkout"] = time.perf_counter()
+    METRICS.inc("sample_registry_db_checkouts_total")
+
+
+def _on_checkin(dbapi_connection, connection_record):
+    start = connection_record.info.pop("metrics_checkout", None)
+    if start is not None:
+        METRICS.observe(
+            "sample_registry_db_checkout_duration_seconds",
+            time.perf_counter() - start,
+        )
+
+
+def _on_do_connect(dialect, conn_rec, cargs, cparams):
+    conn_rec.info["metrics_connect"] = time.perf_counter()
+
+
+def _on_connect(dbapi_connection, connection_record):
+    start = connection_record.info.pop("metrics_connect", None)
+    if start is not None:
+        METRICS.observe(
+            "sample_registry_db_connect_duration_seconds",
+            time.perf_counter() - start,
+        )
+
+
+def _time_pool_wait(engine: Engine):
+    # Pools have no event for before a connection is handed out, so the
+    # engine's own method for getting one is timed. It's set on the engine
+    # rather than the pool as dispose() replaces the pool.
+    raw_connection = engine.raw_connection
+
+    @functools.wraps(raw_connection)
+    def timed_raw_connection():
+        start = time.perf_counter()
+        try:
+            return raw_connection()
+        finally:
+            METRICS.observe(
+                "sample_registry_db_pool_wait_seconds", time.perf_counter() - start
+            )
+
+    engine.raw_connection = timed_raw_connection
+
+
+def instrument_engine(engine: Engine):
+    if event.contains(engine, "checkout", _on_checkout):
+        return
+    _time_pool_wait(engine)
+    event.listen(engine, "checkout", _on_checkout)
+    event.listen(engine, "checkin", _on_checkin)
+    event.listen(engine, "do_connect", _on_do_connect)
+    event.listen(engine, "connect", _on_connect)
+
+
+def init_app(app: Flask, engines: list[Engine]):
+    """Count requests to ``app`` and connections taken from ``engines``."""
+    for engine in engines:
+        instrument_engine(engine)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return response
+        route = request.endpoint or "none"
+        METRICS.inc(
+            "sample_registry_http_requests_total",
+            route=route,
+            status=str(response.status_code),
+        )
+        METRICS.observe(
+            "sample_registry_http_request_duration_seconds",
+            time.perf_counter() - start,
+            route=route,
+        )
+        write_snapshot()
+        return response
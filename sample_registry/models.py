@@ -1,4 +1,5 @@
-from sqlalchemy import ForeignKey
+from datetime import datetime
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from typing import Optional
 
@@ -14,9 +15,17 @@ class Run(Base):
     machine_type: Mapped[str]
     machine_kit: Mapped[str]
     lane: Mapped[int]
-    data_uri: Mapped[str]
+    data_uri: Mapped[str] = mapped_column(index=True)
     comment: Mapped[str]
     admin_comment: Mapped[Optional[str]] = mapped_column(nullable=True)
+    # Lets Postgres use an index for LIKE 'prefix%' under any collation
+    __table_args__ = (
+        Index(
+            "ix_runs_data_uri_pattern",
+            "data_uri",
+            postgresql_ops={"data_uri": "text_pattern_ops"},
+        ).ddl_if(dialect="postgresql"),
+    )
 
     def __repr__(self):
         return f"Run(run_accession={self.run_accession}, run_date={self.run_date}, machine_type={self.machine_type}, machine_kit={self.machine_kit}, lane={self.lane}, data_uri={self.data_uri}, comment={self.comment}, admin_comment={self.admin_comment})"
@@ -26,7 +35,9 @@ class Sample(Base):
     __tablename__ = "samples"
     sample_accession: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     sample_name: Mapped[str]
-    run_accession: Mapped[int] = mapped_column(ForeignKey("runs.run_accession"))
+    run_accession: Mapped[int] = mapped_column(
+        ForeignKey("runs.run_accession"), index=True
+    )
     barcode_sequence: Mapped[str]
     primer_sequence: Mapped[Optional[str]] = mapped_column(nullable=True)
     sample_type: Mapped[Optional[str]] = mapped_column(nullable=True)
@@ -39,6 +50,7 @@ class Sample(Base):
 
 class Annotation(Base):
     __tablename__ = "annotations"
+    __table_args__ = (Index("ix_annotations_key_val", "key", "val"),)
     sample_accession: Mapped[int] = mapped_column(
         ForeignKey("samples.sample_accession"), primary_key=True
     )
@@ -47,3 +59,100 @@ class Annotation(Base):
 
     def __repr__(self):
         return f"Annotation(sample_accession={self.sample_accession}, key={self.key}, val={self.val})"
+
+
+class ReadCount(Base):
+    __tablename__ = "read_counts"
+    sample_accession: Mapped[int] = mapped_column(
+        ForeignKey("samples.sample_accession"), primary_key=True
+    )
+    exact_reads: Mapped[int]
+    mismatch_reads: Mapped[int]
+
+    def __repr__(self):
+        return f"ReadCount(sample_accession={self.sample_accession}, exact_reads={self.exact_reads}, mismatch_reads={self.mismatch_reads})"
+
+
+class ArchiveStatus(Base):
+    __tablename__ = "archive_status"
+    run_accession: Mapped[int] = mapped_column(
+        ForeignKey("runs.run_accession"), primary_key=True
+    )
+    data_uri: Mapped[str]
+    status: Mapped[str]
+    size: Mapped[Optional[int]] = mapped_column(nullable=True)
+    mtime: Mapped[Optional[float]] = mapped_column(nullable=True)
+    checked_at: Mapped[datetime]
+
+    def __repr__(self):
+        return f"ArchiveStatus(run_accession={self.run_accession}, data_uri={self.data_uri}, status={self.status}, size={self.size}, mtime={self.mtime}, checked_at={self.checked_at})"
+
+
+class RunChecksum(Base):
+    __tablename__ = "run_checksums"
+    run_accession: Mapped[int] = mapped_column(
+        ForeignKey("runs.run_accession"), primary_key=True
+    )
+    data_uri: Mapped[str]
+    algorithm: Mapped[str]
+    digest: Mapped[str]
+    size: Mapped[int]
+    mtime: Mapped[float]
+    computed_at: Mapped[datetime]
+
+    def __repr__(self):
+        return f"RunChecksum(run_accession={self.run_accession}, data_uri={self.data_uri}, algorithm={self.algorithm}, digest={self.digest}, size={self.size}, mtime={self.mtime}, computed_at={self.computed_at})"
+
+
+class RunPath(Base):
+    __tablename__ = "run_paths"
+    run_accession: Mapped[int] = mapped_column(
+        ForeignKey("runs.run_accession"), primary_key=True
+    )
+    run_folder: Mapped[Optional[str]] = mapped_column(nullable=True)
+    file_name: Mapped[str] = mapped_column(index=True)
+    # The lane in the file name, e.g. 1 for Undetermined_S0_L001_R1_001.fastq.gz
+    lane: Mapped[Optional[int]] = mapped_column(nullable=True)
+    __table_args__ = (Index("ix_run_paths_run_folder_lane", "run_folder", "lane"),)
+
+    def __repr__(self):
+        return f"RunPath(run_accession={self.run_accession}, run_folder={self.run_folder}, file_name={self.file_name}, lane={self.lane})"
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    key: Mapped[str] = mapped_column(primary_key=True)
+    fingerprint: Mapped[str]
+    # Both null while the first request with this key is being handled
+    status_code: Mapped[Optional[int]] = mapped_column(nullable=True)
+    response: Mapped[Optional[str]] = mapped_column(nullable=True)
+    created_at: Mapped[datetime]
+    # The end of the claim's lease until a response is stored, then of its TTL
+    expires_at: Mapped[datetime] = mapped_column(index=True)
+
+    def __repr__(self):
+        return f"IdempotencyKey(key={self.key}, fingerprint={self.fingerprint}, status_code={self.status_code}, created_at={self.created_at}, expires_at={self.expires_at})"
+
+
+class RegistrationJob(Base):
+    __tablename__ = "registration_jobs"
+    job_id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    operation: Mapped[str]
+    # queued, running, done or failed
+    status: Mapped[str] = mapped_column(index=True)
+    # What a running job is doing: parsing or registering
+    stage: Mapped[Optional[str]] = mapped_column(nullable=True)
+    # The request fields as JSON, cleared once the job has finished
+    request: Mapped[Optional[str]] = mapped_column(nullable=True)
+    run_accession: Mapped[Optional[int]] = mapped_column(nullable=True)
+    sample_count: Mapped[Optional[int]] = mapped_column(nullable=True)
+    result: Mapped[Optional[str]] = mapped_column(nullable=True)
+    error: Mapped[Optional[str]] = mapped_column(nullable=True)
+    created_at: Mapped[datetime]
+    started_at: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+    # When the worker running the job last renewed its lease
+    heartbeat_at: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+
+    def __repr__(self):
+        return f"RegistrationJob(job_id={self.job_id}, operation={self.operation}, status={self.status}, stage={self.stage}, run_accession={self.run_accession}, created_at={self.created_at})"
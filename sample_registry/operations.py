@@ -0,0 +1,331 @@
+"""Write operations shared by the API endpoints and batch requests
+
+Each operation takes a ``SampleRegistry`` and the request fields for one
+change, validates them and applies the change without committing, so that
+callers decide whether it stands alone or is part of a larger transaction.
+"""
+
+import csv
+import itertools
+from io import StringIO
+from sample_registry.mapping import SampleTable
+from sample_registry.registrar import SampleRegistry
+from sample_registry.util import accession_number
+
+
+class OperationError(ValueError):
+    """Raised when the fields given for an operation are missing or invalid."""
+
+
+def _require(data: dict, *fields: str):
+    missing = [k for k in fields if not data.get(k)]
+    if len(missing) == 1:
+        raise OperationError(f"Missing required field: {missing[0]}")
+    if missing:
+        raise OperationError(f"Missing required fields: {', '.join(missing)}")
+
+
+def _int(data: dict, field: str, default=None) -> int | None:
+    value = data.get(field, default)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError as exc:
+        raise OperationError(f"Invalid {field} value: {exc}")
+
+
+def _bool(data: dict, field: str, default: bool = False) -> bool:
+    # Form and query values arrive as strings, so "false" must not be true
+    value = data.get(field)
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ("1", "true", "yes", "on"):
+        return True
+    if text in ("0", "false", "no", "off", ""):
+        return False
+    raise OperationError(f"Invalid {field} value: {value!r}")
+
+
+def load_sample_table(content: str | SampleTable) -> SampleTable:
+    """Load and validate a sample table.
+
+    A table that has already been loaded, by ``prepare_sample_table``, is
+    returned as it is.
+    """
+    if isinstance(content, SampleTable):
+        return content
+    if not content:
+        raise OperationError("sample_table is required")
+    try:
+        sample_table = SampleTable.load(StringIO(content))
+        sample_table.look_up_nextera_barcodes()
+        sample_table.validate()
+    except Exception as exc:
+        raise OperationError(str(exc)) from exc
+    return sample_table
+
+
+def prepare_sample_table(data: dict) -> dict:
+    """Load the sample table in ``data`` before the write is applied.
+
+    Parsing and validating a large table takes far longer than inserting
+    it, so callers that apply writes on a shared writer thread do it first.
+    Returns a copy of ``data`` with the loaded table in place of its text.
+    """
+    return dict(data, sample_table=load_sample_table(data.get("sample_table")))
+
+
+def register_run(registry: SampleRegistry, data: dict) -> dict:
+    _require(data, "file", "date", "comment")
+    lane = _int(data, "lane", 1)
+    run_accession = registry.register_run(
+        data["date"],
+        data.get("type", "Illumina-MiSeq"),
+        "Nextera XT",
+        lane,
+        data["file"],
+        data["comment"],
+    )
+    return {"run_accession": run_accession}
+
+
+def _register_sample_annotations(
+    registry: SampleRegistry,
+    data: dict,
+    register_samples: bool,
+    sample_table: SampleTable | None = None,
+) -> dict:
+    _require(data, "run_accession")
+    run_accession = _int(data, "run_accession")
+    diff = not register_samples and _bool(data, "diff")
+    if sample_table is None:
+        sample_table = load_sample_table(data.get("sample_table"))
+    if register_samples:
+        registry.check_samples(run_accession, exists=False)
+    registry.check_run_accession(run_accession)
+    result = {"run_accession": run_accession, "sample_count": len(sample_table.recs)}
+    if register_samples:
+        registry.register_samples(run_accession, sample_table)
+    if diff:
+        result["changes"] = registry.sync_annotations(run_accession, sample_table)
+    else:
+        registry.register_annotations(run_accession, sample_table)
+    return result
+
+
+def register_samples(
+    registry: SampleRegistry, data: dict, sample_table: SampleTable | None = None
+) -> dict:
+    """Register the samples and annotations in ``data["sample_table"]``.
+
+    A ``sample_table`` that has already been loaded can be passed instead.
+    """
+    return _register_sample_annotations(
+        registry, data, register_samples=True, sample_table=sample_table
+    )
+
+
+def register_annotations(
+    registry: SampleRegistry, data: dict, sample_table: SampleTable | None = None
+) -> dict:
+    return _register_sample_annotations(
+        registry, data, register_samples=False, sample_table=sample_table
+    )
+
+
+def unregister_samples(registry: SampleRegistry, data: dict) -> dict:
+    _require(data, "run_accession")
+    run_accession = _int(data, "run_accession")
+    registry.check_run_accession(run_accession)
+    samples_removed = registry.remove_samples(run_accession)
+    return {"run_accession": run_accession, "removed_samples": samples_removed}
+
+
+def modify_run(registry: SampleRegistry, data: dict) -> dict:
+    _require(data, "run_accession")
+    run_accession = _int(data, "run_accession")
+    lane = _int(data, "lane")
+    registry.check_run_accession(run_accession)
+    registry.modify_run(
+        run_accession=run_accession,
+        run_date=data.get("date"),
+        machine_type=data.get("type"),
+        machine_kit=data.get("kit"),
+        lane=lane,
+        data_uri=data.get("data_uri"),
+        comment=data.get("comment"),
+        admin_comment=data.get("admin_comment"),
+    )
+    return {"run_accession": run_accession}
+
+
+SAMPLE_FIELDS = [
+    "sample_name",
+    "sample_type",
+    "subject_id",
+    "host_species",
+    "barcode_sequence",
+    "primer_sequence",
+]
+
+
+def modify_samples(registry: SampleRegistry, items: list[dict]) -> list[dict]:
+    """Apply many ``modify_sample`` operations with one bulk UPDATE."""
+    updates = []
+    for data in items:
+        _require(data, "sample_accession")
+        update = {k: data.get(k) for k in SAMPLE_FIELDS}
+        update["sample_accession"] = _int(data, "sample_accession")
+        updates.append(update)
+    registry.check_sample_accessions([u["sample_accession"] for u in updates])
+    registry.modify_samples(updates)
+    return [{"sample_accession": u["sample_accession"]} for u in updates]
+
+
+def modify_sample(registry: SampleRegistry, data: dict) -> dict:
+    return modify_samples(registry, [data])[0]
+
+
+def modify_annotations(registry: SampleRegistry, items: list[dict]) -> list[dict]:
+    """Apply many ``modify_annotation`` operations with one bulk UPDATE."""
+    updates = []
+    for data in items:
+        _require(data, "sample_accession", "key", "val")
+        updates.append(
+            {
+                "sample_accession": _int(data, "sample_accession"),
+                "key": data["key"],
+                "val": data["val"],
+            }
+        )
+    registry.check_sample_accessions([u["sample_accession"] for u in updates])
+    registry.modify_annotations(updates)
+    return [{"sample_accession": u["sample_accession"]} for u in updates]
+
+
+def modify_annotation(registry: SampleRegistry, data: dict) -> dict:
+    return modify_annotations(registry, [data])[0]
+
+
+def load_patch_table(f) -> list[tuple[int, str, str]]:
+    """Read ``(sample_accession, field, value)`` rows from a TSV patch table.
+
+    An optional header line is skipped, as are blank lines and lines
+    beginning with '#'. Accessions may be numbers or like ``CMS000123``.
+    """
+    patches = []
+    for i, row in enumerate(csv.reader(f, delimiter="\t")):
+        if not row or row[0].startswith("#"):
+            continue
+        if i == 0 and row[0].strip() == "sample_accession":
+            continue
+        if len(row) != 3:
+            raise OperationError(f"Line {i + 1}: expected 3 fields, got {len(row)}")
+        try:
+            acc = accession_number(row[0], "sample")
+        except ValueError as exc:
+            raise OperationError(f"Line {i + 1}: {exc}")
+        patches.append((acc, row[1], row[2]))
+    return patches
+
+
+def patch_samples(registry: SampleRegistry, data: dict) -> dict:
+    if data.get("patch_table"):
+        patches = load_patch_table(StringIO(data["patch_table"]))
+    elif data.get("patches"):
+        try:
+            patches = [
+                (accession_number(str(acc), "sample"), field, val)
+                for acc, field, val in data["patches"]
+            ]
+        except (TypeError, ValueError) as exc:
+            raise OperationError(f"Invalid patches: {exc}")
+    else:
+        raise OperationError("Missing required field: patches or patch_table")
+    return registry.apply_patches(patches)
+
+
+OPERATIONS = {
+    "register_run": register_run,
+    "register_samples": register_samples,
+    "register_annotations": register_annotations,
+    "unregister_samples": unregister_samples,
+    "modify_run": modify_run,
+    "modify_sample": modify_sample,
+    "modify_annotation": modify_annotation,
+    "patch_samples": patch_samples,
+}
+# Operations whose sample table is loaded by ``prepare_batch``
+SAMPLE_TABLE_OPERATIONS = {"register_samples", "register_annotations"}
+# Consecutive operations of these kinds are applied together
+BULK_OPERATIONS = {
+    "modify_sample": modify_samples,
+    "modify_annotation": modify_annotations,
+}
+
+
+def prepare_batch(operations: list[dict]) -> list[dict]:
+    """Load the sample tables of a batch's operations before it's applied.
+
+    Raises
+    ------
+    OperationError
+        If a sample table is invalid; the message names its operation.
+    """
+    prepared = []
+    for i, data in enumerate(operations):
+        if isinstance(data, dict) and data.get("op") in SAMPLE_TABLE_OPERATIONS:
+            try:
+                data = prepare_sample_table(data)
+            except OperationError as exc:
+                raise OperationError(f"Operation {i} ({data['op']}): {exc}") from exc
+        prepared.append(data)
+    return prepared
+
+
+def run_batch(registry: SampleRegistry, operations: list[dict]) -> list[dict]:
+    """Apply ``operations`` in order, without committing.
+
+    Each operation is a dict with an ``op`` naming one of ``OPERATIONS`` and
+    the same fields as the matching API endpoint. Runs of consecutive
+    operations that have a bulk form are applied in one statement.
+
+    Returns
+    -------
+    list[dict]
+        One result per operation, in order, with its ``op`` and index.
+
+    Raises
+    ------
+    OperationError
+        If any operation fails; the message names the first operation of
+        the failing group. Changes already made are left for the caller to
+        roll back.
+    """
+    for i, data in enumerate(operations):
+        if not isinstance(data, dict) or data.get("op") not in OPERATIONS:
+            raise OperationError(f"Operation {i}: unknown or missing op")
+
+    results = []
+    for op, group in itertools.groupby(enumerate(operations), lambda x: x[1]["op"]):
+        group = list(group)
+        if op in BULK_OPERATIONS:
+            batches = [group]
+        else:
+            batches = [[x] for x in group]
+        for batch in batches:
+            items = [data for _, data in batch]
+            try:
+                if op in BULK_OPERATIONS:
+                    batch_results = BULK_OPERATIONS[op](registry, items)
+                else:
+                    batch_results = [OPERATIONS[op](registry, items[0])]
+            except (ValueError, IOError) as exc:
+                raise OperationError(f"Operation {batch[0][0]} ({op}): {exc}") from exc
+            for (i, _), result in zip(batch, batch_results):
+                results.append(dict(result, op=op, index=i))
+    return results
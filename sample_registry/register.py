@@ -3,8 +3,12 @@
 import argparse
 import sys
 import gzip
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from sqlalchemy.orm import Session
+from sample_registry.db import ensure_schema
 from sample_registry.mapping import SampleTable
+from sample_registry.operations import load_patch_table
 from sample_registry.registrar import SampleRegistry
 from seqBackupLib.illumina import IlluminaFastq
 
@@ -57,7 +61,7 @@ def register_annotations():
 
 
 def register_sample_annotations(
-    argv=None, register_samples=False, session: Session = None
+    argv=None, register_samples=False, session: Session = None, out=sys.stdout
 ):
     if register_samples:
         p = argparse.ArgumentParser(description=SAMPLES_DESC)
@@ -67,6 +71,15 @@ def register_sample_annotations(
         )
     p.add_argument("run_accession", type=int, help="Run accession number")
     p.add_argument("sample_table", type=argparse.FileType("r"), help=SAMPLE_TABLE_HELP)
+    if not register_samples:
+        p.add_argument(
+            "--diff",
+            action="store_true",
+            help=(
+                "Only write annotations that differ from those in the registry, "
+                "leaving unchanged values in place"
+            ),
+        )
     args = p.parse_args(argv)
 
     registry = SampleRegistry(session)
@@ -81,7 +94,14 @@ def register_sample_annotations(
     registry.check_run_accession(args.run_accession)
     if register_samples:
         registry.register_samples(args.run_accession, sample_table)
-    registry.register_annotations(args.run_accession, sample_table)
+    if not register_samples and args.diff:
+        counts = registry.sync_annotations(args.run_accession, sample_table)
+        out.write(
+            "Inserted {inserted}, updated {updated}, deleted {deleted}, "
+            "unchanged {unchanged}\n".format(**counts)
+        )
+    else:
+        registry.register_annotations(args.run_accession, sample_table)
 
     registry.session.commit()
 
@@ -95,6 +115,7 @@ def register_illumina_file(argv=None, session: Session = None, out=sys.stdout):
     args = p.parse_args(argv)
 
     registry = SampleRegistry(session)
+    ensure_schema(registry.session.get_bind())
     f = IlluminaFastq(gzip.open(args.file, "rt"))
     acc = registry.register_run(
         f.folder_info["date"],
@@ -109,6 +130,74 @@ def register_illumina_file(argv=None, session: Session = None, out=sys.stdout):
     out.write("Registered run {0} in the database\n".format(acc))
 
 
+UNDETERMINED_PATTERN = "Undetermined_S0_L*_R1_001.fastq.gz"
+
+
+def _read_illumina_file(fp: str) -> tuple[str, str, int, str]:
+    with gzip.open(fp, "rt") as f:
+        fq = IlluminaFastq(f)
+        return fq.folder_info["date"], fq.machine_type, fq.lane, str(fq.filepath)
+
+
+def register_run_directory(argv=None, session: Session = None, out=sys.stdout):
+    p = argparse.ArgumentParser(
+        description=(
+            "Add a new run to the registry for each lane's gzipped Undetermined "
+            "FASTQ file found under an Illumina run folder"
+        )
+    )
+    p.add_argument("run_dir", help="Illumina run folder")
+    p.add_argument("comment", help="Comment (free text)")
+    p.add_argument(
+        "--workers", type=int, default=8, help="Number of files to read at once"
+    )
+    args = p.parse_args(argv)
+
+    fps = sorted(str(fp) for fp in Path(args.run_dir).rglob(UNDETERMINED_PATTERN))
+
+    registry = SampleRegistry(session)
+    ensure_schema(registry.session.get_bind())
+    # Each file's data URI is its path, so registered files needn't be read
+    registered = registry.resolve_data_uris(fps)
+    for fp in fps:
+        if fp in registered:
+            out.write("Skipping {0}, already registered\n".format(fp))
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        headers = list(
+            executor.map(
+                _read_illumina_file, [fp for fp in fps if fp not in registered]
+            )
+        )
+
+    accs = []
+    for run_date, machine_type, lane, data_uri in headers:
+        acc = registry.register_run(
+            run_date, machine_type, "Nextera XT", lane, data_uri, args.comment
+        )
+        accs.append(acc)
+        out.write("Registered run {0} for {1}\n".format(acc, data_uri))
+
+    registry.session.commit()
+    out.write("Registered {0} runs in the database\n".format(len(accs)))
+
+
+def index_data_uris(argv=None, session: Session = None, out=sys.stdout):
+    p = argparse.ArgumentParser(
+        description=(
+            "Index the path components of run data URIs registered before "
+            "the index existed"
+        )
+    )
+    p.parse_args(argv)
+
+    registry = SampleRegistry(session)
+    ensure_schema(registry.session.get_bind())
+    n = registry.index_run_paths()
+
+    registry.session.commit()
+    out.write("Indexed data URIs for {0} runs\n".format(n))
+
+
 def register_run(argv=None, session: Session = None, out=sys.stdout):
     p = argparse.ArgumentParser(description="Add a new run to the registry")
     p.add_argument("file", help="Resource filepath (not checked)")
@@ -124,6 +213,7 @@ def register_run(argv=None, session: Session = None, out=sys.stdout):
     args = p.parse_args(argv)
 
     registry = SampleRegistry(session)
+    ensure_schema(registry.session.get_bind())
     acc = registry.register_run(
         args.date, args.type, "Nextera XT", args.lane, args.file, args.comment
     )
@@ -149,6 +239,7 @@ def modify_run(argv=None, session: Session = None):
     args = p.parse_args(argv)
 
     registry = SampleRegistry(session)
+    ensure_schema(registry.session.get_bind())
     registry.check_run_accession(args.run_accession)
     registry.modify_run(
         run_accession=args.run_accession,
@@ -190,6 +281,32 @@ def modify_sample(argv=None, session: Session = None):
     registry.session.commit()
 
 
+PATCH_TABLE_HELP = """\
+Patch table in tab-separated values (TSV) format, with one change per
+line: sample accession, field and value.  Fields that name a sample
+column or standard tag (e.g. subject_id or SubjectID) update the sample;
+any other field is an annotation key, added if the sample doesn't have it.
+"""
+
+
+def patch_samples(argv=None, session: Session = None, out=sys.stdout):
+    p = argparse.ArgumentParser(
+        description="Update sample fields and annotations from a patch table"
+    )
+    p.add_argument("patch_table", type=argparse.FileType("r"), help=PATCH_TABLE_HELP)
+    args = p.parse_args(argv)
+
+    registry = SampleRegistry(session)
+    counts = registry.apply_patches(load_patch_table(args.patch_table))
+
+    registry.session.commit()
+    out.write(
+        "Inserted {inserted}, updated {updated}, unchanged {unchanged}\n".format(
+            **counts
+        )
+    )
+
+
 def modify_annotation(argv=None, session: Session = None):
     p = argparse.ArgumentParser(
         description="Modify an existing annotation in the registry"
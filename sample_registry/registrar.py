@@ -1,10 +1,56 @@
+import itertools
+import posixpath
+from datetime import datetime, timedelta
 from typing import Optional
-from sqlalchemy import and_, create_engine, delete, insert, select, update
+from sqlalchemy import (
+    and_,
+    bindparam,
+    create_engine,
+    delete,
+    insert,
+    or_,
+    select,
+    tuple_,
+    update,
+)
 from sqlalchemy.orm import Session, sessionmaker
-from sample_registry.db import STANDARD_TAGS
+from sample_registry.db import (
+    STANDARD_TAGS,
+    run_to_dict,
+    sample_filters,
+    sample_to_dict,
+)
 from sample_registry.mapping import SampleTable
-from sample_registry.models import Annotation, Sample, Run
+from sample_registry.models import (
+    Annotation,
+    ArchiveStatus,
+    IdempotencyKey,
+    ReadCount,
+    RegistrationJob,
+    RunChecksum,
+    RunPath,
+    Sample,
+    Run,
+)
 from sample_registry.standards import MACHINE_TYPE_MAPPINGS
+from sample_registry.bulk import chunks, delete_in, insert_rows, scalars_in, select_in
+from sample_registry.util import parse_accession, split_data_uri
+
+# Sample columns that can be set from a patch table
+SAMPLE_PATCH_COLUMNS = {
+    "sample_name": Sample.sample_name,
+    "barcode_sequence": Sample.barcode_sequence,
+    "primer_sequence": Sample.primer_sequence,
+    "sample_type": Sample.sample_type,
+    "subject_id": Sample.subject_id,
+    "host_species": Sample.host_species,
+}
+
+
+def _prefix_upper_bound(prefix: str) -> str:
+    # Smallest string greater than every string starting with prefix, in
+    # code point order
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
 
 
 class SampleRegistry:
@@ -38,6 +84,20 @@ class SampleRegistry:
         if not sample:
             raise ValueError("Sample does not exist %s" % acc)
         return sample
+
+    def check_sample_accessions(self, accs: list[int]):
+        """Raise ``ValueError`` unless every sample in ``accs`` exists."""
+        found = set(
+            scalars_in(
+                self.session,
+                select(Sample.sample_accession),
+                Sample.sample_accession,
+                accs,
+            )
+        )
+        missing = sorted(set(accs) - found)
+        if missing:
+            raise ValueError("Samples do not exist %s" % missing)
 
     def get_run(self, run_accession: int) -> Run | None:
         """Return the ``Run`` record for ``run_accession``.
@@ -57,9 +117,87 @@ class SampleRegistry:
             select(Run).where(Run.run_accession == run_accession)
         )
 
+    def resolve_many(self, accessions: list[str]) -> dict:
+        """Look up many formatted run and sample accessions at once.
+
+        Samples, their annotations and every run referenced either directly
+        or through a sample are fetched in chunked ``IN`` queries, so the
+        number of queries grows with the database's parameter limit rather
+        than with the number of accessions.
+
+        Parameters
+        ----------
+        accessions:
+            Accessions like ``CMS000123`` or ``CMR000007``.
+
+        Returns
+        -------
+        dict
+            ``runs`` and ``samples`` map formatted accessions to their
+            records, samples including their annotations. ``not_found``
+            lists well-formed accessions with no record and ``invalid``
+            lists strings that are not accessions, both in input order.
+        """
+        run_accs = {}
+        sample_accs = {}
+        invalid = []
+        for acc in dict.fromkeys(accessions):
+            try:
+                kind, n = parse_accession(acc)
+            except ValueError:
+                invalid.append(acc)
+                continue
+            (run_accs if kind == "run" else sample_accs)[acc] = n
+
+        samples = {
+            s.sample_accession: s
+            for s in scalars_in(
+                self.session,
+                select(Sample),
+                Sample.sample_accession,
+                sample_accs.values(),
+            )
+        }
+        annotations = self._get_annotations_by_sample(samples.keys())
+
+        wanted_runs = set(run_accs.values())
+        wanted_runs.update(s.run_accession for s in samples.values())
+        runs = {
+            r.run_accession: r
+            for r in scalars_in(
+                self.session, select(Run), Run.run_accession, wanted_runs
+            )
+        }
+
+        not_found = [
+            acc
+            for acc in dict.fromkeys(accessions)
+            if (acc in run_accs and run_accs[acc] not in runs)
+            or (acc in sample_accs and sample_accs[acc] not in samples)
+        ]
+        return {
+            "runs": {
+                "CMR{:06d}".format(n): run_to_dict(r) for n, r in sorted(runs.items())
+            },
+            "samples": {
+                "CMS{:06d}".format(n): sample_to_dict(s, annotations.get(n, []))
+                for n, s in sorted(samples.items())
+            },
+            "not_found": not_found,
+            "invalid": invalid,
+        }
+
     def get_runs_by_data_uri(self, substring: str) -> list[int]:
         """Return run accessions whose ``data_uri`` contains ``substring``.
 
+        A substring that starts a data URI, or that ends with a whole file
+        name or run folder name, is answered from indexes, and any runs
+        found that way are returned without scanning the runs table. So a
+        run that contains such a substring only elsewhere in its data URI,
+        like ``raw_data`` in ``copies/raw_data/...``, is left out. Any
+        other substring falls back to a scan. Use ``resolve_data_uris`` to
+        look up many paths at once.
+
         Parameters
         ----------
         substring:
@@ -71,6 +209,32 @@ class SampleRegistry:
             Run accessions ordered ascending for runs whose ``data_uri``
             contains ``substring``.
         """
+        if not substring:
+            # Every data_uri contains the empty string
+            return list(
+                self.session.scalars(
+                    select(Run.run_accession).order_by(Run.run_accession)
+                ).all()
+            )
+
+        runs = set(self.resolve_data_uris([substring], "prefix").get(substring, []))
+        component = posixpath.basename(substring.rstrip("/"))
+        if component:
+            runs.update(
+                self.session.scalars(
+                    select(RunPath.run_accession)
+                    .join(Run, Run.run_accession == RunPath.run_accession)
+                    .where(
+                        or_(
+                            RunPath.file_name == component,
+                            RunPath.run_folder == component,
+                        ),
+                        Run.data_uri.contains(substring),
+                    )
+                )
+            )
+        if runs:
+            return sorted(runs)
 
         return list(
             self.session.scalars(
@@ -80,6 +244,125 @@ class SampleRegistry:
             ).all()
         )
 
+    def resolve_data_uris(
+        self, paths: list[str], match: str = "exact"
+    ) -> dict[str, list[int]]:
+        """Return run accessions for each of ``paths`` in as few queries as possible.
+
+        Parameters
+        ----------
+        paths:
+            Data URIs or path components to look up.
+        match:
+            ``"exact"`` matches whole data URIs, ``"prefix"`` matches data
+            URIs starting with the path, ``"file_name"`` matches the file
+            name of each path and ``"run_folder"`` matches the Illumina run
+            folder name.
+
+        Returns
+        -------
+        dict[str, list[int]]
+            Run accessions ordered ascending, keyed by path. Paths with no
+            registered run are left out.
+        """
+        paths = [p for p in dict.fromkeys(paths) if p]
+        if not paths:
+            return {}
+
+        params_per_value = 1
+        if match == "exact":
+            column, accession = Run.data_uri, Run.run_accession
+            keys = {p: [p] for p in paths}
+            condition = column.in_
+        elif match in ("file_name", "run_folder"):
+            column, accession = getattr(RunPath, match), RunPath.run_accession
+            keys = {}
+            for p in paths:
+                keys.setdefault(posixpath.basename(p.rstrip("/")), []).append(p)
+            condition = column.in_
+        elif match == "prefix":
+            column, accession = Run.data_uri, Run.run_accession
+            keys = {p: None for p in paths}
+            if self.session.get_bind().dialect.name == "sqlite":
+                # SQLite compares text in code point order, so a range finds
+                # every prefix match and uses the data_uri index, unlike LIKE,
+                # which is case-insensitive there
+                params_per_value = 2
+
+                def condition(chunk):
+                    return or_(
+                        *[
+                            and_(column >= p, column < _prefix_upper_bound(p))
+                            for p in chunk
+                        ]
+                    )
+
+            else:
+                # Other collations may not sort by code point, so a range
+                # could miss matches; Postgres has a pattern index for this
+                def condition(chunk):
+                    return or_(*[column.startswith(p, autoescape=True) for p in chunk])
+
+        else:
+            raise ValueError("Unknown match type: %s" % match)
+
+        found = []
+        for chunk in chunks(self.session, keys, params_per_value):
+            found += self.session.execute(
+                select(column, accession).where(condition(chunk))
+            )
+        runs = {}
+        for value, run_accession in sorted(found, key=lambda r: r[1]):
+            if match == "prefix":
+                matched = [p for p in paths if value.startswith(p)]
+            else:
+                matched = keys[value]
+            for p in matched:
+                runs.setdefault(p, []).append(run_accession)
+        return runs
+
+    def get_runs_by_run_folder(
+        self, run_folder: str, lane: Optional[int] = None
+    ) -> list[int]:
+        """Return run accessions for an Illumina run folder, optionally one lane.
+
+        The lane is the one in each data URI's file name, as in ``_L001_``.
+        """
+        stmt = select(RunPath.run_accession).where(RunPath.run_folder == run_folder)
+        if lane is not None:
+            stmt = stmt.where(RunPath.lane == lane)
+        return list(self.session.scalars(stmt.order_by(RunPath.run_accession)).all())
+
+    def index_run_paths(self) -> int:
+        """Fill in ``run_paths`` for runs registered before it existed.
+
+        Returns
+        -------
+        int
+            Number of runs indexed.
+        """
+        runs = self.session.execute(
+            select(Run.run_accession, Run.data_uri)
+            .outerjoin(RunPath, RunPath.run_accession == Run.run_accession)
+            .where(RunPath.run_accession.is_(None))
+        ).all()
+        insert_rows(
+            self.session,
+            RunPath,
+            [dict(split_data_uri(uri), run_accession=acc) for acc, uri in runs],
+        )
+        return len(runs)
+
+    def _set_run_path(self, run_accession: int, data_uri: str):
+        self.session.execute(
+            delete(RunPath).where(RunPath.run_accession == run_accession)
+        )
+        self.session.execute(
+            insert(RunPath).values(
+                dict(split_data_uri(data_uri), run_accession=run_accession)
+            )
+        )
+
     def get_samples(self, run_accession: int) -> list[Sample]:
         """Return the list of ``Sample`` records for ``run_accession``.
 
@@ -94,6 +377,57 @@ class SampleRegistry:
             ).all()
         )
 
+    def get_sample_page(
+        self, after: int = 0, limit: int = 1000, **filters
+    ) -> list[dict]:
+        """Return one page of samples with their annotations.
+
+        Pages are keyed on ``sample_accession``: pass the last accession of
+        one page as ``after`` to get the next. Each page costs the same
+        regardless of how deep into the registry it is.
+
+        Parameters
+        ----------
+        after:
+            Only samples with a greater accession number are returned.
+        limit:
+            Maximum number of samples on the page.
+        filters:
+            Keyword arguments for ``sample_filters``.
+
+        Returns
+        -------
+        list[dict]
+            Samples in accession order, as produced by ``sample_to_dict``.
+        """
+        samples = list(
+            self.session.scalars(
+                select(Sample)
+                .where(Sample.sample_accession > after, *sample_filters(**filters))
+                .order_by(Sample.sample_accession)
+                .limit(limit)
+            )
+        )
+        annotations = self._get_annotations_by_sample(
+            [s.sample_accession for s in samples]
+        )
+        return [
+            sample_to_dict(s, annotations.get(s.sample_accession, [])) for s in samples
+        ]
+
+    def _get_annotations_by_sample(
+        self, sample_accessions
+    ) -> dict[int, list[Annotation]]:
+        annotations = {}
+        for a in scalars_in(
+            self.session,
+            select(Annotation).order_by(Annotation.sample_accession, Annotation.key),
+            Annotation.sample_accession,
+            sample_accessions,
+        ):
+            annotations.setdefault(a.sample_accession, []).append(a)
+        return annotations
+
     def get_annotations(self, sample_accession: int) -> list[Annotation]:
         return list(
             self.session.scalars(
@@ -103,6 +437,223 @@ class SampleRegistry:
             ).all()
         )
 
+    def get_read_counts(self, run_accession: int) -> dict[int, ReadCount]:
+        """Return stored read counts for the samples in ``run_accession``.
+
+        Returns
+        -------
+        dict[int, ReadCount]
+            Read counts keyed by sample accession. Samples that have not
+            been counted are missing from the result.
+        """
+        return {
+            rc.sample_accession: rc
+            for rc in self.session.scalars(
+                select(ReadCount)
+                .join(Sample, ReadCount.sample_accession == Sample.sample_accession)
+                .where(Sample.run_accession == run_accession)
+            )
+        }
+
+    def register_read_counts(self, counts: dict[int, tuple[int, int]]):
+        """Replace read counts for samples.
+
+        Parameters
+        ----------
+        counts:
+            Mapping of sample accession to ``(exact_reads, mismatch_reads)``.
+        """
+        delete_in(
+            self.session, delete(ReadCount), ReadCount.sample_accession, counts.keys()
+        )
+        insert_rows(
+            self.session,
+            ReadCount,
+            [
+                {"sample_accession": a, "exact_reads": e, "mismatch_reads": m}
+                for a, (e, m) in counts.items()
+            ],
+        )
+
+    def get_archive_status(self) -> dict[int, ArchiveStatus]:
+        """Return the last recorded archive check for each run."""
+        return {s.run_accession: s for s in self.session.scalars(select(ArchiveStatus))}
+
+    def get_stale_archive_runs(self, checked_before: datetime) -> list[Run]:
+        """Return runs whose data file needs to be checked again.
+
+        A run is stale if it has never been checked, was last checked
+        before ``checked_before``, or its ``data_uri`` changed since.
+        """
+        return list(
+            self.session.scalars(
+                select(Run)
+                .outerjoin(
+                    ArchiveStatus, ArchiveStatus.run_accession == Run.run_accession
+                )
+                .where(
+                    or_(
+                        ArchiveStatus.run_accession.is_(None),
+                        ArchiveStatus.checked_at < checked_before,
+                        ArchiveStatus.data_uri != Run.data_uri,
+                    )
+                )
+                .order_by(Run.run_accession)
+            ).all()
+        )
+
+    def register_archive_status(self, statuses: list[dict]):
+        """Replace archive check results.
+
+        Parameters
+        ----------
+        statuses:
+            Dicts with the ``ArchiveStatus`` columns, one per run.
+        """
+        delete_in(
+            self.session,
+            delete(ArchiveStatus),
+            ArchiveStatus.run_accession,
+            [s["run_accession"] for s in statuses],
+        )
+        insert_rows(self.session, ArchiveStatus, statuses)
+
+    def get_checksums(self) -> dict[int, RunChecksum]:
+        """Return the stored data file checksum for each run."""
+        return {c.run_accession: c for c in self.session.scalars(select(RunChecksum))}
+
+    def register_checksums(self, checksums: list[dict]):
+        """Replace data file checksums.
+
+        Parameters
+        ----------
+        checksums:
+            Dicts with the ``RunChecksum`` columns, one per run.
+        """
+        delete_in(
+            self.session,
+            delete(RunChecksum),
+            RunChecksum.run_accession,
+            [c["run_accession"] for c in checksums],
+        )
+        insert_rows(self.session, RunChecksum, checksums)
+
+    def reserve_idempotency_key(
+        self, key: str, fingerprint: str, lease: timedelta
+    ) -> IdempotencyKey | None:
+        """Claim ``key`` for a new request, or return the one that already has it.
+
+        Expired keys are removed first, so a key can be reused once it has
+        passed its expiry. A claimed key has no response until
+        ``save_idempotent_response`` is called and expires after ``lease``,
+        so a claim left behind by a request that never finished can be
+        taken over by a retry.
+        """
+        now = datetime.now()
+        self.session.execute(
+            delete(IdempotencyKey).where(IdempotencyKey.expires_at < now)
+        )
+        existing = self.session.get(IdempotencyKey, key)
+        if existing is not None:
+            return existing
+        self.session.add(
+            IdempotencyKey(
+                key=key,
+                fingerprint=fingerprint,
+                created_at=now,
+                expires_at=now + lease,
+            )
+        )
+        self.session.flush()
+        return None
+
+    def save_idempotent_response(
+        self, key: str, status_code: int, response: str, ttl: timedelta
+    ):
+        """Store the response for a claimed key and keep it for ``ttl``."""
+        self.session.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.key == key)
+            .values(
+                status_code=status_code,
+                response=response,
+                expires_at=datetime.now() + ttl,
+            )
+        )
+
+    def release_idempotency_key(self, key: str):
+        """Remove a claim on ``key``, leaving any stored response in place."""
+        self.session.execute(
+            delete(IdempotencyKey).where(
+                IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None)
+            )
+        )
+
+    def create_job(
+        self, operation: str, request: str, run_accession: Optional[int] = None
+    ) -> int:
+        """Queue a registration job and return its ID.
+
+        ``request`` holds the operation's fields as JSON.
+        """
+        job = RegistrationJob(
+            operation=operation,
+            status="queued",
+            request=request,
+            run_accession=run_accession,
+            created_at=datetime.now(),
+        )
+        self.session.add(job)
+        self.session.flush()
+        return job.job_id
+
+    def claim_next_job(self, lease: timedelta) -> RegistrationJob | None:
+        """Mark the oldest claimable job as running and return it.
+
+        A job is claimable while it's queued, or once it's running but its
+        worker hasn't renewed its lease for longer than ``lease``, so a job
+        left behind by a process that died is picked up again. The job is claimed with a conditional
+        UPDATE, so when several processes look for work each job is only
+        run by one of them.
+        """
+        while True:
+            now = datetime.now()
+            claimable = or_(
+                RegistrationJob.status == "queued",
+                and_(
+                    RegistrationJob.status == "running",
+                    RegistrationJob.heartbeat_at < now - lease,
+                ),
+            )
+            job_id = self.session.scalar(
+                select(RegistrationJob.job_id)
+                .where(claimable)
+                .order_by(RegistrationJob.job_id)
+                .limit(1)
+            )
+            if job_id is None:
+                return None
+            claimed = self.session.execute(
+                update(RegistrationJob)
+                .where(RegistrationJob.job_id == job_id, claimable)
+                .values(
+                    status="running", stage="parsing", started_at=now, heartbeat_at=now
+                )
+            ).rowcount
+            if claimed:
+                return self.session.get(RegistrationJob, job_id)
+
+    def update_job(self, job_id: int, claim: datetime | None = None, **kwargs) -> bool:
+        """Update a job's columns, returning whether it was updated.
+
+        With ``claim``, the ``started_at`` of the claim being run, the job
+        is only updated while no other worker has taken it over.
+        """
+        stmt = update(RegistrationJob).where(RegistrationJob.job_id == job_id)
+        if claim is not None:
+            stmt = stmt.where(RegistrationJob.started_at == claim)
+        return bool(self.session.execute(stmt.values(**kwargs)).rowcount)
+
     def register_run(
         self,
         run_date: str,
@@ -117,7 +668,7 @@ class SampleRegistry:
             select(Run.run_accession).order_by(Run.run_accession.desc()).limit(1)
         )
 
-        return self.session.scalar(
+        run_accession = self.session.scalar(
             insert(Run)
             .returning(Run.run_accession)
             .values(
@@ -132,12 +683,16 @@ class SampleRegistry:
                 }
             )
         )
+        self._set_run_path(run_accession, data_uri)
+        return run_accession
 
     def modify_run(self, run_accession: int, **kwargs):
         kwargs = {k: v for k, v in kwargs.items() if v is not None}
         self.session.execute(
             update(Run).where(Run.run_accession == run_accession).values(**kwargs)
         )
+        if "data_uri" in kwargs:
+            self._set_run_path(run_accession, kwargs["data_uri"])
 
     def check_samples(self, run_accession: int, exists: bool = True) -> list[Sample]:
         samples = self.session.scalars(
@@ -151,20 +706,19 @@ class SampleRegistry:
     def register_samples(
         self, run_accession: int, sample_table: SampleTable
     ) -> list[int]:
-        sample_tups = [
-            (sample_name, barcode_sequence)
-            for sample_name, barcode_sequence in sample_table.core_info
-        ]
-        if self.session.scalars(
-            select(Sample).where(
-                and_(
-                    Sample.run_accession == run_accession,
-                    Sample.sample_name.in_([s[0] for s in sample_tups]),
-                    Sample.barcode_sequence.in_([s[1] for s in sample_tups]),
-                )
+        sample_tups = list(sample_table.core_info)
+        names = {s[0] for s in sample_tups}
+        barcodes = {s[1] for s in sample_tups}
+        # Compared here rather than with IN lists, which can be too long
+        for name, barcode in self.session.execute(
+            select(Sample.sample_name, Sample.barcode_sequence).where(
+                Sample.run_accession == run_accession
             )
-        ).first():
-            raise ValueError("Samples already registered for run %s" % run_accession)
+        ):
+            if name in names and barcode in barcodes:
+                raise ValueError(
+                    "Samples already registered for run %s" % run_accession
+                )
 
         # Using this because there are situations where the autoincrement is untrustworthy
         max_sample_accession = self.session.scalar(
@@ -173,27 +727,22 @@ class SampleRegistry:
             .limit(1)
         )
 
-        return self.session.scalars(
-            insert(Sample)
-            .returning(Sample.sample_accession)
-            .values(
-                [
-                    {
-                        "sample_accession": (
-                            max_sample_accession + i + 1
-                            if max_sample_accession
-                            else i + 1
-                        ),
-                        "run_accession": run_accession,
-                        "sample_name": sample_name,
-                        "barcode_sequence": barcode_sequence,
-                    }
-                    for i, (sample_name, barcode_sequence) in enumerate(
-                        sample_table.core_info
-                    )
-                ]
-            )
+        first_accession = (max_sample_accession or 0) + 1
+        accessions = list(range(first_accession, first_accession + len(sample_tups)))
+        insert_rows(
+            self.session,
+            Sample,
+            [
+                {
+                    "sample_accession": acc,
+                    "run_accession": run_accession,
+                    "sample_name": sample_name,
+                    "barcode_sequence": barcode_sequence,
+                }
+                for acc, (sample_name, barcode_sequence) in zip(accessions, sample_tups)
+            ],
         )
+        return accessions
 
     def modify_sample(self, sample_accession: int, **kwargs):
         kwargs = {k: v for k, v in kwargs.items() if v is not None}
@@ -203,13 +752,32 @@ class SampleRegistry:
             .values(**kwargs)
         )
 
+    def modify_samples(self, updates: list[dict]):
+        """Apply ``modify_sample`` to many samples in bulk.
+
+        Parameters
+        ----------
+        updates:
+            Dicts with a ``sample_accession`` and the fields to change.
+            Fields set to ``None`` are left as they are.
+        """
+        rows = [{k: v for k, v in u.items() if v is not None} for u in updates]
+        rows = [r for r in rows if len(r) > 1]
+        if rows:
+            self.session.execute(update(Sample), rows)
+
     def remove_samples(self, run_accession: int) -> list[int]:
         samples = self.session.scalars(
             select(Sample.sample_accession).where(Sample.run_accession == run_accession)
         ).all()
-        self.session.execute(
-            delete(Annotation).where(Annotation.sample_accession.in_(samples))
+        run_samples = select(Sample.sample_accession).where(
+            Sample.run_accession == run_accession
         )
+        # Rows that refer to the samples go first, for the foreign keys
+        for model in (Annotation, ReadCount):
+            self.session.execute(
+                delete(model).where(model.sample_accession.in_(run_samples))
+            )
         self.session.execute(
             delete(Sample).where(Sample.run_accession == run_accession)
         )
@@ -222,69 +790,261 @@ class SampleRegistry:
         accessions = self._get_sample_accessions(run_accession, sample_table)
 
         # Remove existing annotations
-        self.session.execute(
-            delete(Annotation).where(Annotation.sample_accession.in_(accessions))
-        )
-        self.session.execute(
-            update(Sample)
-            .where(Sample.sample_accession.in_(accessions))
-            .values({k: None for k in STANDARD_TAGS.values()})
+        delete_in(
+            self.session, delete(Annotation), Annotation.sample_accession, accessions
         )
 
-        # Register new annotations
-        standard_annotation_args = []
+        # Register new annotations. Standard tags are set, or cleared, for
+        # every sample with one executemany UPDATE.
+        sample_updates = []
         annotation_args = []
         for a, pairs in zip(accessions, sample_table.annotations):
+            standard = dict.fromkeys(STANDARD_TAGS.values())
             for k, v in pairs:
                 if k in STANDARD_TAGS:
-                    standard_annotation_args.append((a, STANDARD_TAGS[k], v))
+                    standard[STANDARD_TAGS[k]] = v
                 else:
                     annotation_args.append((a, k, v))
+            sample_updates.append(dict(standard, sample_accession=a))
+        if sample_updates:
+            self.session.execute(update(Sample), sample_updates)
 
-        for a, k, v in standard_annotation_args:
-            self.session.execute(
-                update(Sample).where(Sample.sample_accession == a).values({k: v})
+        annotation_keys = insert_rows(
+            self.session,
+            Annotation,
+            [
+                {"sample_accession": a, "key": k, "val": v}
+                for a, k, v in annotation_args
+            ],
+            returning=[Annotation.sample_accession, Annotation.key],
+        )
+
+        return [tuple(r) for r in annotation_keys]
+
+    def sync_annotations(
+        self, run_accession: int, sample_table: SampleTable
+    ) -> dict[str, int]:
+        """Bring sample annotations in line with ``sample_table``, writing only changes.
+
+        The end state is the same as ``register_annotations``, but current
+        values are loaded first and compared in memory, so re-registering a
+        sheet with one changed cell writes one value instead of deleting
+        and reinserting every annotation for the run.
+
+        Returns
+        -------
+        dict[str, int]
+            Number of values ``inserted``, ``updated``, ``deleted`` and
+            ``unchanged``. Standard tags count as updated when set or
+            changed and as deleted when cleared.
+        """
+        columns = list(STANDARD_TAGS.values())
+        samples = {
+            (s.sample_name, s.barcode_sequence): s
+            for s in self.session.execute(
+                select(
+                    Sample.sample_accession,
+                    Sample.sample_name,
+                    Sample.barcode_sequence,
+                    *[getattr(Sample, c) for c in columns],
+                ).where(Sample.run_accession == run_accession)
             )
+        }
+        unaccessioned_recs = [
+            rec
+            for rec, core in zip(sample_table.recs, sample_table.core_info)
+            if core not in samples
+        ]
+        if unaccessioned_recs:
+            raise IOError("Not accessioned: %s" % unaccessioned_recs)
 
-        annotation_keys = []
-        if annotation_args:
-            annotation_keys = self.session.scalars(
-                insert(Annotation)
-                .returning(Annotation.sample_accession, Annotation.key)
-                .values(
-                    [
-                        {"sample_accession": a, "key": k, "val": v}
-                        for a, k, v in annotation_args
-                    ]
+        matched = [samples[core] for core in sample_table.core_info]
+        current = self._get_annotations_by_sample([s.sample_accession for s in matched])
+        counts = {"inserted": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+        sample_updates = []
+        inserts = []
+        updates = []
+        deletes = []
+        for sample, pairs in zip(matched, sample_table.annotations):
+            acc = sample.sample_accession
+            wanted_columns = dict.fromkeys(columns)
+            wanted = {}
+            for k, v in pairs:
+                if k in STANDARD_TAGS:
+                    wanted_columns[STANDARD_TAGS[k]] = v
+                else:
+                    wanted[k] = v
+
+            changed = {}
+            for c, v in wanted_columns.items():
+                if getattr(sample, c) == v:
+                    counts["unchanged"] += v is not None
+                else:
+                    changed[c] = v
+                    counts["deleted" if v is None else "updated"] += 1
+            if changed:
+                sample_updates.append(dict(changed, sample_accession=acc))
+
+            have = {a.key: a.val for a in current.get(acc, [])}
+            for k, v in wanted.items():
+                row = {"sample_accession": acc, "key": k, "val": v}
+                if k not in have:
+                    inserts.append(row)
+                elif have[k] != v:
+                    updates.append(row)
+                else:
+                    counts["unchanged"] += 1
+            deletes += [(acc, k) for k in have if k not in wanted]
+        counts["inserted"] += len(inserts)
+        counts["updated"] += len(updates)
+        counts["deleted"] += len(deletes)
+
+        if sample_updates:
+            self.session.execute(update(Sample), sample_updates)
+        if updates:
+            self.session.execute(update(Annotation), updates)
+        for chunk in chunks(self.session, deletes, 2):
+            self.session.execute(
+                delete(Annotation).where(
+                    tuple_(Annotation.sample_accession, Annotation.key).in_(chunk)
                 )
             )
-
-        return list(annotation_keys)
+        insert_rows(self.session, Annotation, inserts)
+        return counts
 
     def _get_sample_accessions(
         self, run_accession: int, sample_table: SampleTable
     ) -> list[int]:
-        sample_tups = [
-            (sample_name, barcode_sequence)
-            for sample_name, barcode_sequence in sample_table.core_info
-        ]
-        accessions = self.session.scalars(
-            select(Sample.sample_accession).where(
-                and_(
-                    Sample.run_accession == run_accession,
-                    Sample.sample_name.in_([s[0] for s in sample_tups]),
-                    Sample.barcode_sequence.in_([s[1] for s in sample_tups]),
-                )
+        """Return the accession for each record in ``sample_table``, in order."""
+        accessions = {
+            (name, barcode): acc
+            for acc, name, barcode in self.session.execute(
+                select(
+                    Sample.sample_accession,
+                    Sample.sample_name,
+                    Sample.barcode_sequence,
+                ).where(Sample.run_accession == run_accession)
             )
-        ).all()
+        }
 
         unaccessioned_recs = []
-        for accession, rec in zip(accessions, sample_table.recs):
-            if accession is None:
+        for core, rec in zip(sample_table.core_info, sample_table.recs):
+            if core not in accessions:
                 unaccessioned_recs.append(rec)
         if unaccessioned_recs:
             raise IOError("Not accessioned: %s" % unaccessioned_recs)
-        return list(accessions)
+        return [accessions[core] for core in sample_table.core_info]
+
+    def modify_annotations(self, updates: list[dict]):
+        """Apply ``modify_annotation`` to many annotations in bulk.
+
+        Parameters
+        ----------
+        updates:
+            Dicts with ``sample_accession``, ``key`` and the new ``val``.
+            Annotations that don't exist are left alone.
+        """
+        if not updates:
+            return
+        # A Core executemany, as the ORM's bulk update by primary key raises
+        # when a row it expects to update isn't there
+        self.session.execute(
+            update(Annotation.__table__)
+            .where(
+                Annotation.sample_accession == bindparam("b_sample_accession"),
+                Annotation.key == bindparam("b_key"),
+            )
+            .values(val=bindparam("b_val")),
+            [
+                {"b_" + k: u[k] for k in ("sample_accession", "key", "val")}
+                for u in updates
+            ],
+        )
+
+    def apply_patches(self, patches: list[tuple[int, str, str]]) -> dict[str, int]:
+        """Set fields of many samples, inserting annotations that are missing.
+
+        A field that names a sample column (``subject_id``) or a standard
+        tag (``SubjectID``) updates the sample. Any other field is an
+        annotation key. Current values are read and new values written in
+        chunks with set-based statements, and values that are already
+        correct are not written. When a sample and field appear more than
+        once, the last value wins.
+
+        Parameters
+        ----------
+        patches:
+            ``(sample_accession, field, value)`` triples.
+
+        Returns
+        -------
+        dict[str, int]
+            Number of values ``inserted``, ``updated`` and ``unchanged``.
+        """
+        sample_patches = {}
+        annotation_patches = {}
+        for acc, field, val in patches:
+            column = STANDARD_TAGS.get(field, field)
+            if column in SAMPLE_PATCH_COLUMNS:
+                sample_patches[(acc, column)] = val
+            else:
+                annotation_patches[(acc, field)] = val
+        self.check_sample_accessions(
+            [acc for acc, _ in itertools.chain(sample_patches, annotation_patches)]
+        )
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+
+        sample_updates = {}
+        for sample in select_in(
+            self.session,
+            select(Sample.sample_accession, *SAMPLE_PATCH_COLUMNS.values()),
+            Sample.sample_accession,
+            sorted({acc for acc, _ in sample_patches}),
+        ):
+            for column in SAMPLE_PATCH_COLUMNS:
+                key = (sample.sample_accession, column)
+                if key not in sample_patches:
+                    continue
+                if getattr(sample, column) == sample_patches[key]:
+                    counts["unchanged"] += 1
+                else:
+                    sample_updates.setdefault(
+                        sample.sample_accession,
+                        {"sample_accession": sample.sample_accession},
+                    )[column] = sample_patches[key]
+                    counts["updated"] += 1
+
+        current = {}
+        for chunk in chunks(self.session, annotation_patches, 2):
+            current.update(
+                ((a.sample_accession, a.key), a.val)
+                for a in self.session.execute(
+                    select(
+                        Annotation.sample_accession, Annotation.key, Annotation.val
+                    ).where(
+                        tuple_(Annotation.sample_accession, Annotation.key).in_(chunk)
+                    )
+                )
+            )
+        annotation_inserts = []
+        annotation_updates = []
+        for (acc, key), val in annotation_patches.items():
+            row = {"sample_accession": acc, "key": key, "val": val}
+            if (acc, key) not in current:
+                annotation_inserts.append(row)
+            elif current[(acc, key)] != val:
+                annotation_updates.append(row)
+            else:
+                counts["unchanged"] += 1
+        counts["inserted"] += len(annotation_inserts)
+        counts["updated"] += len(annotation_updates)
+
+        if sample_updates:
+            self.session.execute(update(Sample), list(sample_updates.values()))
+        if annotation_updates:
+            self.session.execute(update(Annotation), annotation_updates)
+        insert_rows(self.session, Annotation, annotation_inserts)
+        return counts
 
     def modify_annotation(self, sample_accession: int, key: str, val: str):
         self.session.execute(
@@ -0,0 +1,150 @@
+"""Record slow SQL statements with their query plans
+
+When ``SAMPLE_REGISTRY_SLOW_QUERY_MS`` is set, every statement that takes
+longer than that many milliseconds is written, with its parameters and the
+database's EXPLAIN output, as a JSON line to a rotating log file. The plan
+is captured straight away on the same connection, so it reflects the
+indexes and statistics the slow statement actually ran with.
+"""
+
+import json
+import logging
+import logging.handlers
+import os
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sample_registry import CACHE_DIR
+
+SLOW_QUERY_MS_ENV = "SAMPLE_REGISTRY_SLOW_QUERY_MS"
+SLOW_QUERY_LOG_ENV = "SAMPLE_REGISTRY_SLOW_QUERY_LOG"
+DEFAULT_LOG_PATH = CACHE_DIR / "slow_queries.log"
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+# Long parameter lists, e.g. from chunked IN filters, are cut to this many
+MAX_LOGGED_PARAMS = 50
+EXPLAIN_PREFIXES = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+    "postgresql": "EXPLAIN ",
+    "mysql": "EXPLAIN ",
+}
+# Statements whose plans show how rows are found; inserts are left out
+EXPLAINABLE = ("select", "with", "update", "delete")
+EXPLAIN_SAVEPOINT = "sample_registry_explain"
+
+
+def threshold_ms() -> float | None:
+    value = os.environ.get(SLOW_QUERY_MS_ENV)
+    return float(value) if value else None
+
+
+def log_path() -> Path:
+    return Path(os.environ.get(SLOW_QUERY_LOG_ENV, DEFAULT_LOG_PATH))
+
+
+def _short_params(parameters):
+    if isinstance(parameters, dict):
+        items = list(parameters.items())[:MAX_LOGGED_PARAMS]
+        return {k: repr(v) for k, v in items}
+    if isinstance(parameters, (list, tuple)):
+        return [repr(v) for v in parameters[:MAX_LOGGED_PARAMS]]
+    return repr(parameters)
+
+
+def explain(dbapi_connection, dialect_name: str, statement: str, parameters) -> list:
+    """Return the plan for ``statement`` as a list of rows of strings.
+
+    The raw DBAPI connection is used so the EXPLAIN isn't itself logged. It
+    runs in a savepoint, as on Postgres a failed statement would otherwise
+    abort the transaction the slow statement is part of.
+    """
+    prefix = EXPLAIN_PREFIXES.get(dialect_name)
+    if prefix is None or not statement.lstrip().lower().startswith(EXPLAINABLE):
+        return []
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"SAVEPOINT {EXPLAIN_SAVEPOINT}")
+        try:
+            cursor.execute(prefix + statement, parameters)
+            plan = [[str(v) for v in row] for row in cursor.fetchall()]
+        except Exception as exc:
+            cursor.execute(f"ROLLBACK TO SAVEPOINT {EXPLAIN_SAVEPOINT}")
+            plan = [[f"EXPLAIN failed: {exc}"]]
+        cursor.execute(f"RELEASE SAVEPOINT {EXPLAIN_SAVEPOINT}")
+        return plan
+    except Exception as exc:
+        return [[f"EXPLAIN failed: {exc}"]]
+    finally:
+        cursor.close()
+
+
+class SlowQueryRecorder:
+    """Engine event listeners that log statements over ``threshold_ms``."""
+
+    def __init__(self, threshold_ms: float, path: Path):
+        self.threshold = threshold_ms / 1000
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            self.path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        # Kept out of the logging hierarchy so records only go to this file
+        self.logger = logging.Logger(__name__)
+        self.logger.addHandler(handler)
+
+    def before_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("slowlog_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        seconds = time.perf_counter() - conn.info["slowlog_start"].pop()
+        if seconds < self.threshold:
+            return
+        if executemany:
+            # The plan is the same for every parameter set
+            parameters = parameters[0] if parameters else ()
+        plan = explain(
+            conn.connection.dbapi_connection, conn.dialect.name, statement, parameters
+        )
+        record = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "duration_ms": round(seconds * 1000, 2),
+            "statement": statement,
+            "parameters": _short_params(parameters),
+            "executemany": executemany,
+            "plan": plan,
+        }
+        self.logger.warning(json.dumps(record))
+
+
+def init_engines(engines: list[Engine], threshold_ms: float, path: Path):
+    """Log statements on ``engines`` that take longer than ``threshold_ms``."""
+    recorder = SlowQueryRecorder(threshold_ms, path)
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", recorder.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", recorder.after_cursor_execute)
+    return recorder
+
+
+def read_slow_queries(path: Path, limit: int = 100) -> list[dict]:
+    """Return the latest ``limit`` logged statements, newest first."""
+    path = Path(path)
+    files = [Path(f"{path}.{i}") for i in range(LOG_BACKUP_COUNT, 0, -1)] + [path]
+    records = deque(maxlen=limit)
+    for fp in files:
+        if not fp.exists():
+            continue
+        with open(fp) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return list(reversed(records))
@@ -0,0 +1,209 @@
+"""Draw fixed-size random samples of reads from run FASTQ files for QC"""
+
+import argparse
+import gzip
+import io
+import json
+import math
+import os
+import random
+import sys
+from pathlib import Path
+from typing import Iterable, Optional, TextIO
+from sqlalchemy.orm import Session
+from sample_registry import ARCHIVE_ROOT, CACHE_DIR
+from sample_registry.census import open_fastq
+from sample_registry.registrar import SampleRegistry
+from sample_registry.util import illumina_index, parse_fastq
+
+DEFAULT_SIZE = 5000
+DEFAULT_SEED = 42
+
+
+def _uniform(rng: random.Random) -> float:
+    # Open interval (0, 1), so the logarithms below are defined
+    u = rng.random()
+    while u == 0.0:
+        u = rng.random()
+    return u
+
+
+class Reservoir:
+    """Uniform random sample of fixed size from a stream of unknown length.
+
+    Uses Algorithm L (Li, 1994), which draws random numbers only when an
+    item is kept rather than for every item offered.
+    """
+
+    def __init__(self, size: int, rng: random.Random):
+        if size < 1:
+            raise ValueError("Reservoir size must be at least 1")
+        self.size = size
+        self.rng = rng
+        self.items = []
+        self.seen = 0
+        self._w = 1.0
+        self._next = 0
+
+    def _skip(self):
+        self._next += (
+            math.floor(math.log(_uniform(self.rng)) / math.log(1 - self._w)) + 1
+        )
+
+    def offer(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+            if len(self.items) == self.size:
+                self._w = math.exp(math.log(_uniform(self.rng)) / self.size)
+                self._next = self.seen
+                self._skip()
+        elif self.seen == self._next:
+            self.items[self.rng.randrange(self.size)] = item
+            self._w *= math.exp(math.log(_uniform(self.rng)) / self.size)
+            self._skip()
+
+
+def sample_reads(
+    f: TextIO,
+    size: int,
+    seed: int = DEFAULT_SEED,
+    barcodes: Optional[Iterable[str]] = None,
+) -> dict[Optional[str], Reservoir]:
+    """Sample reads from a FASTQ stream in one pass.
+
+    Without ``barcodes``, one reservoir holding up to ``size`` reads is
+    returned under the key ``None``. With ``barcodes``, each barcode gets
+    its own reservoir and reads with any other index go to the ``None``
+    reservoir, so memory stays bounded by the number of registered barcodes.
+    """
+    rng = random.Random(seed)
+    unassigned = Reservoir(size, rng)
+    reservoirs = {None: unassigned}
+    if barcodes is None:
+        for read in parse_fastq(f):
+            unassigned.offer(read)
+        return reservoirs
+
+    for b in barcodes:
+        reservoirs[b.upper()] = Reservoir(size, rng)
+    for read in parse_fastq(f):
+        reservoirs.get(illumina_index(read[0]).upper(), unassigned).offer(read)
+    return reservoirs
+
+
+def subsample_path(run_accession: int, cache_dir: str | Path = CACHE_DIR) -> Path:
+    return Path(cache_dir) / "subsamples" / "CMR{:06d}.fastq.gz".format(run_accession)
+
+
+def _info_path(run_accession: int, cache_dir: str | Path) -> Path:
+    return Path(cache_dir) / "subsamples" / "CMR{:06d}.json".format(run_accession)
+
+
+def subsample_info(
+    run_accession: int, cache_dir: str | Path = CACHE_DIR
+) -> Optional[dict]:
+    """Return details of the cached subsample for a run, if there is one."""
+    info_fp = _info_path(run_accession, cache_dir)
+    if not info_fp.exists():
+        return None
+    with open(info_fp) as f:
+        return json.load(f)
+
+
+def write_subsample(
+    registry: SampleRegistry,
+    run_accession: int,
+    size: int = DEFAULT_SIZE,
+    seed: int = DEFAULT_SEED,
+    by_barcode: bool = False,
+    archive_root: str | Path = ARCHIVE_ROOT,
+    cache_dir: str | Path = CACHE_DIR,
+) -> dict:
+    """Sample reads from a run's FASTQ and cache them by run accession.
+
+    The cached sample is reused as long as the source file and sampling
+    parameters are unchanged.
+    """
+    run = registry.check_run_accession(run_accession)
+    fp = Path(archive_root) / run.data_uri
+    stat = fp.stat()
+    params = {
+        "size": size,
+        "seed": seed,
+        "by_barcode": by_barcode,
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+    }
+    info = subsample_info(run_accession, cache_dir)
+    if info and all(info.get(k) == v for k, v in params.items()):
+        return info
+
+    barcodes = None
+    if by_barcode:
+        barcodes = {s.barcode_sequence for s in registry.get_samples(run_accession)}
+    with io.TextIOWrapper(open_fastq(fp), encoding="ascii") as f:
+        reservoirs = sample_reads(f, size, seed, barcodes)
+
+    out_fp = subsample_path(run_accession, cache_dir)
+    out_fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out_fp.with_name(out_fp.name + ".tmp")
+    with gzip.open(tmp, "wt") as out:
+        for reservoir in reservoirs.values():
+            for desc, seq, qual in reservoir.items:
+                out.write("@{0}\n{1}\n+\n{2}\n".format(desc, seq, qual))
+    os.replace(tmp, out_fp)
+
+    info = dict(
+        params,
+        run_accession=run_accession,
+        total_reads=sum(r.seen for r in reservoirs.values()),
+        sampled_reads=sum(len(r.items) for r in reservoirs.values()),
+        barcodes={k or "unassigned": len(r.items) for k, r in reservoirs.items()},
+    )
+    with open(_info_path(run_accession, cache_dir), "w") as f:
+        json.dump(info, f)
+    return info
+
+
+def subsample_run(argv=None, session: Session = None, out=sys.stdout):
+    p = argparse.ArgumentParser(
+        description="Cache a random sample of reads from a run's FASTQ for QC"
+    )
+    p.add_argument("run_accession", type=int, help="Run accession number")
+    p.add_argument(
+        "--size", type=int, default=DEFAULT_SIZE, help="Number of reads to sample"
+    )
+    p.add_argument("--seed", type=int, default=DEFAULT_SEED, help="Random seed")
+    p.add_argument(
+        "--by-barcode",
+        action="store_true",
+        help="Sample up to --size reads for each registered barcode",
+    )
+    p.add_argument(
+        "--archive-root",
+        default=str(ARCHIVE_ROOT),
+        help="Directory that run data URIs are relative to",
+    )
+    p.add_argument(
+        "--cache-dir", default=str(CACHE_DIR), help="Directory for cached samples"
+    )
+    args = p.parse_args(argv)
+
+    registry = SampleRegistry(session)
+    info = write_subsample(
+        registry,
+        args.run_accession,
+        args.size,
+        args.seed,
+        args.by_barcode,
+        args.archive_root,
+        args.cache_dir,
+    )
+    out.write(
+        "Sampled {0} of {1} reads into {2}\n".format(
+            info["sampled_reads"],
+            info["total_reads"],
+            subsample_path(args.run_accession, args.cache_dir),
+        )
+    )
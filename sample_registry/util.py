@@ -2,6 +2,9 @@ import collections
 import io
 import itertools
 import os
+import posixpath
+import re
+from typing import Optional
 
 
 def key_by_attr(objs, attr):
@@ -30,6 +33,67 @@ def local_filepath(data_fp, local_mount, remote_mount):
     return os.path.join(local_mount, data_fp.lstrip("/"))
 
 
+# Illumina run folders look like 160511_M03543_0047_000000000-APE6Y
+RUN_FOLDER_RE = re.compile(r"^(\d{6}|\d{8})_[A-Za-z0-9]+_\d+_[A-Za-z0-9-]+$")
+# Illumina FASTQ names carry the lane, as in Undetermined_S0_L001_R1_001.fastq.gz
+LANE_RE = re.compile(r"_L(\d{3})_")
+
+
+def split_data_uri(data_uri: str) -> dict[str, Optional[str | int]]:
+    """Split a run data URI into its Illumina run folder, file name and lane.
+
+    The run folder is the innermost directory named like an Illumina run
+    folder, or ``None`` if there isn't one. The lane is read from the file
+    name, or ``None`` if it doesn't have one.
+    """
+    directory, file_name = posixpath.split(data_uri.rstrip("/"))
+    run_folder = None
+    for part in reversed(directory.split("/")):
+        if RUN_FOLDER_RE.match(part):
+            run_folder = part
+            break
+    m = LANE_RE.search(file_name)
+    return {
+        "run_folder": run_folder,
+        "file_name": file_name,
+        "lane": int(m.group(1)) if m else None,
+    }
+
+
+ACCESSION_PREFIXES = {"CMR": "run", "CMS": "sample"}
+ACCESSION_RE = re.compile(r"^(CMR|CMS)(\d+)$", re.IGNORECASE)
+
+
+def parse_accession(acc: str) -> tuple[str, int]:
+    """Parse a formatted accession like ``CMS000123`` or ``CMR000007``.
+
+    Returns ``("sample", 123)`` or ``("run", 7)``. Raises ``ValueError`` for
+    anything else.
+    """
+    m = ACCESSION_RE.match(acc.strip())
+    if not m:
+        raise ValueError("Not a run or sample accession: %s" % acc)
+    return ACCESSION_PREFIXES[m.group(1).upper()], int(m.group(2))
+
+
+def accession_number(value: str, kind: str) -> int:
+    """Parse a ``kind`` accession given either formatted or as a bare number."""
+    if value.strip().isdigit():
+        return int(value)
+    parsed_kind, n = parse_accession(value)
+    if parsed_kind != kind:
+        raise ValueError("Not a %s accession: %s" % (kind, value))
+    return n
+
+
+def chunked(seq, n):
+    "Split a sequence into lists of at most n items"
+    # chunked('ABCDEFG', 3) --> ABC DEF G
+    it = iter(seq)
+    while chunk := list(itertools.islice(it, n)):
+        yield chunk
+
+
 def parse_fasta(f):
     f = iter(f)
     desc = next(f).strip()[1:]
@@ -60,6 +124,16 @@ def parse_fastq(f):
         yield desc, seq, qual
 
 
+def illumina_index(desc: str) -> str:
+    """Return the index sequence recorded in an Illumina FASTQ header.
+
+    The index is the last colon-separated field of the header, e.g.
+    ``M03543:21:C8LJ2ANXX:1:2209:1084:2044 1:N:0:ACGT+TTGA``. Dual
+    indexes are joined with "-" to match the registered barcode sequences.
+    """
+    return desc.rstrip().rsplit(":", 1)[-1].replace("+", "-")
+
+
 class FastaRead(object):
     def __init__(self, read: tuple[str, str]):
         self.desc, self.seq = read
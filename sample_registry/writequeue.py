@@ -0,0 +1,165 @@
+"""Apply API writes from one thread, committing them in small groups
+
+SQLite lets one connection write at a time, so concurrent write requests
+wait on each other for the database lock and fail once the wait times
+out. Instead, request threads hand their operation to a ``WriteQueue``
+and block until it's done. A single writer thread takes whatever writes
+are waiting, applies them in order with one ``SampleRegistry`` session and
+commits them together, so a burst of writes costs one commit per group
+rather than one lock wait per request.
+
+If any write in a group fails, the group is rolled back and its writes
+are applied again one at a time, so each request gets the result it would
+have had on its own. If the session itself fails, e.g. because the
+database can't be reached, the group's writes fail with that error and the
+thread carries on with the next group.
+"""
+
+import concurrent.futures
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable
+from sqlalchemy.orm import sessionmaker
+from sample_registry.registrar import SampleRegistry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_DEPTH = 100
+DEFAULT_MAX_GROUP = 50
+# Seconds a request waits for its write before giving up
+DEFAULT_TIMEOUT = 60.0
+
+
+class WriteUnavailable(Exception):
+    """Raised when a write can't be taken on now; the client should retry."""
+
+
+class QueueFull(WriteUnavailable):
+    """Raised when the queue already holds ``max_depth`` writes."""
+
+
+class WriteTimeout(WriteUnavailable):
+    """Raised when a write isn't done within ``timeout`` seconds.
+
+    The write stays queued and may still be applied.
+    """
+
+
+@dataclass
+class _Write:
+    operation: Callable[[SampleRegistry, object], dict]
+    data: object
+    future: Future
+
+
+class WriteQueue:
+    def __init__(
+        self,
+        session_factory: sessionmaker,
+        max_depth: int = DEFAULT_MAX_DEPTH,
+        max_group: int = DEFAULT_MAX_GROUP,
+        timeout: float = DEFAULT_TIMEOUT,
+    ):
+        self.session_factory = session_factory
+        self.max_group = max_group
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=max_depth)
+        self.groups_committed = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def submit(self, operation, data, block: bool = False):
+        """Apply ``operation(registry, data)`` on the writer thread.
+
+        Blocks until the write is committed and returns the operation's
+        result, or raises what the operation raised. With ``block``, waits
+        for room in the queue and for the write however long they take,
+        for background work rather than requests.
+
+        Raises
+        ------
+        QueueFull
+            If the queue is full; nothing is written.
+        WriteTimeout
+            If the write isn't done within ``timeout`` seconds.
+        """
+        self._start()
+        future = Future()
+        write = _Write(operation, data, future)
+        if block:
+            self.queue.put(write)
+            return future.result()
+        try:
+            self.queue.put_nowait(write)
+        except queue.Full:
+            raise QueueFull(
+                "Too many writes waiting ({0}), try again later".format(
+                    self.queue.maxsize
+                )
+            )
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise WriteTimeout(
+                "Write not done within {0} seconds, it may still be applied".format(
+                    self.timeout
+                )
+            )
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="sample_registry-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            group = [self.queue.get()]
+            # Writes that arrived while the last group was committing
+            while len(group) < self.max_group:
+                try:
+                    group.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._apply(group)
+            except Exception as exc:
+                logger.exception("Could not apply a group of writes")
+                for w in group:
+                    if not w.future.done():
+                        w.future.set_exception(exc)
+
+    def _apply(self, group: list[_Write]):
+        session = self.session_factory()
+        registry = SampleRegistry(session)
+        try:
+            results = [w.operation(registry, w.data) for w in group]
+            session.commit()
+        except Exception as exc:
+            session.rollback()
+            if len(group) == 1:
+                group[0].future.set_exception(exc)
+                return
+            results = None
+        finally:
+            try:
+                session.close()
+            except Exception:
+                # The outcome is already settled by the commit or rollback
+                logger.exception("Could not close the writer session")
+
+        if results is None:
+            for w in group:
+                self._apply([w])
+            return
+        self.groups_committed += 1
+        for w, result in zip(group, results):
+            w.future.set_result(result)
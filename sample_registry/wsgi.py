@@ -0,0 +1,30 @@
+"""WSGI entry point for production servers
+
+Point a pre-forking server at ``sample_registry.wsgi:app``, e.g. with the
+settings in ``sample_registry.gunicorn_conf``::
+
+    gunicorn -c python:sample_registry.gunicorn_conf sample_registry.wsgi:app
+
+The app is imported once in the parent process, and each forked worker
+drops the connection pools it inherited so that no database connection is
+ever shared between processes.
+"""
+
+import os
+from sample_registry import engine as cli_engine
+from sample_registry.app import app, db, write_engine
+
+
+def dispose_engines():
+    """Forget pooled connections inherited from the parent process.
+
+    They're left open for the parent to keep using; the worker opens its own
+    on first use.
+    """
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines + [write_engine, cli_engine]:
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=dispose_engines)
@@ -0,0 +1,24 @@
+from typing import Generator
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sample_registry.db import create_test_db
+from sample_registry.models import Base
+
+
+@pytest.fixture()
+def db() -> Generator[Session, None, None]:
+    # This fixture should run before every test and create a new in-memory SQLite test database with identical data
+    SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
+    engine = create_engine(SQLALCHEMY_DATABASE_URI, echo=False)
+    Base.metadata.create_all(engine)
+
+    Session = sessionmaker(bind=engine)
+    session = Session()
+
+    create_test_db(session)
+
+    yield session
+
+    session.rollback()
+    session.close()
@@ -1,12 +1,17 @@
 import importlib
 import io
+import json
+import os
+from datetime import datetime
 
 import pytest
 from sqlalchemy import create_engine, select
 from sqlalchemy.orm import sessionmaker
 
+from sample_registry import metrics
 from sample_registry.mapping import SampleTable
 from sample_registry.models import Annotation, Base, Run, Sample
+from sample_registry.registrar import SampleRegistry
 
 SAMPLES = [
     {
@@ -47,6 +52,8 @@ def api_client(tmp_path, monkeypatch):
     uri = f"sqlite:///{db_path}"
     monkeypatch.setenv("SAMPLE_REGISTRY_DB_URI", uri)
     monkeypatch.delenv("PYTEST_VERSION", raising=False)
+    # Each test has its own database, so sizes counted for another are stale
+    monkeypatch.setattr(metrics, "_registry_sizes", None)
     engine = create_engine(uri, echo=False)
     Base.metadata.create_all(engine)
     Session = sessionmaker(bind=engine)
@@ -154,6 +161,38 @@ def test_api_register_annotations(api_client):
     )
     assert response.status_code == 200
 
+    response = client.post(
+        "/api/register_annotations",
+        json={
+            "run_accession": 4,
+            "sample_table": _sample_table_payload(MODIFIED_SAMPLES),
+            "diff": True,
+        },
+    )
+    assert response.get_json()["changes"]["unchanged"] == 2
+
+    # Form values are strings; "false" leaves diff mode off
+    response = client.post(
+        "/api/register_annotations",
+        data={
+            "run_accession": "4",
+            "sample_table": _sample_table_payload(MODIFIED_SAMPLES),
+            "diff": "false",
+        },
+    )
+    assert response.status_code == 200
+    assert "changes" not in response.get_json()
+    response = client.post(
+        "/api/register_annotations",
+        data={
+            "run_accession": "4",
+            "sample_table": _sample_table_payload(MODIFIED_SAMPLES),
+            "diff": "maybe",
+        },
+    )
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Invalid diff value: 'maybe'"
+
     session = Session()
     try:
         sample = session.scalar(select(Sample).where(Sample.sample_accession == 6))
@@ -263,3 +302,643 @@ def test_api_modify_annotation(api_client):
         assert annotation.val == "updated"
     finally:
         session.close()
+
+
+def test_run_page_and_preview_download(api_client, tmp_path, monkeypatch):
+    client, _ = api_client
+    app_module = importlib.import_module("sample_registry.app")
+    monkeypatch.setattr(app_module, "CACHE_DIR", tmp_path / "cache")
+
+    response = client.get("/preview/1")
+    assert b"Export for 1 failed" in response.data
+
+    fp = tmp_path / "cache/subsamples/CMR000001.fastq.gz"
+    fp.parent.mkdir(parents=True)
+    fp.write_bytes(b"preview")
+    (fp.parent / "CMR000001.json").write_text(
+        '{"sampled_reads": 1, "total_reads": 10, "by_barcode": false, "seed": 42}'
+    )
+    response = client.get("/runs/1")
+    assert response.status_code == 200
+    assert b"1 of 10 reads sampled" in response.data
+
+    response = client.get("/preview/CMR000001")
+    assert response.data == b"preview"
+    assert "CMR000001.fastq.gz" in response.headers["Content-Disposition"]
+
+
+def test_browse_runs_shows_archive_status(api_client):
+    client, Session = api_client
+    session = Session()
+    try:
+        SampleRegistry(session).register_archive_status(
+            [
+                {
+                    "run_accession": 1,
+                    "data_uri": "raw_data/run1/Undetermined_S0_L002_R1_001.fastq.gz",
+                    "status": "missing",
+                    "size": None,
+                    "mtime": None,
+                    "checked_at": datetime(2024, 8, 1),
+                }
+            ]
+        )
+        session.commit()
+    finally:
+        session.close()
+
+    response = client.get("/runs")
+    assert response.status_code == 200
+    assert b"<td>missing</td>" in response.data
+    assert b"<td>unchecked</td>" in response.data
+
+    response = client.get("/runs/1")
+    assert b"missing" in response.data
+
+
+def test_api_resolve(api_client):
+    client, _ = api_client
+    response = client.post(
+        "/api/resolve", json={"accessions": ["CMS000003", "CMR000001", "bad"]}
+    )
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["status"] == "ok"
+    assert set(body["runs"]) == {"CMR000001", "CMR000002"}
+    assert body["samples"]["CMS000003"]["sample_name"] == "Sample3"
+    assert body["invalid"] == ["bad"]
+
+    response = client.get("/api/resolve?accessions=CMS000001,CMS000042")
+    body = response.get_json()
+    assert list(body["samples"]) == ["CMS000001"]
+    assert body["not_found"] == ["CMS000042"]
+
+    response = client.post("/api/resolve", json={})
+    assert response.status_code == 400
+
+
+def test_api_samples_pages(api_client):
+    client, _ = api_client
+    response = client.get("/api/samples?limit=2")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    page = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [s["sample_accession"] for s in page] == ["CMS000001", "CMS000002"]
+    assert page[0]["annotations"] == {"key0": "val0", "key4": "val0"}
+    assert response.headers["X-Next-After"] == "CMS000002"
+
+    seen = [s["sample_accession"] for s in page]
+    while "Link" in response.headers:
+        next_url = response.headers["Link"].split(">")[0].lstrip("<")
+        response = client.get(next_url)
+        seen += [json.loads(l)["sample_accession"] for l in response.data.splitlines()]
+    assert seen == ["CMS00000%d" % i for i in range(1, 6)]
+
+
+def test_api_samples_filters(api_client):
+    client, _ = api_client
+
+    def accessions(query):
+        response = client.get("/api/samples?" + query)
+        assert response.status_code == 200
+        return [json.loads(l)["sample_accession"] for l in response.data.splitlines()]
+
+    assert accessions("run=CMR000002") == ["CMS000003", "CMS000004", "CMS000005"]
+    assert accessions("run=1,2&after=CMS000002") == [
+        "CMS000003",
+        "CMS000004",
+        "CMS000005",
+    ]
+    assert accessions("tag=key1&val=val1") == ["CMS000002"]
+    assert accessions("tag=SampleType&val=Urine") == ["CMS000004"]
+    assert accessions("start_date=2024-07-01") == ["CMS000001", "CMS000002"]
+    assert accessions("end_date=2024-06-30&tag=key3") == ["CMS000004"]
+    assert client.get("/api/samples?run=CMS000001").status_code == 400
+
+
+def test_export_merged_mapping(api_client):
+    client, _ = api_client
+    response = client.get("/export/mapping.tsv?run=CMR000001&run=CMR000002")
+    assert response.status_code == 200
+    assert "mapping.tsv" in response.headers["Content-Disposition"]
+    lines = response.data.decode().splitlines()
+    assert lines[0].startswith("SampleID\tBarcode")
+    assert len(lines) == 6
+
+    response = client.get("/export/mapping.tsv?tag=key3&val=val1")
+    assert len(response.data.decode().splitlines()) == 2
+
+    assert client.get("/export/mapping.tsv").status_code == 400
+
+
+def test_run_downloads_are_serialized_in_memory(api_client, tmp_path, monkeypatch):
+    client, _ = api_client
+    workdir = tmp_path / "workdir"
+    workdir.mkdir()
+    monkeypatch.chdir(workdir)
+
+    response = client.get("/runs/CMR000001.json")
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["run"]["run_accession"] == "CMR000001"
+    assert [s["sample_accession"] for s in body["samples"]] == [
+        "CMS000001",
+        "CMS000002",
+    ]
+    assert body["samples"][1]["annotations"] == {"key1": "val1", "key5": "val1"}
+
+    response = client.get("/runs/1.tsv")
+    lines = response.data.decode().splitlines()
+    assert lines[0].split("\t")[0] == "SampleID"
+    assert len(lines) == 3
+
+    response = client.get("/runs/1.txt")
+    assert response.data.decode().startswith("#SampleID")
+    assert "#Run accession: CMR000001" in response.data.decode()
+
+    assert client.get("/runs/99.json").status_code == 404
+    assert list(workdir.iterdir()) == []
+
+
+def test_api_batch(api_client):
+    client, Session = api_client
+    response = client.post(
+        "/api/batch",
+        json={
+            "operations": [
+                {
+                    "op": "register_run",
+                    "file": "raw/run4.fastq.gz",
+                    "date": "2024-08-01",
+                    "comment": "new run",
+                },
+                {
+                    "op": "register_samples",
+                    "run_accession": 4,
+                    "sample_table": _sample_table_payload(SAMPLES),
+                },
+                {"op": "modify_sample", "sample_accession": 1, "subject_id": "S1a"},
+                {"op": "modify_sample", "sample_accession": 6, "sample_type": "Feces"},
+                {
+                    "op": "modify_annotation",
+                    "sample_accession": 1,
+                    "key": "key0",
+                    "val": "x",
+                },
+            ]
+        },
+    )
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert [r["op"] for r in results] == [
+        "register_run",
+        "register_samples",
+        "modify_sample",
+        "modify_sample",
+        "modify_annotation",
+    ]
+    assert results[0]["run_accession"] == 4
+    assert results[1]["sample_count"] == 2
+    assert [r["index"] for r in results] == [0, 1, 2, 3, 4]
+
+    session = Session()
+    try:
+        assert session.get(Sample, 1).subject_id == "S1a"
+        assert session.get(Sample, 6).sample_type == "Feces"
+        assert session.get(Annotation, (1, "key0")).val == "x"
+    finally:
+        session.close()
+
+
+def test_api_batch_rolls_back(api_client):
+    client, Session = api_client
+    response = client.post(
+        "/api/batch",
+        json={
+            "operations": [
+                {"op": "modify_run", "run_accession": 1, "comment": "changed"},
+                {"op": "modify_sample", "sample_accession": 99, "subject_id": "x"},
+            ]
+        },
+    )
+    assert response.status_code == 400
+    assert response.get_json()["error"].startswith("Operation 1 (modify_sample)")
+
+    session = Session()
+    try:
+        assert session.get(Run, 1).comment == "Test run 1"
+    finally:
+        session.close()
+
+    response = client.post("/api/batch", json={"operations": [{"op": "drop_table"}]})
+    assert response.status_code == 400
+    assert client.post("/api/batch", json={}).status_code == 400
+
+
+def test_api_sample_table_parsed_before_queueing(api_client, monkeypatch):
+    import sample_registry.app as app_module
+    from sample_registry.mapping import SampleTable
+
+    client, _ = api_client
+    submitted = []
+    submit = app_module.write_queue.submit
+
+    def record(operation, data):
+        submitted.append(data)
+        return submit(operation, data)
+
+    monkeypatch.setattr(app_module.write_queue, "submit", record)
+    payload = {"run_accession": 3, "sample_table": "not a sample table"}
+    response = client.post("/api/register_samples", json=payload)
+    assert response.status_code == 400
+    response = client.post(
+        "/api/batch", json={"operations": [dict(payload, op="register_annotations")]}
+    )
+    assert response.status_code == 400
+    assert response.get_json()["error"].startswith("Operation 0 (register_annotations)")
+    assert submitted == []
+
+    payload["sample_table"] = _sample_table_payload(SAMPLES)
+    response = client.post("/api/register_samples", json=payload)
+    assert response.status_code == 200
+    assert isinstance(submitted[0]["sample_table"], SampleTable)
+
+
+def test_api_validation_errors(api_client):
+    client, _ = api_client
+    response = client.post("/api/register_run", json={"file": "x"})
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Missing required fields: date, comment"
+    response = client.post("/api/modify_run", json={"run_accession": 1, "lane": "two"})
+    assert response.status_code == 400
+
+
+def test_api_patch_samples(api_client):
+    client, Session = api_client
+    response = client.post(
+        "/api/patch_samples",
+        json={
+            "patch_table": "sample_accession\tfield\tvalue\n"
+            "CMS000001\tSubjectID\tS1\n"
+            "CMS000002\tnew_key\tx\n"
+        },
+    )
+    assert response.status_code == 200
+    assert response.get_json()["updated"] == 1
+    assert response.get_json()["inserted"] == 1
+
+    response = client.post(
+        "/api/patch_samples", json={"patches": [["CMS000002", "new_key", "x"]]}
+    )
+    assert response.get_json()["unchanged"] == 1
+
+    response = client.post("/api/patch_samples", json={"patch_table": "1\tkey\n"})
+    assert response.status_code == 400
+
+    response = client.post(
+        "/api/patch_samples", json={"patches": [["CMS000099", "new_key", "x"]]}
+    )
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Samples do not exist [99]"
+    response = client.post("/api/modify_run", json={"run_accession": 99})
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Run does not exist 99"
+
+
+@pytest.fixture
+def instrumented(monkeypatch):
+    monkeypatch.setenv("SAMPLE_REGISTRY_INSTRUMENT", "1")
+
+
+def test_request_instrumentation(instrumented, api_client, caplog):
+    client, _ = api_client
+    with caplog.at_level("INFO", logger="sample_registry.instrument"):
+        response = client.get("/runs/1")
+        download = client.get("/runs/CMR000001.json")
+    assert response.status_code == 200
+    timing = response.headers["Server-Timing"]
+    assert timing.startswith("db;dur=")
+    assert "render;dur=" in timing and "total;dur=" in timing
+    assert "serialize;dur=" in download.headers["Server-Timing"]
+
+    records = [json.loads(r.getMessage()) for r in caplog.records]
+    assert [r["endpoint"] for r in records] == ["show_runs", "show_runs"]
+    assert records[0]["path"] == "/runs/1"
+    assert records[0]["queries"] >= 4
+    assert records[0]["render_ms"] > 0
+    assert records[1]["serialize_ms"] > 0
+
+
+def test_instrumentation_times_failed_statements(monkeypatch):
+    import time
+    from sqlalchemy.exc import OperationalError
+    from sample_registry import instrument
+
+    engine = create_engine("sqlite://")
+    instrument.instrument_engine(engine)
+    timings = instrument.RequestTimings()
+    monkeypatch.setattr(instrument, "current_timings", lambda: timings)
+    with engine.connect() as conn:
+        with pytest.raises(OperationalError):
+            conn.exec_driver_sql("SELECT * FROM missing")
+        assert "instrument_start" not in conn.info
+        time.sleep(0.2)
+        conn.exec_driver_sql("SELECT 1")
+    # Neither statement is paired with the other's start time
+    assert timings.queries == 2
+    assert timings.seconds["db"] < 0.1
+
+
+def test_instrumentation_is_off_by_default(api_client):
+    client, _ = api_client
+    assert "Server-Timing" not in client.get("/runs/1").headers
+
+
+def test_metrics_endpoint(api_client):
+    client, _ = api_client
+    client.get("/runs/1")
+    client.post("/api/modify_run", json={"run_accession": 1, "comment": "x"})
+    client.post("/api/modify_run", json={})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert 'sample_registry_registry_size{table="samples"} 5' in text
+    assert 'sample_registry_registry_size{table="annotations"} 8' in text
+    assert (
+        'sample_registry_http_request_duration_seconds_count{route="show_runs"}' in text
+    )
+    assert 'operation="modify_run",status="ok"' in text
+    assert 'operation="modify_run",status="error"' in text
+    assert 'sample_registry_cache_requests_total{cache="preview",result="miss"}' in text
+    assert "sample_registry_db_checkouts_total" in text
+
+
+@pytest.fixture
+def slow_query_log(tmp_path, monkeypatch):
+    path = tmp_path / "slow_queries.log"
+    monkeypatch.setenv("SAMPLE_REGISTRY_SLOW_QUERY_MS", "0")
+    monkeypatch.setenv("SAMPLE_REGISTRY_SLOW_QUERY_LOG", str(path))
+    return path
+
+
+def test_slow_queries_page(slow_query_log, api_client):
+    client, _ = api_client
+    client.get("/tags/key0/val0")
+    response = client.get("/admin/slow_queries")
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert "Statements taking longer than 0.0 ms" in page
+    assert "JOIN annotations" in page
+
+
+# Most statements each page or read API may run, whatever the number of samples
+ROUTE_STATEMENT_BUDGETS = {
+    "/runs": 3,
+    "/runs/2": 5,
+    "/runs/CMR000002.json": 3,
+    "/runs/CMR000002.tsv": 4,
+    "/runs/CMR000002.txt": 4,
+    "/download/2.tsv": 4,
+    "/tags": 1,
+    "/tags/key0": 1,
+    "/tags/key0/val0": 2,
+    "/tags/SampleType/Stool": 2,
+    "/stats": 13,
+    "/api/resolve?accessions=CMR000001,CMS000001,CMS000002": 3,
+    "/api/samples?run=2": 2,
+    "/export/mapping.tsv?run=2": 2,
+    "/metrics": 3,
+}
+
+
+def _route_statement_counts(client) -> dict[str, int]:
+    from sample_registry.app import db, write_engine
+    from sample_registry.instrument import StatementCounter
+
+    counts = {}
+    with client.application.app_context():
+        engines = [db.engine, write_engine]
+    for route in ROUTE_STATEMENT_BUDGETS:
+        with StatementCounter(*engines) as counter:
+            response = client.get(route)
+        assert response.status_code == 200, route
+        counts[route] = counter.count
+    return counts
+
+
+def _register_stool_samples(Session, start: int, n: int):
+    session = Session()
+    registry = SampleRegistry(session)
+    table = SampleTable(
+        [
+            {
+                "SampleID": f"Extra{i}",
+                "BarcodeSequence": f"{i:08d}",
+                "SampleType": "Stool",
+                "key0": "val0",
+                "key1": str(i),
+            }
+            for i in range(start, start + n)
+        ]
+    )
+    registry.register_samples(2, table)
+    registry.register_annotations(2, table)
+    session.commit()
+    session.close()
+
+
+def test_route_statement_budgets(api_client, monkeypatch):
+    client, Session = api_client
+    # Budget what a scrape runs when the registry sizes aren't cached
+    monkeypatch.setattr(metrics, "REGISTRY_SIZES_TTL", 0)
+    _register_stool_samples(Session, 0, 5)
+    small = _route_statement_counts(client)
+    _register_stool_samples(Session, 5, 60)
+    large = _route_statement_counts(client)
+
+    over_budget = {
+        route: (small[route], large[route])
+        for route, budget in ROUTE_STATEMENT_BUDGETS.items()
+        if large[route] > budget or large[route] != small[route]
+    }
+    assert over_budget == {}
+
+
+def test_wsgi_workers_get_fresh_pools(api_client):
+    import sample_registry.wsgi as wsgi
+
+    wsgi = importlib.reload(wsgi)
+    with wsgi.write_engine.connect():
+        pass
+    assert wsgi.write_engine.pool.checkedin() == 1
+
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if wsgi.write_engine.pool.checkedin() == 0 else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    # The parent keeps its connections
+    assert wsgi.write_engine.pool.checkedin() == 1
+
+
+def test_api_write_queue_full(api_client, monkeypatch):
+    import sample_registry.app as app_module
+    from sample_registry.writequeue import QueueFull
+
+    client, _ = api_client
+    assert app_module.write_queue is not None
+
+    def full(operation, data):
+        raise QueueFull("Too many writes waiting (100), try again later")
+
+    monkeypatch.setattr(app_module.write_queue, "submit", full)
+    response = client.post("/api/modify_run", json={"run_accession": 1, "comment": "x"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert response.get_json()["error"].startswith("Too many writes waiting")
+
+
+def test_api_idempotency_key_replays_response(api_client):
+    client, Session = api_client
+    run = {"file": "raw/run4.fastq.gz", "date": "2024-08-01", "comment": "retried"}
+    headers = {"Idempotency-Key": "run4-upload"}
+    first = client.post("/api/register_run", json=run, headers=headers)
+    retry = client.post("/api/register_run", json=run, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.get_json() == first.get_json()
+
+    session = Session()
+    try:
+        runs = session.scalars(select(Run).where(Run.comment == "retried")).all()
+        assert len(runs) == 1
+    finally:
+        session.close()
+
+    # The same key can't be reused for a different request
+    response = client.post(
+        "/api/register_run", json=dict(run, comment="other"), headers=headers
+    )
+    assert response.status_code == 422
+
+    # Without a key, every request is applied
+    client.post("/api/register_run", json=run)
+    session = Session()
+    try:
+        runs = session.scalars(select(Run).where(Run.comment == "retried")).all()
+        assert len(runs) == 2
+    finally:
+        session.close()
+
+
+def test_api_idempotency_key_replays_client_errors(api_client):
+    client, _ = api_client
+    headers = {"Idempotency-Key": "bad-run"}
+    first = client.post("/api/modify_run", json={"comment": "x"}, headers=headers)
+    retry = client.post("/api/modify_run", json={"comment": "x"}, headers=headers)
+    assert first.status_code == retry.status_code == 400
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.get_json() == first.get_json()
+
+
+def test_api_idempotency_key_in_progress(api_client):
+    import sample_registry.app as app_module
+    from sample_registry.models import IdempotencyKey
+
+    client, Session = api_client
+    payload = {"run_accession": 1, "comment": "x"}
+    with app_module.app.test_request_context(
+        "/api/modify_run", method="POST", json=payload
+    ):
+        fingerprint = app_module.request_fingerprint()
+    session = Session()
+    session.add(
+        IdempotencyKey(
+            key="slow",
+            fingerprint=fingerprint,
+            created_at=datetime.now(),
+            expires_at=datetime(2100, 1, 1),
+        )
+    )
+    session.commit()
+    session.close()
+
+    response = client.post(
+        "/api/modify_run", json=payload, headers={"Idempotency-Key": "slow"}
+    )
+    assert response.status_code == 409
+
+    # A request that never finished doesn't hold the key past its lease
+    session = Session()
+    session.get(IdempotencyKey, "slow").expires_at = datetime(2000, 1, 1)
+    session.commit()
+    session.close()
+    response = client.post(
+        "/api/modify_run", json=payload, headers={"Idempotency-Key": "slow"}
+    )
+    assert response.status_code == 200
+
+
+def test_api_idempotent_response_saved_with_write(api_client, monkeypatch):
+    from sample_registry.models import IdempotencyKey
+    from sample_registry.registrar import SampleRegistry
+
+    client, Session = api_client
+
+    def fail(*args):
+        raise RuntimeError("Could not save the response")
+
+    monkeypatch.setattr(SampleRegistry, "save_idempotent_response", fail)
+    run = {"file": "raw/run5.fastq.gz", "date": "2024-08-01", "comment": "unsaved"}
+    with pytest.raises(RuntimeError):
+        client.post("/api/register_run", json=run, headers={"Idempotency-Key": "k"})
+
+    # The write was rolled back with the response, and the key released
+    session = Session()
+    try:
+        assert session.scalars(select(Run).where(Run.comment == "unsaved")).all() == []
+        assert session.get(IdempotencyKey, "k") is None
+    finally:
+        session.close()
+
+
+def test_api_registration_job(api_client):
+    import time
+
+    client, Session = api_client
+    response = client.post(
+        "/api/jobs",
+        data={
+            "op": "register_samples",
+            "run_accession": "3",
+            "sample_table": (
+                io.BytesIO(_sample_table_payload(SAMPLES).encode()),
+                "samples.tsv",
+            ),
+        },
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 202
+    job_id = response.get_json()["job_id"]
+    assert response.headers["Location"].endswith(f"/api/jobs/{job_id}")
+
+    deadline = time.monotonic() + 10
+    while True:
+        job = client.get(f"/api/jobs/{job_id}").get_json()["job"]
+        if job["status"] not in ("queued", "running"):
+            break
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert job["status"] == "done", job["error"]
+    assert job["sample_count"] == 2
+    assert [s["sample_name"] for s in job["result"]["samples"]] == [
+        "abc123",
+        "def456",
+    ]
+
+    assert client.get("/api/jobs/999").status_code == 404
+    response = client.post("/api/jobs", json={"op": "register_samples"})
+    assert response.status_code == 400
@@ -0,0 +1,140 @@
+import hashlib
+import io
+import os
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import update
+from sample_registry.archive import (
+    checksum_archive,
+    checksum_runs,
+    hash_file,
+    stat_data_uri,
+    verify_archive,
+    verify_runs,
+)
+from sample_registry.models import ArchiveStatus
+from sample_registry.registrar import SampleRegistry
+
+
+@pytest.fixture()
+def archive(tmp_path):
+    # Run 1 has data, run 2 has an empty file and run 3 is missing
+    for run, content in [(1, b"reads"), (2, b"")]:
+        fp = (
+            tmp_path / f"raw_data/run{run}/Undetermined_S0_L00{run * 2}_R1_001.fastq.gz"
+        )
+        fp.parent.mkdir(parents=True)
+        fp.write_bytes(content)
+    return tmp_path
+
+
+def test_stat_data_uri(archive):
+    assert (
+        stat_data_uri(archive, "raw_data/run1/Undetermined_S0_L002_R1_001.fastq.gz")[
+            "size"
+        ]
+        == 5
+    )
+    assert stat_data_uri(archive, "nope.fastq.gz")["status"] == "missing"
+
+
+def test_verify_runs(db, archive):
+    registry = SampleRegistry(db)
+    statuses = verify_runs(registry, archive)
+    assert [s["status"] for s in statuses] == ["ok", "empty", "missing"]
+    stored = registry.get_archive_status()
+    assert stored[1].size == 5
+    assert stored[3].status == "missing"
+
+    # Fresh results are not checked again
+    assert verify_runs(registry, archive) == []
+
+
+def test_verify_runs_rechecks_stale_entries(db, archive):
+    registry = SampleRegistry(db)
+    verify_runs(registry, archive)
+    db.execute(
+        update(ArchiveStatus)
+        .where(ArchiveStatus.run_accession == 1)
+        .values(checked_at=datetime.now() - timedelta(days=2))
+    )
+    registry.modify_run(
+        2, data_uri="raw_data/run1/Undetermined_S0_L002_R1_001.fastq.gz"
+    )
+    statuses = verify_runs(registry, archive)
+    assert [s["run_accession"] for s in statuses] == [1, 2]
+    assert registry.get_archive_status()[2].status == "ok"
+
+
+def test_verify_archive(db, archive):
+    out = io.StringIO()
+    verify_archive(["--archive-root", str(archive), "--workers", "2"], db, out)
+    assert out.getvalue().endswith("Checked 3 runs, 2 with problems\n")
+    assert "CMR000003\tmissing" in out.getvalue()
+
+    out = io.StringIO()
+    verify_archive(["--archive-root", str(archive), "--all"], db, out)
+    assert out.getvalue().endswith("Checked 3 runs, 2 with problems\n")
+
+
+def test_hash_file(tmp_path):
+    fp = tmp_path / "reads.fastq"
+    fp.write_bytes(b"abc" * 1000)
+    assert hash_file(fp, block_bytes=7) == hashlib.sha256(b"abc" * 1000).hexdigest()
+    assert hash_file(fp, "md5") == hashlib.md5(b"abc" * 1000).hexdigest()
+
+
+def test_checksum_runs_is_incremental(db, archive):
+    registry = SampleRegistry(db)
+    results = checksum_runs(registry, archive, workers=2)
+    assert [(r["run_accession"], r["result"]) for r in results] == [
+        (1, "new"),
+        (2, "new"),
+    ]
+    assert registry.get_checksums()[1].digest == hashlib.sha256(b"reads").hexdigest()
+
+    # Nothing changed, so nothing is hashed
+    assert checksum_runs(registry, archive, workers=2) == []
+
+    fp = archive / "raw_data/run1/Undetermined_S0_L002_R1_001.fastq.gz"
+    fp.write_bytes(b"more reads")
+    results = checksum_runs(registry, archive, workers=2)
+    assert [(r["run_accession"], r["result"]) for r in results] == [(1, "changed")]
+
+
+def test_checksum_runs_verify_detects_bit_rot(db, archive):
+    registry = SampleRegistry(db)
+    checksum_runs(registry, archive, workers=2)
+
+    fp = archive / "raw_data/run1/Undetermined_S0_L002_R1_001.fastq.gz"
+    stat = fp.stat()
+    fp.write_bytes(b"reeds")
+    os.utime(fp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    assert checksum_runs(registry, archive, workers=2) == []
+    out = io.StringIO()
+    checksum_archive(["--archive-root", str(archive), "--verify"], db, out)
+    assert "CMR000001\tmismatch" in out.getvalue()
+    assert "CMR000002\tverified" in out.getvalue()
+    assert out.getvalue().endswith("Hashed 2 files, 1 checksum mismatches\n")
+    # The original digest is kept
+    assert registry.get_checksums()[1].digest == hashlib.sha256(b"reads").hexdigest()
+
+
+def test_checksum_runs_carries_on_past_unreadable_files(db, archive, monkeypatch):
+    registry = SampleRegistry(db)
+    # A directory stats like a file but can't be read as one
+    registry.modify_run(2, data_uri="raw_data/run1")
+    monkeypatch.setattr("sample_registry.archive.CHECKSUM_COMMIT_EVERY", 1)
+    results = checksum_runs(registry, archive, workers=2)
+    assert [(r["run_accession"], r["result"]) for r in results] == [
+        (1, "new"),
+        (2, "error"),
+    ]
+    assert results[1]["error"]
+    assert set(registry.get_checksums()) == {1}
+
+    out = io.StringIO()
+    checksum_archive(["--archive-root", str(archive)], db, out)
+    assert "CMR000002\terror" in out.getvalue()
+    assert out.getvalue().endswith("Could not read 1 files\n")
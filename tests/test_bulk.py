@@ -0,0 +1,85 @@
+import pytest
+from sqlalchemy import event, func, select
+from sample_registry import bulk
+from sample_registry.bulk import chunks, max_params
+from sample_registry.mapping import SampleTable
+from sample_registry.models import Annotation, Sample
+from sample_registry.registrar import SampleRegistry
+
+# Enough samples to split every statement into several chunks at the
+# patched limits below
+N_SAMPLES = 2500
+# The size of run the chunking is for, at the real parameter limit
+LARGE_RUN = 100000
+
+
+@pytest.fixture
+def statement_params(db):
+    """Record the number of bound parameters each statement is sent with."""
+    counts = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        # A multi-row VALUES batch arrives as one flat tuple even though
+        # executemany is set; a real executemany has one tuple per row
+        if parameters and isinstance(parameters[0], (tuple, list, dict)):
+            counts.extend(len(params) for params in parameters)
+        else:
+            counts.append(len(parameters))
+
+    engine = db.get_bind()
+    event.listen(engine, "before_cursor_execute", record)
+    yield counts
+    event.remove(engine, "before_cursor_execute", record)
+
+
+def test_chunks_respect_parameter_limit(db):
+    limit = max_params(db) - bulk.RESERVED_PARAMS
+    sizes = [len(c) for c in chunks(db, range(limit * 2 + 5), 3)]
+    assert max(sizes) * 3 <= limit
+    assert sum(sizes) == limit * 2 + 5
+
+
+@pytest.fixture(params=[999, 200])
+def param_limit(request, monkeypatch):
+    # Old SQLite versions allow 999 parameters per statement; the smaller
+    # limit exercises many chunk boundaries without a huge run
+    monkeypatch.setattr(bulk, "max_params", lambda session: request.param)
+
+
+def _check_large_run(db, n_samples: int):
+    registry = SampleRegistry(db)
+    recs = [
+        {"SampleID": f"S{i}", "BarcodeSequence": f"{i:08d}", "plate": str(i % 96)}
+        for i in range(n_samples)
+    ]
+    accessions = registry.register_samples(3, SampleTable(recs))
+    assert len(accessions) == n_samples
+    keys = registry.register_annotations(3, SampleTable(recs))
+    assert len(keys) == n_samples
+
+    registry.check_sample_accessions(accessions)
+    resolved = registry.resolve_many(["CMS{:06d}".format(a) for a in accessions])
+    assert len(resolved["samples"]) == n_samples
+    assert resolved["samples"]["CMS{:06d}".format(accessions[-1])]["annotations"] == {
+        "plate": str((n_samples - 1) % 96)
+    }
+
+    counts = registry.apply_patches([(a, "plate", "A1") for a in accessions])
+    assert counts == {"inserted": 0, "updated": n_samples, "unchanged": 0}
+
+    removed = registry.remove_samples(3)
+    assert len(removed) == n_samples
+    assert db.scalar(select(func.count()).select_from(Sample)) == 5
+    assert db.scalar(select(func.count()).select_from(Annotation)) == 8
+
+
+def test_large_run(db, param_limit, statement_params):
+    _check_large_run(db, N_SAMPLES)
+    assert max(statement_params) <= bulk.max_params(db)
+
+
+@pytest.mark.slow
+def test_large_run_at_real_limit(db, statement_params):
+    _check_large_run(db, LARGE_RUN)
+    # Unchunked, a single statement would carry hundreds of thousands
+    assert max(statement_params) <= bulk.max_params(db)
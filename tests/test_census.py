@@ -0,0 +1,98 @@
+import collections
+import gzip
+import io
+import pytest
+from sqlalchemy import select
+from sample_registry.census import (
+    assign_indexes,
+    barcode_neighbors,
+    census_fastq,
+    census_run,
+    count_index_range,
+    count_indexes,
+)
+from sample_registry.models import ReadCount
+
+
+def _fastq(indexes):
+    # Quality lines start with "@" to make sure they aren't taken for headers
+    return "".join(
+        f"@M03543:21:C8LJ2ANXX:1:2209:1084:{i} 1:N:0:{index}\nACGT\n+\n@@@@\n"
+        for i, index in enumerate(indexes)
+    )
+
+
+INDEXES = ["AAAA"] * 5 + ["AAAT"] * 2 + ["CCCC"] * 3 + ["GGGG"] * 4
+
+
+@pytest.fixture()
+def fastq_files(tmp_path):
+    plain = tmp_path / "Undetermined_S0_L001_R1_001.fastq"
+    plain.write_text(_fastq(INDEXES))
+    gz = tmp_path / "Undetermined_S0_L001_R1_001.fastq.gz"
+    with gzip.open(gz, "wt") as f:
+        f.write(_fastq(INDEXES))
+    return plain, gz
+
+
+def test_barcode_neighbors():
+    neighbors = barcode_neighbors(["AAAA", "AAAT"])
+    # AAAT is itself a barcode, and AAAG is one mismatch from both
+    assert "AAAT" not in neighbors
+    assert "AAAG" not in neighbors
+    assert neighbors["CAAA"] == "AAAA"
+    assert neighbors["CAAT"] == "AAAT"
+
+
+def test_barcode_neighbors_dual_index():
+    neighbors = barcode_neighbors(["AC-GT"])
+    assert neighbors["AC-GA"] == "AC-GT"
+    assert not any("-" not in k for k in neighbors)
+
+
+def test_assign_indexes():
+    counts = collections.Counter({b"AAAA": 5, b"AAAT": 2, b"CCCC": 3, b"GGGG": 4})
+    census = assign_indexes(counts, ["AAAA", "CCCC"])
+    assert census.exact == {"AAAA": 5, "CCCC": 3}
+    assert census.mismatch == {"AAAA": 2, "CCCC": 0}
+    assert census.unmatched == 4
+    assert census.total == 14
+
+
+def test_count_index_range_splits_on_records(fastq_files):
+    plain, _ = fastq_files
+    size = plain.stat().st_size
+    total = collections.Counter()
+    for start in range(0, size, 7):
+        total.update(count_index_range(plain, start, min(start + 7, size)))
+    assert total == count_index_range(plain, 0, size)
+    assert sum(total.values()) == len(INDEXES)
+
+
+def test_count_indexes_parallel(fastq_files):
+    plain, gz = fastq_files
+    expected = collections.Counter(i.encode() for i in INDEXES)
+    assert count_indexes(plain, workers=2, chunk_bytes=50) == expected
+    assert count_indexes(gz) == expected
+
+
+def test_census_fastq(fastq_files):
+    _, gz = fastq_files
+    census = census_fastq(gz, ["AAAA", "CCCC", "GGGG"])
+    assert census.exact == {"AAAA": 5, "CCCC": 3, "GGGG": 4}
+    assert census.mismatch["AAAA"] == 2
+
+
+def test_census_run(db, tmp_path):
+    fp = tmp_path / "raw_data/run1/Undetermined_S0_L002_R1_001.fastq.gz"
+    fp.parent.mkdir(parents=True)
+    with gzip.open(fp, "wt") as f:
+        f.write(_fastq(INDEXES))
+
+    out = io.StringIO()
+    census_run(["1", "--archive-root", str(tmp_path)], db, out)
+
+    counts = {rc.sample_accession: rc for rc in db.scalars(select(ReadCount))}
+    assert (counts[1].exact_reads, counts[1].mismatch_reads) == (5, 2)
+    assert (counts[2].exact_reads, counts[2].mismatch_reads) == (3, 0)
+    assert "Counted 14 reads, 4 not assigned to a sample" in out.getvalue()
@@ -0,0 +1,127 @@
+import gzip
+import io
+import json
+import pytest
+from sample_registry import export
+from sample_registry.export import (
+    export_mapping,
+    export_samples,
+    iter_mapping_tsv,
+    mapping_columns,
+    write_samples,
+)
+
+
+def _table(text):
+    return [line.split("\t") for line in text.splitlines()]
+
+
+def test_mapping_columns(db):
+    assert mapping_columns(db, run_accessions=[2]) == [
+        "SampleID",
+        "Barcode",
+        "Primer",
+        "SampleType",
+        "SubjectID",
+        "HostSpecies",
+        "key2",
+        "key6",
+        "key3",
+        "key7",
+        "sample_accession",
+        "run_accession",
+    ]
+    assert mapping_columns(db, tag="key1")[6:-2] == ["key1", "key5"]
+
+
+def test_iter_mapping_tsv_merges_runs(db, monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_BATCH_SIZE", 2)
+    chunks = list(iter_mapping_tsv(db, run_accessions=[1, 2]))
+    assert len(chunks) == 3
+    table = _table("".join(chunks))
+    header = table[0]
+    # Columns are in the order the first sample with each key was registered
+    assert header[6:-2] == [
+        "key0",
+        "key4",
+        "key1",
+        "key5",
+        "key2",
+        "key6",
+        "key3",
+        "key7",
+    ]
+    assert [r[-2] for r in table[1:]] == ["CMS00000%d" % i for i in range(1, 6)]
+    assert [r[-1] for r in table[1:]] == ["CMR000001"] * 2 + ["CMR000002"] * 3
+    sample1 = dict(zip(header, table[1]))
+    assert sample1["key0"] == "val0"
+    assert sample1["key2"] == "NA"
+    # Sample5 has no annotations at all
+    assert table[5][6:-2] == ["NA"] * 8
+
+
+def test_export_mapping(db):
+    out = io.StringIO()
+    export_mapping(["--tag", "SampleType", "--val", "Urine"], db, out)
+    table = _table(out.getvalue())
+    assert len(table) == 2
+    assert table[1][0] == "Sample4"
+
+    out = io.StringIO()
+    export_mapping(["CMR000001"], db, out)
+    assert len(_table(out.getvalue())) == 3
+
+    with pytest.raises(SystemExit):
+        export_mapping([], db, io.StringIO())
+
+
+def test_write_samples_tsv(db):
+    out = io.StringIO()
+    assert write_samples(db, out, "tsv", tag="key0") == 1
+    table = _table(out.getvalue())
+    assert table[0] == [
+        "sample_accession",
+        "sample_name",
+        "run_accession",
+        "barcode_sequence",
+        "primer_sequence",
+        "sample_type",
+        "subject_id",
+        "host_species",
+        "key0",
+        "key4",
+    ]
+    assert table[1][:3] == ["CMS000001", "Sample1", "CMR000001"]
+    assert table[1][-2:] == ["val0", "val0"]
+
+
+def test_write_samples_progress(db, monkeypatch):
+    monkeypatch.setattr(export, "PROGRESS_INTERVAL", 2)
+    reported = []
+    n = write_samples(db, io.StringIO(), "jsonl", reported.append)
+    assert n == 5
+    assert reported == [2, 4]
+
+
+def test_export_samples(db, tmp_path):
+    out = io.StringIO()
+    export_samples(["--format", "jsonl", "--run", "CMR000002", "-q"], db, out)
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [r["sample_accession"] for r in records] == [
+        "CMS000003",
+        "CMS000004",
+        "CMS000005",
+    ]
+    assert records[0]["annotations"] == {"key2": "val0", "key6": "val0"}
+
+    fp = tmp_path / "samples.jsonl.gz"
+    export_samples(["-o", str(fp), "--start-date", "2024-07-01", "-q"], db)
+    with gzip.open(fp, "rt") as f:
+        assert [json.loads(line)["sample_name"] for line in f] == [
+            "Sample1",
+            "Sample2",
+        ]
+
+    fp = tmp_path / "samples.tsv"
+    export_samples(["-o", str(fp), "-q"], db)
+    assert len(_table(fp.read_text())) == 6
@@ -0,0 +1,127 @@
+import gzip
+import io
+import os
+import pytest
+from sample_registry.fastq_index import (
+    FastqIndex,
+    build_index,
+    extract_sample_fastq,
+    index_run_fastq,
+    read_sample_fastq,
+)
+from sample_registry.registrar import SampleRegistry
+from sample_registry.util import parse_fastq
+
+INDEXES = ["AAAA", "CCCC", "AAAT", "GGGG", "AAAA", "CCCC", "AAAA"]
+
+
+def _reads():
+    return [
+        (
+            f"M03543:21:C8LJ2ANXX:1:2209:1084:{i} 1:N:0:{index}",
+            "ACGT" * (i + 1),
+            "@" * 4 * (i + 1),
+        )
+        for i, index in enumerate(INDEXES)
+    ]
+
+
+def _fastq(reads):
+    return "".join(f"@{d}\n{s}\n+\n{q}\n" for d, s, q in reads)
+
+
+@pytest.fixture(params=["plain", "gzip", "multi_member"])
+def fastq_file(request, tmp_path):
+    text = _fastq(_reads())
+    if request.param == "plain":
+        fp = tmp_path / "Undetermined_S0_L001_R1_001.fastq"
+        fp.write_text(text)
+    elif request.param == "gzip":
+        fp = tmp_path / "Undetermined_S0_L001_R1_001.fastq.gz"
+        with gzip.open(fp, "wt") as f:
+            f.write(text)
+    else:
+        # Split members at arbitrary points, so reads straddle members
+        fp = tmp_path / "Undetermined_S0_L001_R1_001.fastq.gz"
+        data = text.encode()
+        fp.write_bytes(
+            b"".join(gzip.compress(data[i : i + 37]) for i in range(0, len(data), 37))
+        )
+    return fp
+
+
+def test_build_index(fastq_file):
+    index = build_index(fastq_file)
+    assert index.barcodes() == {"AAAA": 3, "CCCC": 2, "AAAT": 1, "GGGG": 1}
+    reads = _reads()
+    assert list(index.read(["AAAA"])) == [reads[0], reads[4], reads[6]]
+    assert list(index.read(["CCCC", "GGGG"])) == [reads[1], reads[3], reads[5]]
+    assert list(index.read(["TTTT"])) == []
+
+
+def test_build_index_multi_member_blocks(tmp_path):
+    fp = tmp_path / "reads.fastq.gz"
+    data = _fastq(_reads()).encode()
+    fp.write_bytes(
+        b"".join(gzip.compress(data[i : i + 50]) for i in range(0, len(data), 50))
+    )
+    index = build_index(fp)
+    assert len(index.blocks) == (len(data) + 49) // 50
+    # Later reads are entered from later members
+    assert index.offsets("AAAA")[-1][0] > 0
+
+
+def test_build_index_truncated(fastq_file):
+    # Drop the quality line of the last record
+    if fastq_file.suffix == ".gz":
+        text = gzip.decompress(fastq_file.read_bytes()).decode()
+        fastq_file.write_bytes(gzip.compress(text.rsplit("+\n", 1)[0].encode()))
+    else:
+        fastq_file.write_text(fastq_file.read_text().rsplit("+\n", 1)[0])
+    with pytest.raises(ValueError, match=f"record {len(INDEXES)} is truncated"):
+        build_index(fastq_file)
+    assert not os.path.exists(str(fastq_file) + ".sridx")
+
+
+def test_index_detects_changed_file(tmp_path):
+    fp = tmp_path / "reads.fastq"
+    fp.write_text(_fastq(_reads()))
+    build_index(fp)
+    with open(fp, "a") as f:
+        f.write(_fastq(_reads()[:1]))
+    with pytest.raises(ValueError):
+        FastqIndex.load(fp)
+
+
+def test_index_dir(tmp_path):
+    fp = tmp_path / "reads.fastq"
+    fp.write_text(_fastq(_reads()))
+    index_dir = tmp_path / "indexes"
+    index_dir.mkdir()
+    build_index(fp, index_dir)
+    assert os.listdir(index_dir) == ["reads.fastq.sridx"]
+    assert FastqIndex.load(fp, index_dir).barcodes()["AAAA"] == 3
+
+
+def test_read_sample_fastq(db, tmp_path):
+    fp = tmp_path / "raw_data/run1/Undetermined_S0_L002_R1_001.fastq.gz"
+    fp.parent.mkdir(parents=True)
+    with gzip.open(fp, "wt") as f:
+        f.write(_fastq(_reads()))
+
+    out = io.StringIO()
+    index_run_fastq(["1", "--archive-root", str(tmp_path)], db, out)
+    assert out.getvalue().startswith("Indexed 7 reads with 4 index sequences")
+
+    registry = SampleRegistry(db)
+    reads = _reads()
+    assert list(read_sample_fastq(registry, 1, tmp_path)) == [
+        reads[0],
+        reads[4],
+        reads[6],
+    ]
+    assert len(list(read_sample_fastq(registry, 1, tmp_path, mismatches=True))) == 4
+
+    out = io.StringIO()
+    extract_sample_fastq(["2", "--archive-root", str(tmp_path)], db, out)
+    assert list(parse_fastq(io.StringIO(out.getvalue()))) == [reads[1], reads[5]]
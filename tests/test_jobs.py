@@ -0,0 +1,215 @@
+import functools
+import io
+import json
+import time
+import pytest
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+from sample_registry import jobs
+from sample_registry.db import create_test_db
+from sample_registry.mapping import SampleTable
+from sample_registry.models import Base, RegistrationJob, Sample
+from sample_registry.operations import OperationError
+from sample_registry.registrar import SampleRegistry
+from sample_registry.writequeue import WriteQueue
+
+
+@pytest.fixture()
+def Session(tmp_path):
+    # A file, so the worker thread's connection sees the same database
+    engine = create_engine(f"sqlite:///{tmp_path / 'registry.sqlite'}", echo=False)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as session:
+        create_test_db(session)
+    return Session
+
+
+def _sample_table(n: int) -> str:
+    buf = io.StringIO()
+    SampleTable(
+        [
+            {
+                "SampleID": f"S{i}",
+                "BarcodeSequence": f"{i:08b}".replace("0", "A").replace("1", "C"),
+            }
+            for i in range(n)
+        ]
+    ).write(buf)
+    return buf.getvalue()
+
+
+def _queue(Session, operation: str, fields: dict) -> int:
+    with Session() as session:
+        job_id = jobs.create_job(SampleRegistry(session), (operation, fields))["job_id"]
+        session.commit()
+    return job_id
+
+
+def _job(Session, job_id: int) -> dict:
+    with Session() as session:
+        return jobs.job_to_dict(session.get(RegistrationJob, job_id))
+
+
+def test_create_job_checks_fields(Session):
+    with Session() as session:
+        registry = SampleRegistry(session)
+        with pytest.raises(OperationError):
+            jobs.create_job(registry, ("unregister_samples", {"run_accession": 3}))
+        with pytest.raises(OperationError):
+            jobs.create_job(registry, ("register_samples", {"run_accession": 3}))
+
+
+def test_run_pending(Session):
+    job_id = _queue(
+        Session,
+        "register_samples",
+        {"run_accession": 3, "sample_table": _sample_table(20)},
+    )
+    assert _job(Session, job_id)["status"] == "queued"
+
+    assert jobs.JobWorker(Session).run_pending() == 1
+    job = _job(Session, job_id)
+    assert job["status"] == "done"
+    assert job["sample_count"] == 20
+    assert job["finished_at"] is not None
+    assert [s["sample_name"] for s in job["result"]["samples"]] == [
+        f"S{i}" for i in range(20)
+    ]
+    with Session() as session:
+        registered = session.scalars(
+            select(Sample.sample_accession).where(Sample.run_accession == 3)
+        ).all()
+        assert sorted(registered) == [
+            s["sample_accession"] for s in job["result"]["samples"]
+        ]
+        # The upload isn't kept once the job has finished
+        assert session.get(RegistrationJob, job_id).request is None
+
+
+def test_failed_job_registers_nothing(Session):
+    # Run 1 already has samples, so registering more is refused
+    failed = _queue(
+        Session,
+        "register_samples",
+        {"run_accession": 1, "sample_table": _sample_table(5)},
+    )
+    invalid = _queue(
+        Session,
+        "register_samples",
+        {"run_accession": 3, "sample_table": "not a sample table"},
+    )
+    with Session() as session:
+        before = len(session.scalars(select(Sample)).all())
+
+    assert jobs.JobWorker(Session).run_pending() == 2
+    assert _job(Session, failed)["status"] == "failed"
+    assert "Samples don't exist" in _job(Session, failed)["error"]
+    assert _job(Session, invalid)["status"] == "failed"
+    assert _job(Session, invalid)["stage"] is None
+    with Session() as session:
+        assert len(session.scalars(select(Sample)).all()) == before
+
+
+def test_run_pending_through_write_queue(Session):
+    job_id = _queue(
+        Session,
+        "register_samples",
+        {"run_accession": 3, "sample_table": _sample_table(5)},
+    )
+    failed = _queue(
+        Session,
+        "register_samples",
+        {"run_accession": 1, "sample_table": _sample_table(5)},
+    )
+    q = WriteQueue(Session)
+    worker = jobs.JobWorker(Session, submit=functools.partial(q.submit, block=True))
+    assert worker.run_pending() == 2
+    assert _job(Session, job_id)["status"] == "done"
+    assert len(_job(Session, job_id)["result"]["samples"]) == 5
+    assert _job(Session, failed)["status"] == "failed"
+    # Each job's claim, stage and outcome, then the claim that found nothing,
+    # were committed by the queue's writer
+    assert q.groups_committed == 7
+
+
+def test_jobs_are_claimed_once(Session):
+    job_id = _queue(
+        Session,
+        "register_samples",
+        {"run_accession": 3, "sample_table": _sample_table(2)},
+    )
+    with Session() as session:
+        registry = SampleRegistry(session)
+        assert registry.claim_next_job(jobs.JOB_LEASE).job_id == job_id
+        assert registry.claim_next_job(jobs.JOB_LEASE) is None
+
+
+def test_expired_running_job_is_taken_over(Session):
+    job_id = _queue(
+        Session,
+        "register_samples",
+        {"run_accession": 3, "sample_table": _sample_table(2)},
+    )
+    with Session() as session:
+        registry = SampleRegistry(session)
+        data = json.loads(registry.claim_next_job(jobs.JOB_LEASE).request)
+        session.commit()
+    assert jobs.JobWorker(Session).run_pending() == 0
+
+    # The process running the job died two hours ago
+    claim = datetime.now() - timedelta(hours=2)
+    with Session() as session:
+        job = session.get(RegistrationJob, job_id)
+        job.started_at = job.heartbeat_at = claim
+        session.commit()
+    assert jobs.JobWorker(Session).run_pending() == 1
+    done = _job(Session, job_id)
+    assert done["status"] == "done"
+
+    # A run that outlived its claim commits nothing
+    jobs.run_job(
+        jobs.JobWorker(Session).submit, job_id, "register_samples", data, claim
+    )
+    assert _job(Session, job_id) == done
+    with Session() as session:
+        registered = session.scalars(select(Sample).where(Sample.run_accession == 3))
+        assert len(registered.all()) == 2
+
+
+def test_running_job_is_not_taken_over(Session):
+    job_id = _queue(
+        Session,
+        "register_samples",
+        {"run_accession": 3, "sample_table": _sample_table(2)},
+    )
+    lease = timedelta(seconds=0.4)
+    other = jobs.JobWorker(Session, lease=lease)
+    taken_over = []
+
+    def slow_submit(operation, data):
+        if operation is jobs._register_job:
+            # Registering outlasts several leases while another worker looks
+            # for work
+            for _ in range(4):
+                time.sleep(lease.total_seconds())
+                taken_over.append(other.run_pending())
+        return jobs.apply_write(Session, operation, data)
+
+    assert jobs.JobWorker(Session, lease=lease, submit=slow_submit).run_pending() == 1
+    assert taken_over == [0, 0, 0, 0]
+    assert _job(Session, job_id)["status"] == "done"
+
+
+def test_worker_thread(Session):
+    job_id = _queue(
+        Session,
+        "register_samples",
+        {"run_accession": 3, "sample_table": _sample_table(3)},
+    )
+    jobs.JobWorker(Session).notify()
+    deadline = time.monotonic() + 10
+    while _job(Session, job_id)["status"] != "done":
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
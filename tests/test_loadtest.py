@@ -0,0 +1,162 @@
+import io
+import json
+import random
+import pytest
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import Session
+from sample_registry.loadtest import (
+    LoadResult,
+    Targets,
+    count_lock_errors,
+    generate_registry,
+    loadtest,
+    make_request,
+    parse_mix,
+    percentile,
+    server_command,
+    summarize,
+)
+from sample_registry.models import Annotation, Base, Run, Sample
+
+
+def test_parse_mix():
+    assert parse_mix("run=4,write=1") == {"run": 4.0, "write": 1.0}
+    assert parse_mix("tag") == {"tag": 1.0}
+    with pytest.raises(ValueError):
+        parse_mix("run=4,upload=1")
+    with pytest.raises(ValueError):
+        parse_mix("run=0")
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([], 50) == 0.0
+
+
+def test_summarize():
+    results = [LoadResult("run", 0.01 * i, 200) for i in range(1, 10)]
+    results.append(
+        LoadResult("write", 0.5, 500, "OperationalError: database is locked")
+    )
+    summary = summarize(results, 2.0, lock_errors=1)
+    assert summary["requests"] == 10
+    assert summary["throughput"] == 5.0
+    assert summary["errors"] == 1
+    assert summary["lock_errors"] == 2
+    assert summary["kinds"]["run"]["p50_ms"] == pytest.approx(50)
+    assert summary["kinds"]["write"]["error_rate"] == 1.0
+
+
+def test_generate_registry():
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        generate_registry(session, runs=3, samples_per_run=10, keys=2)
+        assert session.scalar(select(func.count()).select_from(Run)) == 3
+        assert session.scalar(select(func.count()).select_from(Sample)) == 30
+        assert session.scalar(select(func.count()).select_from(Annotation)) == 60
+
+
+def test_make_request():
+    targets = Targets(["CMR000001"], ["CMS000005"], [("key0", "val1")])
+    rng = random.Random(0)
+    assert make_request("run", targets, rng) == ("/runs/000001", None)
+    path, body = make_request("write", targets, rng)
+    assert path == "/api/patch_samples"
+    assert json.loads(body)["patches"][0][:2] == ["CMS000005", "loadtest"]
+
+
+def test_count_lock_errors(tmp_path):
+    failure = (
+        "[2024-08-01 12:00:00] ERROR in app: Exception on /api/patch_samples\n"
+        "Traceback (most recent call last):\n"
+        '  File "base.py", line 1, in _execute_context\n'
+        "sqlite3.OperationalError: database is locked\n"
+        "\n"
+        "The above exception was the direct cause of the following exception:\n"
+        "\n"
+        "Traceback (most recent call last):\n"
+        '  File "app.py", line 1, in api_patch_samples\n'
+        "sqlalchemy.exc.OperationalError: (sqlite3.OperationalError) "
+        "database is locked\n"
+        "[SQL: UPDATE annotations SET val=?]\n"
+    )
+    log_path = tmp_path / "server.log"
+    log_path.write_text(failure + "127.0.0.1 - GET /runs 200\n" + failure)
+    assert count_lock_errors(log_path) == 2
+
+
+def test_loadtest(tmp_path):
+    out = io.StringIO()
+    summaries = loadtest(
+        [
+            "--db",
+            str(tmp_path / "registry.sqlite"),
+            "--runs",
+            "2",
+            "--samples-per-run",
+            "5",
+            "--threads",
+            "2",
+            "--duration",
+            "0.5",
+            "--json",
+        ],
+        out=out,
+    )
+    # A read-only mix, then one with writes
+    assert list(summaries["dev"]) == ["read", "write"]
+    assert "write" not in summaries["dev"]["read"]["kinds"]
+    assert "write" in summaries["dev"]["write"]["kinds"]
+    summary = summaries["dev"]["write"]
+    assert summary["requests"] > 0
+    assert summary["errors"] == 0
+    assert json.loads(out.getvalue())["dev"]["write"]["requests"] == summary["requests"]
+    # Writes change real rows
+    engine = create_engine(f"sqlite:///{tmp_path / 'registry.sqlite'}")
+    with Session(engine) as session:
+        assert session.scalar(
+            select(func.count())
+            .select_from(Annotation)
+            .where(Annotation.key == "loadtest")
+        )
+    engine.dispose()
+
+
+def test_server_command():
+    cmd = server_command("gunicorn", 8000, 4)
+    assert cmd[cmd.index("--workers") + 1] == "4"
+    assert "--workers" not in server_command("dev", 8000, 4)
+
+
+def test_loadtest_compares_servers(tmp_path):
+    pytest.importorskip("gunicorn")
+    out = io.StringIO()
+    summaries = loadtest(
+        [
+            "--db",
+            str(tmp_path / "registry.sqlite"),
+            "--runs",
+            "2",
+            "--samples-per-run",
+            "5",
+            "--threads",
+            "2",
+            "--duration",
+            "0.5",
+            "--server",
+            "dev",
+            "--server",
+            "gunicorn",
+            "--workers",
+            "2",
+        ],
+        out=out,
+    )
+    assert summaries["gunicorn"]["read"]["requests"] > 0
+    assert summaries["gunicorn"]["write"]["errors"] == 0
+    assert "== gunicorn, read mix ==" in out.getvalue()
+    assert "the requests/s of dev with the write mix" in out.getvalue()
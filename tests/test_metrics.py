@@ -0,0 +1,112 @@
+import json
+from sqlalchemy import create_engine, text
+from sample_registry import metrics
+from sample_registry.metrics import Metrics, render
+from sample_registry.models import Sample
+
+
+def test_render_counters_and_histograms():
+    m = Metrics()
+    m.inc("sample_registry_http_requests_total", route="show_runs", status="200")
+    m.inc("sample_registry_http_requests_total", route="show_runs", status="200")
+    m.observe("sample_registry_http_request_duration_seconds", 0.02, route="a")
+    m.observe("sample_registry_http_request_duration_seconds", 20, route="a")
+    text = render(m)
+    assert "# TYPE sample_registry_http_requests_total counter" in text
+    assert (
+        'sample_registry_http_requests_total{route="show_runs",status="200"} 2' in text
+    )
+    assert (
+        'sample_registry_http_request_duration_seconds_bucket{route="a",le="0.01"} 0'
+        in text
+    )
+    assert (
+        'sample_registry_http_request_duration_seconds_bucket{route="a",le="0.025"} 1'
+        in text
+    )
+    assert (
+        'sample_registry_http_request_duration_seconds_bucket{route="a",le="+Inf"} 2'
+        in text
+    )
+    assert 'sample_registry_http_request_duration_seconds_count{route="a"} 2' in text
+    assert 'sample_registry_http_request_duration_seconds_sum{route="a"} 20.02' in text
+
+
+def test_label_values_are_escaped():
+    m = Metrics()
+    m.inc("x_total", route='a"b\\c')
+    assert 'x_total{route="a\\"b\\\\c"} 1' in render(m)
+
+
+def test_workers_are_summed_from_snapshots(tmp_path, monkeypatch):
+    monkeypatch.setenv(metrics.METRICS_DIR_ENV, str(tmp_path))
+    monkeypatch.setattr(metrics, "METRICS", Metrics())
+    metrics.METRICS.inc("x_total", op="a")
+    metrics.METRICS.observe("y_seconds", 0.1)
+
+    # Another worker's snapshot
+    other = Metrics()
+    other.inc("x_total", op="a", value=2)
+    other.inc("x_total", op="b")
+    other.observe("y_seconds", 1)
+    (tmp_path / "1.json").write_text(json.dumps(other.snapshot()))
+
+    merged = metrics.collect()
+    assert merged.counters[("x_total", (("op", "a"),))] == 3
+    assert merged.counters[("x_total", (("op", "b"),))] == 1
+    assert sum(merged.histograms[("y_seconds", ())][:-1]) == 2
+    # This process's values were saved for the other workers
+    assert len(list(tmp_path.glob("*.json"))) == 2
+
+
+def test_exited_workers_are_folded_together(tmp_path, monkeypatch):
+    monkeypatch.setenv(metrics.METRICS_DIR_ENV, str(tmp_path))
+    monkeypatch.setattr(metrics, "METRICS", Metrics())
+    for pid in (101, 102):
+        other = Metrics()
+        other.inc("x_total", value=pid)
+        other.add_gauge("in_use", 1)
+        (tmp_path / f"{pid}.json").write_text(json.dumps(other.snapshot()))
+        metrics.retire_snapshot(pid)
+    # Never written, as when a worker dies before its first request
+    metrics.retire_snapshot(103)
+
+    assert sorted(fp.name for fp in tmp_path.iterdir()) == ["exited.json"]
+    merged = metrics.collect()
+    assert merged.counters[("x_total", ())] == 203
+    assert ("in_use", ()) not in merged.gauges
+
+    metrics.clear_snapshots()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_registry_sizes_are_cached(db, monkeypatch):
+    monkeypatch.setattr(metrics, "_registry_sizes", None)
+    assert metrics.registry_sizes(db)["samples"] == 5
+    db.add(Sample(sample_name="new", run_accession=1, barcode_sequence="ACGT"))
+    db.flush()
+    assert metrics.registry_sizes(db)["samples"] == 5
+    monkeypatch.setattr(metrics, "REGISTRY_SIZES_TTL", 0)
+    assert metrics.registry_sizes(db)["samples"] == 6
+
+
+def _pool_waits() -> int:
+    return sum(
+        sum(h[:-1])
+        for name, _, h in metrics.METRICS.snapshot()["histograms"]
+        if name == "sample_registry_db_pool_wait_seconds"
+    )
+
+
+def test_pool_wait_is_timed():
+    engine = create_engine("sqlite://")
+    metrics.instrument_engine(engine)
+    # Still timed once the pool is replaced, as in a forked worker
+    engine.dispose(close=False)
+    before = _pool_waits()
+    with engine.connect() as conn:
+        conn.execute(text("select 1"))
+    assert _pool_waits() == before + 1
+    assert "# TYPE sample_registry_db_pool_wait_seconds histogram" in render(
+        metrics.METRICS
+    )
@@ -3,22 +3,17 @@ import io
 import os
 import pytest
 import tempfile
-from sqlalchemy import and_, create_engine, select
-from sqlalchemy.orm import Session, sessionmaker
-from typing import Generator
-from sample_registry.db import create_test_db
+from sqlalchemy import and_, select
+from sample_registry import register
 from sample_registry.mapping import SampleTable
-from sample_registry.models import (
-    Annotation,
-    Base,
-    Run,
-    Sample,
-)
+from sample_registry.models import Annotation, Run, Sample
 from sample_registry.register import (
     register_run,
     register_sample_annotations,
     unregister_samples,
     register_illumina_file,
+    register_run_directory,
+    patch_samples,
 )
 
 samples = [
@@ -59,24 +54,6 @@ run_args = [
 ]
 
 
-@pytest.fixture()
-def db() -> Generator[Session, None, None]:
-    # This fixture should run before every test and create a new in-memory SQLite test database with identical data
-    SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
-    engine = create_engine(SQLALCHEMY_DATABASE_URI, echo=False)
-    Base.metadata.create_all(engine)
-
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    create_test_db(session)
-
-    yield session
-
-    session.rollback()
-    session.close()
-
-
 @pytest.fixture
 def temp_sample_file():
     f = tempfile.NamedTemporaryFile(mode="wt")
@@ -130,6 +107,58 @@ def test_register_illumina_file(tmpdir, db):
     assert db.scalar(select(Run.data_uri).where(Run.run_accession == 4)) == relative_fp
 
 
+def test_register_run_directory(tmpdir, db, monkeypatch):
+    run_dir = "Miseq/160511_M03543_0047_000000000-APE6Y"
+    fastq_dir = os.path.join(run_dir, "Data/Intensities/BaseCalls")
+    os.makedirs(os.path.join(tmpdir, fastq_dir))
+    relative_fps = []
+    for lane in [1, 2]:
+        relative_fp = os.path.join(
+            fastq_dir, f"Undetermined_S0_L00{lane}_R1_001.fastq.gz"
+        )
+        with gzip.open(os.path.join(tmpdir, relative_fp), "wt") as f:
+            f.write(
+                f"@M03543:21:C8LJ2ANXX:{lane}:2209:1084:2044 1:N:0:NNNNNNNN+NNNNNNNN"
+            )
+        relative_fps.append(relative_fp)
+    # Other reads in the folder are not registered
+    with gzip.open(
+        os.path.join(tmpdir, fastq_dir, "Sample1_S1_L001_R1_001.fastq.gz"), "wt"
+    ) as f:
+        f.write("@M03543:21:C8LJ2ANXX:1:2209:1084:2044 1:N:0:NNNNNNNN+NNNNNNNN")
+
+    read = []
+    read_illumina_file = register._read_illumina_file
+
+    def record(fp):
+        read.append(fp)
+        return read_illumina_file(fp)
+
+    original_cwd = os.getcwd()
+    os.chdir(tmpdir)
+    try:
+        register_illumina_file([relative_fps[0], "abcd efg"], db, io.StringIO())
+        monkeypatch.setattr(register, "_read_illumina_file", record)
+        out = io.StringIO()
+        register_run_directory([run_dir, "abcd efg"], db, out)
+    finally:
+        os.chdir(original_cwd)
+
+    # The file registered already isn't opened again
+    assert read == relative_fps[1:]
+
+    assert out.getvalue().endswith("Registered 1 runs in the database\n")
+    assert (
+        db.scalars(
+            select(Run.data_uri)
+            .where(Run.run_accession > 3)
+            .order_by(Run.run_accession)
+        ).all()
+        == relative_fps
+    )
+    assert db.scalar(select(Run.lane).where(Run.run_accession == 5)) == 2
+
+
 def test_register_samples(db, temp_sample_file):
     register_run(run_args, db)
     sample_file = temp_sample_file
@@ -231,3 +260,11 @@ def test_unregister_samples(db, temp_sample_file):
     assert not db.scalar(select(Sample).where(Sample.run_accession == 4))
     assert not db.scalar(select(Annotation).where(Annotation.sample_accession == 6))
     assert not db.scalar(select(Annotation).where(Annotation.sample_accession == 7))
+
+
+def test_patch_samples(db, tmp_path):
+    fp = tmp_path / "patches.tsv"
+    fp.write_text("1\tsubject_id\tSubject1b\nCMS000003\tkey2\tval0\n")
+    out = io.StringIO()
+    patch_samples([str(fp)], db, out)
+    assert out.getvalue() == "Inserted 0, updated 1, unchanged 1\n"
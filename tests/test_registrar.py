@@ -1,15 +1,22 @@
-from typing import Generator
+from datetime import datetime, timedelta
 import pytest
-from sqlalchemy import create_engine, func, select
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy import create_engine, delete, func, inspect, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateIndex
 from sample_registry.db import create_test_db
 from sample_registry.mapping import SampleTable
 from sample_registry.models import (
     Annotation,
     Base,
+    IdempotencyKey,
+    ReadCount,
     Run,
+    RunPath,
     Sample,
 )
+from sample_registry import bulk
+from sample_registry.instrument import StatementCounter
 from sample_registry.registrar import SampleRegistry
 
 recs = [
@@ -28,24 +35,6 @@ recs = [
 ]
 
 
-@pytest.fixture()
-def db() -> Generator[Session, None, None]:
-    # This fixture should run before every test and create a new in-memory SQLite test database with identical data
-    SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
-    engine = create_engine(SQLALCHEMY_DATABASE_URI, echo=False)
-    Base.metadata.create_all(engine)
-
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    create_test_db(session)
-
-    yield session
-
-    session.rollback()
-    session.close()
-
-
 def test_check_run_accession(db):
     registry = SampleRegistry(db)
     assert registry.check_run_accession(1).run_accession == 1
@@ -68,6 +57,176 @@ def test_get_runs_by_data_uri(db):
     assert registry.get_runs_by_data_uri("run1") == [1]
     assert registry.get_runs_by_data_uri("raw_data") == [1, 2, 3]
     assert registry.get_runs_by_data_uri("not-a-uri") == []
+    assert registry.get_runs_by_data_uri("") == [1, 2, 3]
+
+
+def test_resolve_data_uris(db):
+    registry = SampleRegistry(db)
+    assert registry.resolve_data_uris(
+        [
+            "raw_data/run1/Undetermined_S0_L002_R1_001.fastq.gz",
+            "raw_data/run3/Undetermined_S0_L001_R1_001.fastq.gz",
+            "run1",
+        ]
+    ) == {
+        "raw_data/run1/Undetermined_S0_L002_R1_001.fastq.gz": [1],
+        "raw_data/run3/Undetermined_S0_L001_R1_001.fastq.gz": [3],
+    }
+
+
+def test_get_runs_by_data_uri_indexed(db):
+    registry = SampleRegistry(db)
+    registry.register_run(
+        "2024-08-01",
+        "Illumina-MiSeq",
+        "Nextera XT",
+        1,
+        "Miseq/160511_M03543_0047_000000000-APE6Y/Data/Intensities/BaseCalls/"
+        "Undetermined_S0_L001_R1_001.fastq.gz",
+        "A comment",
+    )
+    assert registry.get_runs_by_data_uri("160511_M03543_0047_000000000-APE6Y") == [4]
+    assert registry.get_runs_by_data_uri("Undetermined_S0_L002_R1_001.fastq.gz") == [1]
+    assert registry.get_runs_by_data_uri("raw_data/run") == [1, 2, 3]
+    assert registry.get_runs_by_run_folder("160511_M03543_0047_000000000-APE6Y", 1) == [
+        4
+    ]
+    assert (
+        registry.get_runs_by_run_folder("160511_M03543_0047_000000000-APE6Y", 2) == []
+    )
+    # Answered from the run_paths and data_uri indexes, without a scan
+    with StatementCounter(db.get_bind()) as counter:
+        assert registry.get_runs_by_data_uri(
+            "Data/Intensities/BaseCalls/Undetermined_S0_L001_R1_001.fastq.gz"
+        ) == [4]
+        assert registry.get_runs_by_data_uri("raw_data/run1/") == [1]
+    # Any LIKE only filters the runs found through run_paths
+    assert not any("LIKE" in s and "run_paths" not in s for s in counter.statements)
+
+
+def test_get_runs_by_data_uri_finds_every_run_containing_it(db):
+    registry = SampleRegistry(db)
+    registry.register_run(
+        "2024-08-01",
+        "Illumina-MiSeq",
+        "Nextera XT",
+        1,
+        "copies/raw_data/run1/Undetermined_S0_L002_R1_001.fastq.gz",
+        "A comment",
+    )
+    # An exact match for run 1 and a substring of run 4's data_uri
+    assert registry.get_runs_by_data_uri(
+        "raw_data/run1/Undetermined_S0_L002_R1_001.fastq.gz"
+    ) == [1, 4]
+    assert registry.resolve_data_uris(["raw_data/run1/"], "prefix") == {
+        "raw_data/run1/": [1]
+    }
+
+
+def test_data_uri_pattern_index_is_postgres_only(db):
+    index = next(
+        i for i in Run.__table__.indexes if i.name == "ix_runs_data_uri_pattern"
+    )
+    assert "text_pattern_ops" in str(
+        CreateIndex(index).compile(dialect=postgresql.dialect())
+    )
+    assert "ix_runs_data_uri_pattern" not in {
+        i["name"] for i in inspect(db.get_bind()).get_indexes("runs")
+    }
+
+
+def test_resolve_data_uris_bulk(db):
+    registry = SampleRegistry(db)
+    assert registry.resolve_data_uris(
+        ["raw_data/run1/", "raw_data/run2/", "raw_data/run9/"], "prefix"
+    ) == {"raw_data/run1/": [1], "raw_data/run2/": [2]}
+    assert registry.resolve_data_uris(
+        ["/elsewhere/Undetermined_S0_L004_R1_001.fastq.gz", "missing.fastq.gz"],
+        "file_name",
+    ) == {"/elsewhere/Undetermined_S0_L004_R1_001.fastq.gz": [2]}
+    with pytest.raises(ValueError):
+        registry.resolve_data_uris(["x"], "suffix")
+
+
+def test_modify_run_data_uri_updates_index(db):
+    registry = SampleRegistry(db)
+    registry.modify_run(1, data_uri="raw_data/run1/renamed.fastq.gz")
+    assert registry.resolve_data_uris(["renamed.fastq.gz"], "file_name") == {
+        "renamed.fastq.gz": [1]
+    }
+    assert (
+        registry.resolve_data_uris(
+            ["Undetermined_S0_L002_R1_001.fastq.gz"], "file_name"
+        )
+        == {}
+    )
+
+
+def test_index_run_paths(db):
+    registry = SampleRegistry(db)
+    db.execute(delete(RunPath))
+    assert registry.index_run_paths() == 3
+    assert registry.index_run_paths() == 0
+    assert registry.resolve_data_uris(
+        ["Undetermined_S0_L001_R1_001.fastq.gz"], "file_name"
+    ) == {"Undetermined_S0_L001_R1_001.fastq.gz": [3]}
+
+
+def test_resolve_many(db, monkeypatch):
+    monkeypatch.setattr(bulk, "max_params", lambda session: bulk.RESERVED_PARAMS + 2)
+    registry = SampleRegistry(db)
+    resolved = registry.resolve_many(
+        ["CMS000001", "cms3", "CMS000004", "CMR000003", "CMS000099", "CMR9", "S1"]
+    )
+    assert list(resolved["samples"]) == ["CMS000001", "CMS000003", "CMS000004"]
+    # Runs of the requested samples come along with the requested run
+    assert list(resolved["runs"]) == ["CMR000001", "CMR000002", "CMR000003"]
+    assert resolved["samples"]["CMS000001"]["run_accession"] == "CMR000001"
+    assert resolved["samples"]["CMS000001"]["annotations"] == {
+        "key0": "val0",
+        "key4": "val0",
+    }
+    assert resolved["not_found"] == ["CMS000099", "CMR9"]
+    assert resolved["invalid"] == ["S1"]
+
+
+def test_get_sample_page(db):
+    registry = SampleRegistry(db)
+    page = registry.get_sample_page(after=1, limit=2)
+    assert [s["sample_accession"] for s in page] == ["CMS000002", "CMS000003"]
+    assert page[0]["annotations"] == {"key1": "val1", "key5": "val1"}
+    page = registry.get_sample_page(after=3, run_accessions=[1, 2], tag="key0")
+    assert [s["sample_accession"] for s in page] == []
+    page = registry.get_sample_page(
+        tag="HostSpecies", val="Human", start_date="2024-07-01"
+    )
+    assert [s["sample_accession"] for s in page] == ["CMS000001", "CMS000002"]
+
+
+def test_apply_patches(db, monkeypatch):
+    monkeypatch.setattr(bulk, "max_params", lambda session: bulk.RESERVED_PARAMS + 3)
+    registry = SampleRegistry(db)
+    counts = registry.apply_patches(
+        [
+            (1, "SubjectID", "Subject1"),  # unchanged
+            (2, "subject_id", "Subject2a"),
+            (3, "host_species", "Mouse"),
+            (1, "key0", "val0"),  # unchanged
+            (1, "key0", "val9"),  # last value wins
+            (2, "key1", "val1"),  # unchanged
+            (4, "new_key", "a"),
+            (5, "new_key", "b"),
+        ]
+    )
+    assert counts == {"inserted": 2, "updated": 3, "unchanged": 2}
+    db.expire_all()
+    assert db.get(Sample, 2).subject_id == "Subject2a"
+    assert db.get(Sample, 3).host_species == "Mouse"
+    assert db.get(Annotation, (1, "key0")).val == "val9"
+    assert db.get(Annotation, (5, "new_key")).val == "b"
+
+    with pytest.raises(ValueError):
+        registry.apply_patches([(99, "key0", "x")])
 
 
 def test_check_run_accession_doesnt_exist(db):
@@ -154,6 +313,15 @@ def test_remove_samples(db):
     )
 
 
+def test_remove_samples_with_read_counts(db):
+    registry = SampleRegistry(db)
+    registry.register_read_counts({1: (10, 2), 2: (5, 0)})
+    sample_accessions = registry.remove_samples(1)
+    assert not db.scalar(
+        select(ReadCount).where(ReadCount.sample_accession.in_(sample_accessions))
+    )
+
+
 def test_register_annotations(db):
     registry = SampleRegistry(db)
     sample_table = SampleTable(recs)
@@ -170,6 +338,33 @@ def test_register_annotations(db):
     )
 
 
+def test_sync_annotations(db):
+    registry = SampleRegistry(db)
+    registry.register_samples(3, SampleTable(recs))
+    registry.register_annotations(3, SampleTable(recs))
+
+    changed = [
+        dict(recs[0], HostSpecies="Mouse"),
+        {"SampleID": "S2", "BarcodeSequence": "GCAT", "key1": "val1", "key3": "x"},
+    ]
+    counts = registry.sync_annotations(3, SampleTable(changed))
+    assert counts == {"inserted": 1, "updated": 1, "deleted": 1, "unchanged": 2}
+    db.expire_all()
+    assert db.get(Sample, 6).host_species == "Mouse"
+    assert {
+        a.key: a.val
+        for a in db.scalars(select(Annotation).where(Annotation.sample_accession == 7))
+    } == {"key1": "val1", "key3": "x"}
+
+    counts = registry.sync_annotations(3, SampleTable(changed))
+    assert counts == {"inserted": 0, "updated": 0, "deleted": 0, "unchanged": 4}
+
+    with pytest.raises(IOError):
+        registry.sync_annotations(
+            3, SampleTable([{"SampleID": "S9", "BarcodeSequence": "AAAA"}])
+        )
+
+
 def test_modify_annotation(db):
     registry = SampleRegistry(db)
     registry.modify_annotation(1, "key0", "new val")
@@ -181,3 +376,123 @@ def test_modify_annotation(db):
         ).val
         == "new val"
     )
+
+
+def test_modify_annotations_skips_missing(db):
+    registry = SampleRegistry(db)
+    registry.modify_annotations(
+        [
+            {"sample_accession": 1, "key": "key0", "val": "new val"},
+            {"sample_accession": 1, "key": "missing", "val": "x"},
+        ]
+    )
+    assert registry.get_annotations(1)[0].val == "new val"
+    assert "missing" not in {a.key for a in registry.get_annotations(1)}
+
+
+def test_reserve_idempotency_key(db):
+    registry = SampleRegistry(db)
+    assert registry.reserve_idempotency_key("k", "abc", timedelta(hours=1)) is None
+    claimed = registry.reserve_idempotency_key("k", "def", timedelta(hours=1))
+    assert claimed.fingerprint == "abc"
+    assert claimed.status_code is None
+
+    # A finished request's response isn't removed by a release
+    registry.save_idempotent_response("k", 200, '{"status": "ok"}', timedelta(days=1))
+    registry.release_idempotency_key("k")
+    assert db.get(IdempotencyKey, "k").status_code == 200
+    assert db.get(IdempotencyKey, "k").expires_at > datetime.now() + timedelta(hours=1)
+
+    # Once expired, the key is free to claim again
+    db.get(IdempotencyKey, "k").expires_at = datetime.now() - timedelta(seconds=1)
+    assert registry.reserve_idempotency_key("k", "def", timedelta(hours=1)) is None
+    assert db.get(IdempotencyKey, "k").fingerprint == "def"
+
+
+def test_reserve_idempotency_key_takes_over_expired_lease(db):
+    registry = SampleRegistry(db)
+    assert registry.reserve_idempotency_key("k", "abc", timedelta(seconds=-1)) is None
+    assert registry.reserve_idempotency_key("k", "abc", timedelta(minutes=5)) is None
+    registry.release_idempotency_key("k")
+    assert db.get(IdempotencyKey, "k") is None
+
+
+# Most statements each registrar method may run, whatever the number of samples
+STATEMENT_BUDGETS = {
+    "register_samples": 3,
+    "register_annotations": 4,
+    "sync_annotations": 6,
+    "check_samples": 1,
+    "check_sample_accessions": 1,
+    "get_samples": 1,
+    "get_sample_page": 2,
+    "resolve_many": 3,
+    "modify_samples": 1,
+    "modify_annotations": 1,
+    "apply_patches": 5,
+    "remove_samples": 4,
+}
+
+
+def _count_statements(n_samples: int) -> dict[str, int]:
+    engine = create_engine("sqlite:///:memory:", echo=False)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    create_test_db(session)
+    registry = SampleRegistry(session)
+    table_recs = [
+        {
+            "SampleID": f"S{i}",
+            "BarcodeSequence": f"{i:08d}",
+            "SampleType": "Feces",
+            "plate": str(i),
+        }
+        for i in range(n_samples)
+    ]
+    resynced = SampleTable([dict(r, plate="A", SubjectID="x") for r in table_recs])
+    accs = []
+    calls = {
+        "register_samples": lambda: accs.extend(
+            registry.register_samples(3, SampleTable(table_recs))
+        ),
+        "register_annotations": lambda: registry.register_annotations(
+            3, SampleTable(table_recs)
+        ),
+        "sync_annotations": lambda: registry.sync_annotations(3, resynced),
+        "check_samples": lambda: registry.check_samples(3),
+        "check_sample_accessions": lambda: registry.check_sample_accessions(accs),
+        "get_samples": lambda: registry.get_samples(3),
+        "get_sample_page": lambda: registry.get_sample_page(0, 1000, tag="plate"),
+        "resolve_many": lambda: registry.resolve_many(
+            ["CMS{:06d}".format(a) for a in accs] + ["CMR000003"]
+        ),
+        "modify_samples": lambda: registry.modify_samples(
+            [{"sample_accession": a, "sample_type": "Blood"} for a in accs]
+        ),
+        "modify_annotations": lambda: registry.modify_annotations(
+            [{"sample_accession": a, "key": "plate", "val": "B"} for a in accs]
+        ),
+        "apply_patches": lambda: registry.apply_patches(
+            [(a, "plate", "C") for a in accs] + [(a, "new", "1") for a in accs]
+        ),
+        "remove_samples": lambda: registry.remove_samples(3),
+    }
+    counts = {}
+    for name, call in calls.items():
+        with StatementCounter(engine) as counter:
+            call()
+        counts[name] = counter.count
+    session.close()
+    return counts
+
+
+def test_statement_budgets():
+    small = _count_statements(5)
+    large = _count_statements(60)
+    assert set(small) == set(STATEMENT_BUDGETS)
+    over_budget = {
+        name: (small[name], large[name])
+        for name, budget in STATEMENT_BUDGETS.items()
+        if large[name] > budget or large[name] != small[name]
+    }
+    assert over_budget == {}
@@ -0,0 +1,91 @@
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import Session
+from sample_registry.db import create_test_db
+from sample_registry.models import Annotation, Base, Sample
+from sample_registry.slowlog import explain, init_engines, read_slow_queries
+
+
+def _engine():
+    engine = create_engine("sqlite:///:memory:", echo=False)
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        create_test_db(session)
+    return engine
+
+
+def test_slow_queries_are_logged_with_plan(tmp_path):
+    engine = _engine()
+    path = tmp_path / "logs/slow.log"
+    init_engines([engine], 0, path)
+    with Session(engine) as session:
+        session.scalars(
+            select(Sample)
+            .join(Annotation, Annotation.sample_accession == Sample.sample_accession)
+            .where(Annotation.key == "key0", Annotation.val == "val0")
+        ).all()
+
+    records = read_slow_queries(path)
+    record = records[0]
+    assert "FROM samples JOIN annotations" in record["statement"]
+    assert record["parameters"] == ["'key0'", "'val0'"]
+    assert any("ix_annotations_key_val" in " ".join(row) for row in record["plan"])
+
+
+def test_fast_queries_are_not_logged(tmp_path):
+    engine = _engine()
+    path = tmp_path / "slow.log"
+    init_engines([engine], 60000, path)
+    with Session(engine) as session:
+        session.scalars(select(Sample)).all()
+    assert read_slow_queries(path) == []
+
+
+class _FailingExplainCursor:
+    def __init__(self, executed):
+        self.executed = executed
+
+    def execute(self, statement, parameters=()):
+        self.executed.append(statement)
+        if statement.startswith("EXPLAIN"):
+            raise RuntimeError("syntax error")
+
+    def close(self):
+        pass
+
+
+class _Connection:
+    def __init__(self):
+        self.executed = []
+
+    def cursor(self):
+        return _FailingExplainCursor(self.executed)
+
+
+def test_failed_explain_is_rolled_back_to_a_savepoint():
+    conn = _Connection()
+    plan = explain(conn, "postgresql", "SELECT * FROM nope", ())
+    assert plan == [["EXPLAIN failed: syntax error"]]
+    assert conn.executed == [
+        "SAVEPOINT sample_registry_explain",
+        "EXPLAIN SELECT * FROM nope",
+        "ROLLBACK TO SAVEPOINT sample_registry_explain",
+        "RELEASE SAVEPOINT sample_registry_explain",
+    ]
+
+
+def test_explain_leaves_the_transaction_open(tmp_path):
+    engine = _engine()
+    init_engines([engine], 0, tmp_path / "slow.log")
+    with Session(engine) as session:
+        session.add(Annotation(sample_accession=1, key="new", val="x"))
+        session.flush()
+        session.scalars(select(Sample)).all()
+        assert session.scalar(select(Annotation).where(Annotation.key == "new"))
+
+
+def test_read_slow_queries_includes_backups(tmp_path):
+    path = tmp_path / "slow.log"
+    (tmp_path / "slow.log.1").write_text('{"statement": "a"}\n{"statement": "b"}\n')
+    path.write_text('{"statement": "c"}\nnot json\n')
+    assert [r["statement"] for r in read_slow_queries(path)] == ["c", "b", "a"]
+    assert [r["statement"] for r in read_slow_queries(path, limit=2)] == ["c", "b"]
@@ -0,0 +1,111 @@
+import collections
+import gzip
+import io
+import random
+import pytest
+from sample_registry.registrar import SampleRegistry
+from sample_registry.subsample import (
+    Reservoir,
+    sample_reads,
+    subsample_info,
+    subsample_path,
+    subsample_run,
+    write_subsample,
+)
+from sample_registry.util import parse_fastq
+
+
+def _fastq(n, indexes=("AAAA", "CCCC", "GGGG")):
+    return "".join(
+        f"@read{i} 1:N:0:{indexes[i % len(indexes)]}\nACGT\n+\n####\n" for i in range(n)
+    )
+
+
+@pytest.fixture()
+def archive(tmp_path):
+    fp = tmp_path / "archive/raw_data/run1/Undetermined_S0_L002_R1_001.fastq.gz"
+    fp.parent.mkdir(parents=True)
+    with gzip.open(fp, "wt") as f:
+        f.write(_fastq(300))
+    return tmp_path / "archive"
+
+
+def test_reservoir_keeps_everything_when_short():
+    r = Reservoir(10, random.Random(1))
+    for i in range(4):
+        r.offer(i)
+    assert r.items == [0, 1, 2, 3]
+    assert r.seen == 4
+
+
+def test_reservoir_is_bounded_and_seeded():
+    def draw(seed):
+        r = Reservoir(10, random.Random(seed))
+        for i in range(10000):
+            r.offer(i)
+        return r.items
+
+    assert len(draw(1)) == 10
+    assert draw(1) == draw(1)
+    assert draw(1) != draw(2)
+
+
+def test_reservoir_is_uniform():
+    counts = collections.Counter()
+    for seed in range(2000):
+        r = Reservoir(2, random.Random(seed))
+        for i in range(10):
+            r.offer(i)
+        counts.update(r.items)
+    # Each item is kept with probability 2/10, i.e. about 400 times
+    assert all(300 < counts[i] < 500 for i in range(10))
+
+
+def test_sample_reads_by_barcode():
+    reservoirs = sample_reads(io.StringIO(_fastq(90)), 5, barcodes=["AAAA", "CCCC"])
+    assert reservoirs["AAAA"].seen == 30
+    assert len(reservoirs["AAAA"].items) == 5
+    assert all(d.endswith("AAAA") for d, _, _ in reservoirs["AAAA"].items)
+    # Reads with unregistered indexes are sampled together
+    assert reservoirs[None].seen == 30
+
+
+def test_write_subsample(db, archive, tmp_path):
+    cache_dir = tmp_path / "cache"
+    registry = SampleRegistry(db)
+    info = write_subsample(
+        registry, 1, size=20, archive_root=archive, cache_dir=cache_dir
+    )
+    assert info["total_reads"] == 300
+    assert info["sampled_reads"] == 20
+    assert subsample_info(1, cache_dir) == info
+    with gzip.open(subsample_path(1, cache_dir), "rt") as f:
+        assert len(list(parse_fastq(f))) == 20
+
+    # Same parameters reuse the cache, new ones replace it
+    assert (
+        write_subsample(registry, 1, size=20, archive_root=archive, cache_dir=cache_dir)
+        == info
+    )
+    info = write_subsample(
+        registry, 1, size=5, by_barcode=True, archive_root=archive, cache_dir=cache_dir
+    )
+    assert info["barcodes"] == {"unassigned": 5, "AAAA": 5, "CCCC": 5}
+
+
+def test_subsample_run(db, archive, tmp_path):
+    out = io.StringIO()
+    subsample_run(
+        [
+            "1",
+            "--size",
+            "7",
+            "--archive-root",
+            str(archive),
+            "--cache-dir",
+            str(tmp_path / "cache"),
+        ],
+        db,
+        out,
+    )
+    assert out.getvalue().startswith("Sampled 7 of 300 reads")
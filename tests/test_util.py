@@ -1,11 +1,17 @@
 import collections
 import io
+import pytest
 from sample_registry.util import (
     key_by_attr,
     dict_from_eav,
     local_filepath,
     parse_fasta,
     parse_fastq,
+    illumina_index,
+    split_data_uri,
+    parse_accession,
+    accession_number,
+    chunked,
     deambiguate,
     reverse_complement,
 )
@@ -68,6 +74,47 @@ def test_parse_fastq():
         pass
 
 
+def test_illumina_index():
+    desc = "M03543:21:C8LJ2ANXX:1:2209:1084:2044 1:N:0:ACGTACGT+TTGATTGA"
+    assert illumina_index(desc) == "ACGTACGT-TTGATTGA"
+    assert illumina_index("M03543:21:C8LJ2ANXX:1:2209:1084:2044 1:N:0:ACGT\n") == "ACGT"
+
+
+def test_split_data_uri():
+    assert split_data_uri(
+        "Miseq/160511_M03543_0047_000000000-APE6Y/Data/Intensities/BaseCalls/"
+        "Undetermined_S0_L001_R1_001.fastq.gz"
+    ) == {
+        "run_folder": "160511_M03543_0047_000000000-APE6Y",
+        "file_name": "Undetermined_S0_L001_R1_001.fastq.gz",
+        "lane": 1,
+    }
+    assert split_data_uri("raw_data/run1/reads.fastq.gz") == {
+        "run_folder": None,
+        "file_name": "reads.fastq.gz",
+        "lane": None,
+    }
+
+
+def test_parse_accession():
+    assert parse_accession("CMS000123") == ("sample", 123)
+    assert parse_accession(" cmr7 ") == ("run", 7)
+    with pytest.raises(ValueError):
+        parse_accession("CMX000001")
+
+
+def test_accession_number():
+    assert accession_number("CMR000012", "run") == 12
+    assert accession_number("12", "sample") == 12
+    with pytest.raises(ValueError):
+        accession_number("CMS000012", "run")
+
+
+def test_chunked():
+    assert list(chunked("ABCDEFG", 3)) == [["A", "B", "C"], ["D", "E", "F"], ["G"]]
+    assert list(chunked([], 3)) == []
+
+
 def test_deambiguate():
     obs = set(deambiguate("AYGR"))
     exp = set(["ACGA", "ACGG", "ATGA", "ATGG"])
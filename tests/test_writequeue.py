@@ -0,0 +1,152 @@
+import threading
+import time
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+from sample_registry.db import create_test_db
+from sample_registry.models import Base, Run
+from sample_registry.operations import OperationError
+from sample_registry.writequeue import QueueFull, WriteQueue, WriteTimeout
+
+
+@pytest.fixture()
+def Session(tmp_path):
+    # A file, so the writer thread's connection sees the same database
+    engine = create_engine(f"sqlite:///{tmp_path / 'registry.sqlite'}", echo=False)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    with Session() as session:
+        create_test_db(session)
+    return Session
+
+
+def set_comment(registry, data):
+    run_accession, comment = data
+    if comment is None:
+        raise OperationError("Missing comment")
+    registry.modify_run(run_accession, comment=comment)
+    return {"run_accession": run_accession, "comment": comment}
+
+
+def _blocked(q):
+    """Hold the writer thread until the returned event is set."""
+    started = threading.Event()
+    release = threading.Event()
+
+    def block(registry, data):
+        started.set()
+        release.wait()
+        return {}
+
+    threading.Thread(target=q.submit, args=(block, None), daemon=True).start()
+    started.wait()
+    return release
+
+
+def _wait_for_depth(q, n):
+    while q.depth() < n:
+        time.sleep(0.001)
+
+
+def _submit_all(q, items):
+    results = [None] * len(items)
+
+    def submit(i, data):
+        try:
+            results[i] = q.submit(set_comment, data)
+        except Exception as exc:
+            results[i] = exc
+
+    threads = [
+        threading.Thread(target=submit, args=(i, data)) for i, data in enumerate(items)
+    ]
+    for t in threads:
+        t.start()
+    return threads, results
+
+
+def test_writes_are_committed_in_groups(Session):
+    q = WriteQueue(Session)
+    release = _blocked(q)
+    threads, results = _submit_all(q, [(1, f"comment {i}") for i in range(10)])
+    _wait_for_depth(q, 10)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert [r["run_accession"] for r in results] == [1] * 10
+    # The blocking write, then the ten queued behind it
+    assert q.groups_committed == 2
+    with Session() as session:
+        assert session.scalar(select(Run.comment).where(Run.run_accession == 1)) in {
+            f"comment {i}" for i in range(10)
+        }
+
+
+def test_failed_write_doesnt_affect_its_group(Session):
+    q = WriteQueue(Session)
+    release = _blocked(q)
+    threads, results = _submit_all(q, [(1, "one"), (2, None), (3, "three")])
+    _wait_for_depth(q, 3)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert results[0] == {"run_accession": 1, "comment": "one"}
+    assert isinstance(results[1], OperationError)
+    assert results[2] == {"run_accession": 3, "comment": "three"}
+    with Session() as session:
+        comments = dict(session.execute(select(Run.run_accession, Run.comment)).all())
+    assert comments[1] == "one"
+    assert comments[2] == "Test run 2"
+    assert comments[3] == "three"
+
+
+def test_full_queue_rejects_writes(Session):
+    q = WriteQueue(Session, max_depth=2)
+    release = _blocked(q)
+    threads, results = _submit_all(q, [(1, "a"), (2, "b")])
+    _wait_for_depth(q, 2)
+    with pytest.raises(QueueFull):
+        q.submit(set_comment, (3, "c"))
+    release.set()
+    for t in threads:
+        t.join()
+    assert all(isinstance(r, dict) for r in results)
+
+
+def test_writer_survives_session_errors(Session):
+    calls = []
+
+    def session_factory():
+        calls.append(None)
+        if len(calls) == 1:
+            raise RuntimeError("database unreachable")
+        return Session()
+
+    q = WriteQueue(session_factory)
+    with pytest.raises(RuntimeError, match="database unreachable"):
+        q.submit(set_comment, (1, "lost"))
+    assert q.submit(set_comment, (1, "kept")) == {
+        "run_accession": 1,
+        "comment": "kept",
+    }
+
+
+def test_slow_write_times_out(Session):
+    q = WriteQueue(Session)
+    release = _blocked(q)
+    q.timeout = 0.05
+    with pytest.raises(WriteTimeout):
+        q.submit(set_comment, (1, "late"))
+    release.set()
+    # Still applied once the writer gets to it
+    deadline = time.monotonic() + 10
+    while True:
+        with Session() as session:
+            if session.scalar(select(Run.comment).where(Run.run_accession == 1)) == (
+                "late"
+            ):
+                break
+        assert time.monotonic() < deadline
+        time.sleep(0.01)